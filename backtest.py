@@ -0,0 +1,305 @@
+import argparse
+import datetime
+import logging
+import os
+from itertools import chain
+
+import numpy
+
+# Grabs non-application specific helper modules
+import helper
+import process
+import sentiment
+import sources
+import trade
+
+"""
+Backtesting harness that replays archived tweets through the SA
+engine's scoring once, keeping each (company, polarity, weight,
+timestamp) it extracts column-wise, and then sweeps a whole grid
+of trading thresholds over them against local OHLC prices, as
+NumPy passes over every event rather than a pipeline run each
+"""
+
+BACKTEST_DIRECTORY = 'output/backtest'
+EVENTS_FILE = '.app.events.npz'
+
+# Tweets read in and scored at a time while building the events
+CHUNK_SIZE = 10000
+
+# Events times threshold combinations swept at once, which bounds memory use
+SWEEP_CELLS = 1 << 22
+
+# Default soft and hard thresholds swept, as start:stop:step, puts mirror calls
+SOFT_GRID = '0:200:10'
+HARD_GRID = '0:400:20'
+
+# Combinations listed in the report, best first
+TOP_COMBINATIONS = 10
+
+
+class Events:
+    """
+    Scoring events laid out column-wise in time order: every company
+    mentioned by each scored tweet, with the tweet's polarity, weight
+    (ln of its retweets+fav) and timestamp (int64 microseconds)
+    """
+
+    def __init__(self, companies, company_ids, polarities, weights, timestamps):
+        self.companies = companies      # company id => company
+        self.company_ids = company_ids
+        self.polarities = polarities
+        self.weights = weights
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_batches(cls, batches):
+        """
+        From batches of company => (polarity, weight, timestamp)
+        dictionaries, one per tweet, as get_batch_sentiment_analysis
+        gives them back. Ties in time keep their batch order.
+        """
+        companies, polarities, weights, timestamps = [], [], [], []
+        for batch_companies in batches:
+            for new_companies in batch_companies:
+                for company, (polarity, weight, timestamp) in new_companies.items():
+                    companies.append(company)
+                    polarities.append(polarity)
+                    weights.append(weight)
+                    timestamps.append(timestamp)
+        if not companies:
+            empty = numpy.zeros(0)
+            return cls(numpy.array([], dtype=str), empty.astype(numpy.int64), empty, empty,
+                       empty.astype(numpy.int64))
+
+        companies, company_ids = numpy.unique(numpy.array(companies), return_inverse=True)
+        timestamps = trade.parse_timestamps(timestamps)
+        order = numpy.argsort(timestamps, kind='stable')
+        return cls(companies, company_ids[order], numpy.array(polarities, dtype=numpy.float64)[order],
+                   numpy.array(weights, dtype=numpy.float64)[order], timestamps[order])
+
+    def save(self, file_name):
+        with open(file_name, "wb") as events_file:
+            numpy.savez(events_file, companies=self.companies, company_ids=self.company_ids,
+                        polarities=self.polarities, weights=self.weights, timestamps=self.timestamps)
+
+    @classmethod
+    def load(cls, file_name):
+        with numpy.load(file_name) as events:
+            return cls(events['companies'], events['company_ids'], events['polarities'], events['weights'],
+                       events['timestamps'])
+
+
+def score_chunks(file_names, aliases, pool=None, chunk_size=CHUNK_SIZE):
+    """
+    Scores the tweets of archived input files (tweet text|retweets+fav|timestamp)
+    or batch files a chunk at a time, split across scoring workers if given a pool
+    """
+    for file_name in file_names:
+        tweets = []
+        for tweet in chain(sources.FileSource.read(file_name), [None]):
+            if tweet is not None:
+                tweets.append(tweet)
+            if tweets and (tweet is None or len(tweets) == chunk_size):
+                if pool is None:
+                    yield process.get_batch_sentiment_analysis(tweets, aliases)
+                else:
+                    chunks = [tweets[i:i + process.WORKER_CHUNK_SIZE]
+                              for i in range(0, len(tweets), process.WORKER_CHUNK_SIZE)]
+                    yield list(chain.from_iterable(pool.map(process.score_tweets, chunks)))
+                tweets = []
+        logging.info('Scored the tweets of ' + file_name)
+
+
+def build_events(file_names, aliases, pool=None):
+    return Events.from_batches(score_chunks(file_names, aliases, pool))
+
+
+def threshold_grid(soft, hard, put_soft=None, put_hard=None):
+    """
+    Every combination of soft and hard thresholds, as call soft, call hard,
+    put soft and put hard columns, where the soft threshold is no further
+    out than the hard one. Put thresholds are given as distances below 0,
+    and mirror the call thresholds unless given.
+    """
+    if put_soft is None and put_hard is None:
+        soft, hard = (grid.ravel() for grid in numpy.meshgrid(soft, hard, indexing='ij'))
+        is_valid = soft <= hard
+        return soft[is_valid], hard[is_valid], 0.0 - soft[is_valid], 0.0 - hard[is_valid]
+
+    put_soft = soft if put_soft is None else put_soft
+    put_hard = hard if put_hard is None else put_hard
+    grids = [grid.ravel() for grid in numpy.meshgrid(soft, hard, put_soft, put_hard, indexing='ij')]
+    is_valid = (grids[0] <= grids[1]) & (grids[2] <= grids[3])
+    return grids[0][is_valid], grids[1][is_valid], 0.0 - grids[2][is_valid], 0.0 - grids[3][is_valid]
+
+
+class Backtest:
+    """
+    Events laid out for sweeping thresholds over: grouped by company in
+    time order, each with the company's cumulative score after it, and
+    the change in price until the company's next event (or the end).
+
+    The cumulative scores are those the SA engine trades on, from a clean
+    state. Trading matches trade.py: each signal trades the company into
+    its position, at the price as of the signal, a score in the no trade
+    band takes it flat, and events without a price yet are skipped.
+    """
+
+    def __init__(self, events, price_book, end=None):
+        order, is_first = trade.group_by(events.company_ids)
+        company_ids = events.company_ids[order]
+        timestamps = events.timestamps[order]
+        scores = trade.grouped_cumsum((events.polarities * events.weights)[order], is_first)
+
+        prices, has_price = price_book.as_of(company_ids, timestamps)
+        skipped = len(events) - int(has_price.sum())
+        if skipped:
+            logging.warning('Skipped %d events without a price', skipped)
+        company_ids, timestamps, scores, prices = (column[has_price]
+                                                   for column in (company_ids, timestamps, scores, prices))
+
+        # Positions are marked to market at the end, by default the latest price
+        if end is None:
+            end = int(price_book.timestamps.max()) if len(price_book.timestamps) else 0
+        _, is_first = trade.group_by(company_ids)
+        is_last = numpy.append(is_first[1:], True)[:len(is_first)]
+        final_prices, _ = price_book.as_of(company_ids[is_last], numpy.maximum(timestamps[is_last], end))
+        next_prices = numpy.roll(prices, -1)
+        next_prices[is_last] = final_prices
+
+        self.scores = scores
+        self.is_first = is_first
+        self.price_changes = next_prices - prices
+
+    def __len__(self):
+        return len(self.scores)
+
+    def sweep(self, call_soft, call_hard, put_soft, put_hard, lot_size=trade.LOT_SIZE):
+        """
+        Gains/losses and number of fills for each combination of
+        thresholds (equal length columns, see threshold_grid), each
+        computed over every event at once, a chunk of combinations
+        at a time
+        """
+        # Band edges in the order process.band_lots takes them, one combination per row
+        thresholds = [numpy.asarray(column, dtype=numpy.float64).reshape(-1, 1)
+                      for column in (put_hard, put_soft, call_soft, call_hard)]
+        combinations = len(thresholds[0])
+        gains = numpy.zeros(combinations)
+        fills = numpy.zeros(combinations, dtype=numpy.int64)
+        if len(self) == 0:
+            return gains, fills
+
+        is_later = ~self.is_first[1:]
+
+        step = max(SWEEP_CELLS // len(self), 1)
+        for start in range(0, combinations, step):
+            chunk = [column[start:start + step] for column in thresholds]
+            # Each event holds the position its score bands into, as the SA engine bands
+            # it for trades, each company starting from flat
+            positions = process.band_lots(self.scores, chunk)
+
+            changes = positions[:, 1:] != positions[:, :-1]
+            changes &= is_later
+            gains[start:start + step] = positions @ self.price_changes * lot_size
+            fills[start:start + step] = (numpy.count_nonzero(changes, axis=1)
+                                         + numpy.count_nonzero(positions[:, self.is_first], axis=1))
+        return gains, fills
+
+
+def parse_range(text):
+    """
+    start:stop:step (stop included) or a single value => array of values
+    """
+    values = [float(value) for value in text.split(':')]
+    if len(values) == 1:
+        return numpy.array(values)
+    if len(values) != 3 or values[2] <= 0:
+        raise argparse.ArgumentTypeError('expected start:stop:step, got ' + text)
+    start, stop, step = values
+    return numpy.arange(start, stop + step / 2, step)
+
+
+def write_report(backtest, grid, results, current, top, report_file):
+    gains, fills = results
+    lines = ['{0:>10} {1:>10} {2:>10} {3:>10} {4:>8} {5:>16}'.format(
+        'call soft', 'call hard', 'put soft', 'put hard', 'fills', 'gain/loss')]
+    for index in numpy.argsort(-gains, kind='stable')[:top]:
+        lines.append('{0:>10g} {1:>10g} {2:>10g} {3:>10g} {4:>8} {5:>16.2f}'.format(
+            grid[0][index], grid[1][index], grid[2][index], grid[3][index], fills[index], gains[index]))
+
+    current_gains, current_fills = current
+    lines.append('')
+    lines.append('Current thresholds ({0:g}, {1:g}, {2:g}, {3:g}): {4} fills, gain/loss {5:.2f}'.format(
+        process.CALL_THRESHOLD_SOFT, process.CALL_THRESHOLD_HARD, process.PUT_THRESHOLD_SOFT,
+        process.PUT_THRESHOLD_HARD, current_fills[0], current_gains[0]))
+    lines.append('Swept {0} combinations over {1} events'.format(len(gains), len(backtest)))
+
+    report = '\n'.join(lines) + '\n'
+    with open(report_file, "w") as output_file:
+        output_file.write(report)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Sweeps trading thresholds over archived tweets and OHLC prices')
+    parser.add_argument("inputs", nargs='*',
+                        help="archived input files (tweet text|retweets+fav|timestamp) or batch files to score "
+                             "into the events file, the events file is reused without any")
+    parser.add_argument("--prices", required=True,
+                        help="OHLC price file (timestamp,company,open,high,low,close, with a header line), "
+                             "trades are placed at the close as of each signal")
+    parser.add_argument("--events", default=EVENTS_FILE, help="columnar file of scored events")
+    parser.add_argument("--soft", type=parse_range, default=SOFT_GRID, help="soft thresholds, start:stop:step")
+    parser.add_argument("--hard", type=parse_range, default=HARD_GRID, help="hard thresholds, start:stop:step")
+    parser.add_argument("--put-soft", type=parse_range,
+                        help="soft put thresholds below 0, start:stop:step, the soft thresholds by default")
+    parser.add_argument("--put-hard", type=parse_range,
+                        help="hard put thresholds below 0, start:stop:step, the hard thresholds by default")
+    parser.add_argument("--thresholds", type=helper.parse_thresholds,
+                        help="current band edges of trades to compare against, as "
+                             "--thresholds=PUT_HARD,PUT_SOFT,CALL_SOFT,CALL_HARD, those of process.py by default")
+    parser.add_argument("--lot-size", type=int, default=trade.LOT_SIZE, help="shares per lot")
+    parser.add_argument("--top", type=int, default=TOP_COMBINATIONS, help="number of combinations to report")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of processes to score sentiment across")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    helper.setup_logging(args.verbose)
+    if args.thresholds is not None:
+        process.set_thresholds(args.thresholds)
+
+    if args.inputs:
+        # Aliases are those gathered in history, polarities of retweets are only scored once
+        _, aliases = process.read_history_files()
+        process.setup_cache(sentiment.CACHE_SIZE, False)
+        if args.workers > 1:
+            with process.create_worker_pool(args.workers, aliases) as pool:
+                events = build_events(args.inputs, aliases, pool)
+        else:
+            events = build_events(args.inputs, aliases)
+        events.save(args.events)
+        logging.info('Saved %d events to %s', len(events), args.events)
+    else:
+        events = Events.load(args.events)
+
+    backtest = Backtest(events, trade.read_prices(args.prices, events.companies, 'close'))
+    grid = threshold_grid(args.soft, args.hard, args.put_soft, args.put_hard)
+    results = backtest.sweep(*grid, lot_size=args.lot_size)
+    current = backtest.sweep([process.CALL_THRESHOLD_SOFT], [process.CALL_THRESHOLD_HARD],
+                             [process.PUT_THRESHOLD_SOFT], [process.PUT_THRESHOLD_HARD], args.lot_size)
+
+    os.makedirs(BACKTEST_DIRECTORY, exist_ok=True)
+    report_file = BACKTEST_DIRECTORY + '/' + datetime.datetime.now().isoformat() + '.backtest'
+    print(write_report(backtest, grid, results, current, args.top, report_file))
+
+
+if __name__ == '__main__':
+    main()
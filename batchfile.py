@@ -0,0 +1,176 @@
+import argparse
+import logging
+from collections.abc import Sequence
+
+import numpy
+
+# Grabs non-application specific helper modules
+import process
+import scores
+
+"""
+Columnar binary format for batches of tweets, used to hand batches
+from the ingestion engine to the processing engine, and to archive
+tweets for replay and backtesting. Laid out as:
+
+    magic (8 bytes) | tweet count (int64)
+    retweets+fav (int64 per tweet)
+    timestamp (int64 microseconds since the epoch per tweet)
+    text offsets (int64 per tweet, plus the end of the last one)
+    tweet texts (utf-8, back to back)
+
+every number little-endian, so that a batch file is read in place
+through a memory map, without parsing any of it
+"""
+
+MAGIC = b'TWBATCH1'
+
+# Bytes of each number in the header and columns
+WORD = 8
+COLUMN_TYPE = numpy.dtype('<i8')
+
+
+def pack(tweets):
+    """
+    (tweet text, retweets+fav, timestamp) records => a batch, tweets
+    with an invalid timestamp are dropped
+    """
+    try:
+        timestamps = scores.to_epochs([str(tweet[2]) for tweet in tweets])
+    except ValueError:
+        valid = []
+        for tweet in tweets:
+            try:
+                scores.to_epoch(tweet[2])
+                valid.append(tweet)
+            except ValueError:
+                logging.warning('Dropped a tweet with an invalid timestamp: %s', tweet)
+        return pack(valid)
+
+    texts = [tweet[0].encode('utf-8') for tweet in tweets]
+    offsets = numpy.zeros(len(texts) + 1, dtype=COLUMN_TYPE)
+    numpy.cumsum([len(text) for text in texts], out=offsets[1:])
+    engagements = numpy.array([int(tweet[1]) for tweet in tweets], dtype=COLUMN_TYPE)
+
+    return b''.join([MAGIC, numpy.array([len(texts)], dtype=COLUMN_TYPE).tobytes(), engagements.tobytes(),
+                     timestamps.astype(COLUMN_TYPE).tobytes(), offsets.tobytes()] + texts)
+
+
+def columns(batch):
+    """
+    Views of a batch's retweets+fav, timestamp and text offset
+    columns, and of its texts, none of them copied
+    """
+    if bytes(batch[:len(MAGIC)]) != MAGIC:
+        raise ValueError('Not a batch of tweets')
+
+    count = int(numpy.frombuffer(batch, COLUMN_TYPE, 1, len(MAGIC))[0])
+    start = len(MAGIC) + WORD
+    engagements = numpy.frombuffer(batch, COLUMN_TYPE, count, start)
+    timestamps = numpy.frombuffer(batch, COLUMN_TYPE, count, start + count * WORD)
+    offsets = numpy.frombuffer(batch, COLUMN_TYPE, count + 1, start + 2 * count * WORD)
+    texts = memoryview(batch)[start + (3 * count + 1) * WORD:]
+    return engagements, timestamps, offsets, texts
+
+
+class Batch(Sequence):
+    """
+    The (tweet text, retweets+fav, timestamp) records of a batch, read
+    off its columns as they are needed rather than unpacked up front.
+
+    Each column is only decoded, all in one go, the first time it is
+    needed, and kept. Records are put together one at a time, out of
+    the decoded columns, as they are looked up or iterated over.
+    """
+
+    def __init__(self, batch):
+        self._engagement_column, self._timestamp_column, self._offsets, self._text_bytes = columns(batch)
+        self._texts = None
+        self._engagements = None
+        self._timestamps = None
+
+    @property
+    def texts(self):
+        if self._texts is None:
+            offsets = self._offsets.tolist()
+            text = str(self._text_bytes[:offsets[-1]], 'utf-8')
+            if len(text) == offsets[-1]:
+                # Every character is a single byte, so texts are sliced straight out of the whole
+                self._texts = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+            else:
+                self._texts = [str(self._text_bytes[start:end], 'utf-8') for start, end in zip(offsets, offsets[1:])]
+        return self._texts
+
+    @property
+    def engagements(self):
+        if self._engagements is None:
+            self._engagements = self._engagement_column.tolist()
+        return self._engagements
+
+    @property
+    def timestamps(self):
+        if self._timestamps is None:
+            self._timestamps = scores.from_epochs(self._timestamp_column)
+        return self._timestamps
+
+    def __len__(self):
+        return len(self._engagement_column)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self.texts[index], self.engagements[index], self.timestamps[index]))
+        return self.texts[index], self.engagements[index], self.timestamps[index]
+
+    def __iter__(self):
+        return zip(self.texts, self.engagements, self.timestamps)
+
+
+def unpack(batch):
+    """
+    A batch => its (tweet text, retweets+fav, timestamp) records, see Batch
+    """
+    return Batch(batch)
+
+
+def is_batch_file(file_name):
+    with open(file_name, "rb") as batch_file:
+        return batch_file.read(len(MAGIC)) == MAGIC
+
+
+def write_batch(file_name, tweets):
+    with open(file_name, "wb") as batch_file:
+        batch_file.write(pack(tweets))
+
+
+def read_batch(file_name):
+    """
+    Reads a batch file in place, through a memory map
+    """
+    return unpack(numpy.memmap(file_name, dtype=numpy.uint8, mode='r'))
+
+
+def read_tweets(file_name):
+    """
+    Records of a batch file, or of an input file (tweet text|retweets+fav|timestamp)
+    """
+    if is_batch_file(file_name):
+        return read_batch(file_name)
+    with open(file_name, "r") as input_file:
+        return [tuple(process.parse_line(line)) for line in input_file if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts input files into a batch file, e.g. to archive them')
+    parser.add_argument("inputs", nargs='+', help="input files (tweet text|retweets+fav|timestamp) or batch files")
+    parser.add_argument("output", help="batch file to write")
+    args = parser.parse_args()
+
+    tweets = []
+    for file_name in args.inputs:
+        tweets.extend(read_tweets(file_name))
+    write_batch(args.output, tweets)
+    print('Wrote ' + str(len(tweets)) + ' tweets to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+# Benchmarking suite for the application
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import chain
+
+import numpy
+
+import backtest
+import helper
+import process
+import scores
+import sentiment
+import trade
+from engine import MAX_BATCH_SIZE, ProcessingEngine
+from matcher import AliasMatcher
+
+"""
+Benchmarks are run from a scratch working directory,
+so that they never touch the real history/trade files
+"""
+
+ROOT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIRECTORY = os.path.join(ROOT_DIRECTORY, process.TESTING_DIRECTORY)
+
+
+@contextlib.contextmanager
+def scratch_directory():
+    """
+    Switches into a fresh working directory seeded with the
+    base aliases as history, and cleans it up afterwards
+    """
+    previous_directory = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        os.mkdir(process.LOGGING_DIRECTORY)
+        shutil.copyfile(os.path.join(FIXTURE_DIRECTORY, 'base_aliases'), process.HISTORY_FILE)
+        yield directory
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory)
+
+
+def fixture_batch(batch_size):
+    """
+    Builds a batch of input lines by cycling through the test inputs
+    """
+    lines = []
+    for fixture in range(1, 6):
+        with open(os.path.join(FIXTURE_DIRECTORY, 'test_input_' + str(fixture)), "r") as input_file:
+            lines.extend(line.strip() for line in input_file if line.strip())
+    return [lines[i % len(lines)] for i in range(batch_size)]
+
+
+def summarise(latencies):
+    return {
+        'samples': len(latencies),
+        'mean': statistics.mean(latencies),
+        'median': statistics.median(latencies),
+        'min': min(latencies),
+        'max': max(latencies),
+    }
+
+
+def bench_spawned_engine(batches, batch_size):
+    """
+    Per-batch latency of spawning `python process.py` for every batch
+    """
+    batch = fixture_batch(batch_size)
+    latencies = []
+    with scratch_directory():
+        for _ in range(batches):
+            start = time.perf_counter()
+            with open('.input', "w") as input_file:
+                input_file.write('\n'.join(batch) + '\n')
+            subprocess.check_call([sys.executable, os.path.join(ROOT_DIRECTORY, 'process.py'), '.input'],
+                                  stdout=subprocess.DEVNULL)
+            latencies.append(time.perf_counter() - start)
+    return summarise(latencies)
+
+
+def bench_startup(runs):
+    """
+    Time taken by a fresh interpreter to import the processing engine and
+    load the sentiment lexicon, from TextBlob and from its compiled index
+    """
+    results = {}
+    with scratch_directory() as directory:
+        lexicon_file = os.path.join(directory, 'lexicon.npy')
+        sentiment.build_lexicon(lexicon_file)
+        for name, load in (('TextBlob lexicon', 'sentiment.Lexicon.from_pattern()'),
+                           ('compiled lexicon', 'sentiment.load_lexicon(' + repr(lexicon_file) + ')')):
+            latencies = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.check_call([sys.executable, '-c', 'import process, sentiment; ' + load],
+                                      cwd=ROOT_DIRECTORY)
+                latencies.append(time.perf_counter() - start)
+            results[name] = summarise(latencies)
+    return results
+
+
+def bench_resident_engine(batches, batch_size):
+    """
+    Per-batch latency of handing batches to the resident processing engine
+    """
+    tweets = [process.parse_line(line) for line in fixture_batch(batch_size)]
+    latencies = []
+    with scratch_directory():
+        engine = ProcessingEngine().start()
+        for _ in range(batches):
+            start = time.perf_counter()
+            engine.submit(tweets)
+            engine.wait()
+            latencies.append(time.perf_counter() - start)
+        engine.stop()
+    return summarise(latencies)
+
+
+def read_base_aliases():
+    aliases = {}
+    with open(os.path.join(FIXTURE_DIRECTORY, 'base_aliases'), "r") as alias_file:
+        for line in alias_file:
+            _, alias, company = line.strip().split(', ', 2)
+            aliases[alias] = company
+    return aliases
+
+
+def synthetic_aliases(alias_count, seed=0):
+    """
+    Pads the base aliases out with generated multi-word company
+    names and tickers until there are alias_count of them
+    """
+    generator = random.Random(seed)
+    aliases = dict(list(read_base_aliases().items())[:alias_count])
+    suffixes = ['Inc', 'Corp', 'Holdings', 'Group', 'plc', 'Co']
+    while len(aliases) < alias_count:
+        ticker = ''.join(generator.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+        name = 'Company' + str(len(aliases)) + ' ' + generator.choice(suffixes)
+        aliases[name] = ticker
+        if len(aliases) < alias_count:
+            aliases[ticker] = ticker
+    return aliases
+
+
+def synthetic_tweets(aliases, tweet_count, seed=0):
+    generator = random.Random(seed)
+    names = list(aliases)
+    filler = 'the market is looking really strong today for some reason and I am buying more'.split()
+    tweets = []
+    for _ in range(tweet_count):
+        words = generator.sample(filler, 8)
+        for _ in range(generator.randint(0, 2)):
+            words.insert(generator.randint(0, len(words)), generator.choice(names))
+        tweets.append(' '.join(words))
+    return tweets
+
+
+def bench_alias_matching(alias_count, tweet_count):
+    """
+    Automaton build time, and per-tweet extraction time against
+    the single-word token lookup it replaced
+    """
+    aliases = synthetic_aliases(alias_count)
+    tweets = synthetic_tweets(aliases, tweet_count)
+
+    start = time.perf_counter()
+    alias_matcher = AliasMatcher(aliases)
+    alias_matcher.find('')
+    build = time.perf_counter() - start
+
+    latencies = []
+    for tweet in tweets:
+        start = time.perf_counter()
+        alias_matcher.find(tweet)
+        latencies.append(time.perf_counter() - start)
+
+    token_latencies = []
+    for tweet in tweets:
+        start = time.perf_counter()
+        [aliases[token] for token in helper.normalise_tweet(tweet)[0] if token in aliases]
+        token_latencies.append(time.perf_counter() - start)
+
+    return build, summarise(latencies), summarise(token_latencies)
+
+
+# Words tweets are generated from, with modifiers and negations in the mix
+POSITIVE_WORDS = ['good', 'great', 'amazing', 'strong', 'bullish', 'excellent', 'happy', 'best']
+NEGATIVE_WORDS = ['bad', 'terrible', 'weak', 'awful', 'poor', 'worst', 'sad', 'disappointing']
+NEUTRAL_WORDS = ['the', 'market', 'is', 'today', 'for', 'quarter', 'shares', 'and', 'earnings', 'this',
+                 'stock', 'price', 'news', 'about', 'on', 'after', 'report', 'analysts', 'say', 'week']
+MODIFIER_WORDS = ['very', 'really', 'not', 'never', 'extremely']
+
+SUITE_SIZES = (1000, 100000, 1000000)
+
+# Most tweets single-tweet sentiment is timed over, per size
+SENTIMENT_SAMPLE_SIZE = 10000
+
+
+def generate_tweets(tweet_count, seed=0, mention_rate=0.7):
+    """
+    Deterministically generates input lines (tweet text|engagement|timestamp),
+    most of which mention one or more of the base aliases
+    """
+    generator = random.Random(seed)
+    aliases = list(read_base_aliases())
+    moment = datetime.datetime(2017, 4, 11, 8, 0, 0)
+    for _ in range(tweet_count):
+        words = generator.sample(NEUTRAL_WORDS, generator.randint(4, 10))
+        for _ in range(generator.randint(1, 3)):
+            sentiment_word = generator.choice(POSITIVE_WORDS + NEGATIVE_WORDS)
+            if generator.random() < 0.2:
+                sentiment_word = generator.choice(MODIFIER_WORDS) + ' ' + sentiment_word
+            words.insert(generator.randint(0, len(words)), sentiment_word)
+        if generator.random() < mention_rate:
+            for _ in range(generator.randint(1, 2)):
+                words.insert(generator.randint(0, len(words)), generator.choice(aliases))
+
+        # Engagement is at least 2, so that no tweet carries a zero (or undefined) weight
+        engagement = int(generator.paretovariate(1.2)) + 1
+        moment += datetime.timedelta(microseconds=generator.randint(1, 2000000))
+        yield ' '.join(words) + '|' + str(engagement) + '|' + moment.isoformat()
+
+
+def write_corpus(path, tweet_count, seed=0):
+    with open(path, "w") as corpus_file:
+        for line in generate_tweets(tweet_count, seed):
+            corpus_file.write(line + '\n')
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_functions(tweet_count, seed=0):
+    """
+    Times each of the processing engine's functions over a synthetic
+    corpus of tweet_count tweets, returns name => (seconds, items)
+    """
+    results = {}
+    with scratch_directory():
+        write_corpus('.input', tweet_count, seed)
+        process.setup(helper.parse_args([]))
+
+        # One-off lexicon load is left out of every timing
+        sentiment.load_lexicon()
+
+        seconds, (viability_scores, aliases) = timed(process.read_history)
+        results['read_history (aliases only)'] = seconds, len(aliases)
+
+        seconds, (viability_scores, aliases) = timed(process.parse_input, viability_scores, aliases, '.input')
+        results['parse_input'] = seconds, tweet_count
+
+        with open('.input', "r") as input_file:
+            tweets = [process.parse_line(line) for line in input_file]
+
+        def extract_all():
+            for tweet in tweets:
+                process.extract_companies(tweet[0], aliases)
+        results['extract_companies'] = timed(extract_all)[0], tweet_count
+
+        sample = [tweet[0] for tweet in tweets[:SENTIMENT_SAMPLE_SIZE]]
+
+        def score_all():
+            process.setup_cache(0, False)
+            for tweet in sample:
+                process.get_tweet_sentiment(tweet)
+        results['get_tweet_sentiment (uncached)'] = timed(score_all)[0], len(sample)
+
+        batch_companies = process.get_batch_sentiment_analysis(tweets, aliases)
+
+        def add_all():
+            table = scores.ScoreTable()
+            for new_companies in batch_companies:
+                table = process.add_new_state(table, new_companies)
+        results['add_new_state'] = timed(add_all)[0], tweet_count
+
+        results['write_trades'] = timed(process.write_trades, viability_scores)[0], len(viability_scores)
+        touched = set(chain.from_iterable(batch_companies[-MAX_BATCH_SIZE:]))
+        results['write_trades (one batch touched)'] = (timed(process.write_trades, viability_scores, touched)[0],
+                                                       len(touched))
+        results['write_history (snapshot)'] = (timed(process.write_history, viability_scores, aliases)[0],
+                                               len(viability_scores) + len(aliases))
+        seconds, (viability_scores, aliases) = timed(process.read_history)
+        results['read_history'] = seconds, len(viability_scores) + len(aliases)
+
+        process.setup_cache(0, False)
+    return results
+
+
+def run_suite(sizes, seed=0):
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'sizes': {},
+    }
+    for size in sizes:
+        print('{0:<32} {1:>10} {2:>12} {3:>14}'.format(str(size) + ' tweets', 'items', 'seconds', 'items/s'))
+        results['sizes'][str(size)] = {}
+        for name, (seconds, items) in bench_functions(size, seed).items():
+            print('{0:<32} {1:>10} {2:>12} {3:>14}'.format(
+                name, items, '%.6f' % seconds, '%.1f' % (items / seconds if seconds > 0 else 0.0)))
+            results['sizes'][str(size)][name] = {'seconds': seconds, 'items': items}
+        print('')
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints the ratio of each timing to the same timing in a previous run
+    """
+    print('{0:<32} {1:>10} {2:>12}'.format('compared to previous run', 'tweets', 'time ratio'))
+    for size, timings in results['sizes'].items():
+        for name, timing in timings.items():
+            previous_timing = previous.get('sizes', {}).get(size, {}).get(name)
+            if previous_timing and previous_timing['seconds'] > 0:
+                print('{0:<32} {1:>10} {2:>12}'.format(
+                    name, size, '%.3f' % (timing['seconds'] / previous_timing['seconds'])))
+
+
+def bench_paper_trading(signal_count, seed=0):
+    """
+    Time taken to paper trade a synthetic trade file of signal_count
+    signals over a day, against prices for every company each minute,
+    from reading both files through to the gains/losses per hour
+    """
+    generator = random.Random(seed)
+    companies = sorted(set(read_base_aliases().values()))
+    start = datetime.datetime(2017, 4, 11, 8, 0, 0)
+    with scratch_directory():
+        with open('.app.trades', "w") as trade_file:
+            for index in range(signal_count):
+                moment = start + datetime.timedelta(microseconds=index * 86400000000 // signal_count)
+                trade_file.write(', '.join((generator.choice(['put', 'call']), generator.choice(companies),
+                                            generator.choice(['soft', 'hard']), moment.isoformat())) + '\n')
+        with open('.app.prices', "w") as price_file:
+            price_file.write('timestamp,company,price\n')
+            for minute in range(24 * 60):
+                moment = (start + datetime.timedelta(minutes=minute)).isoformat()
+                for company in companies:
+                    price_file.write(moment + ',' + company + ',' + '%.2f' % generator.uniform(10, 500) + '\n')
+
+        began = time.perf_counter()
+        signals = trade.read_signals('.app.trades')
+        price_book = trade.read_prices('.app.prices', signals.companies)
+        prices_read = time.perf_counter()
+        portfolio = trade.Portfolio(signals.companies)
+        fills = portfolio.execute(signals, price_book)
+        trade.segment_gains(fills, price_book, portfolio.starting_cash)
+        finished = time.perf_counter()
+    return prices_read - began, finished - prices_read
+
+
+def bench_backtest_sweep(event_count, seed=0):
+    """
+    Time taken to lay out event_count synthetic scoring events over a
+    day against prices for every company each minute, and to sweep
+    the default grid of thresholds over them
+    """
+    generator = numpy.random.default_rng(seed)
+    companies = numpy.unique(list(read_base_aliases().values()))
+    start = trade.parse_timestamps(['2017-04-11T08:00:00'])[0]
+    events = backtest.Events(companies, generator.integers(0, len(companies), event_count),
+                             generator.uniform(-1, 1, event_count), generator.uniform(0, 10, event_count),
+                             numpy.sort(generator.integers(start, start + 86400000000, event_count)))
+    minutes = start + numpy.arange(24 * 60, dtype=numpy.int64) * 60000000
+    price_book = trade.AsOfBook(numpy.tile(numpy.arange(len(companies)), len(minutes)),
+                                numpy.repeat(minutes, len(companies)),
+                                generator.uniform(10, 500, len(minutes) * len(companies)))
+    grid = backtest.threshold_grid(backtest.parse_range(backtest.SOFT_GRID), backtest.parse_range(backtest.HARD_GRID))
+
+    began = time.perf_counter()
+    results = backtest.Backtest(events, price_book)
+    laid_out = time.perf_counter()
+    results.sweep(*grid)
+    finished = time.perf_counter()
+    return len(grid[0]), laid_out - began, finished - laid_out
+
+
+def report(name, results):
+    print('{0:<30} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        name, results['samples'], '%.6f' % results['mean'], '%.6f' % results['median'],
+        '%.6f' % results['min'], '%.6f' % results['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the twitter stock trader')
+    parser.add_argument("--batches", type=int, default=10, help="number of batches per benchmark")
+    parser.add_argument("--batch-size", type=int, default=20, help="number of tweets per batch")
+    parser.add_argument("--tweets", type=int, default=10000, help="number of tweets to match aliases against")
+    parser.add_argument("--suite", action="store_true",
+                        help="time each processing function over synthetic corpora instead")
+    parser.add_argument("--sizes", default=','.join(str(size) for size in SUITE_SIZES),
+                        help="comma separated corpus sizes for the suite")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpora")
+    parser.add_argument("--output", help="JSON file to save the suite's results to")
+    parser.add_argument("--compare", help="JSON results of a previous suite run to compare against")
+    args = parser.parse_args()
+
+    if args.suite:
+        results = run_suite([int(size) for size in args.sizes.split(',')], args.seed)
+        if args.output is not None:
+            with open(args.output, "w") as output_file:
+                json.dump(results, output_file, indent=2)
+        if args.compare is not None:
+            with open(args.compare, "r") as previous_file:
+                compare(results, json.load(previous_file))
+        return
+
+    print('{0:<30} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'benchmark', 'batches', 'mean (s)', 'median (s)', 'min (s)', 'max (s)'))
+    report('spawned process.py', bench_spawned_engine(args.batches, args.batch_size))
+    report('resident engine', bench_resident_engine(args.batches, args.batch_size))
+
+    print('\n{0:<30} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'startup', 'runs', 'mean (s)', 'median (s)', 'min (s)', 'max (s)'))
+    for name, results in bench_startup(args.batches).items():
+        report(name, results)
+
+    print('\n{0:<30} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'alias matching', 'tweets', 'mean (s)', 'median (s)', 'min (s)', 'max (s)'))
+    for alias_count in (500, 10000):
+        build, matched, tokens = bench_alias_matching(alias_count, args.tweets)
+        print('{0:<30} {1:>8}'.format(str(alias_count) + ' aliases: build', '%.6f' % build))
+        report(str(alias_count) + ' aliases: automaton', matched)
+        report(str(alias_count) + ' aliases: token lookup', tokens)
+
+    print('\n{0:<30} {1:>10} {2:>12} {3:>12} {4:>14}'.format(
+        'paper trading', 'signals', 'read (s)', 'trade (s)', 'signals/s'))
+    for signal_count in (10000, 1000000):
+        read, traded = bench_paper_trading(signal_count)
+        print('{0:<30} {1:>10} {2:>12} {3:>12} {4:>14}'.format(
+            '', signal_count, '%.6f' % read, '%.6f' % traded, '%.1f' % (signal_count / (read + traded))))
+
+    print('\n{0:<30} {1:>10} {2:>12} {3:>12} {4:>14}'.format(
+        'backtest sweep', 'events', 'layout (s)', 'sweep (s)', 'combinations'))
+    for event_count in (100000, 1000000):
+        combinations, laid_out, swept = bench_backtest_sweep(event_count)
+        print('{0:<30} {1:>10} {2:>12} {3:>12} {4:>14}'.format(
+            '', event_count, '%.6f' % laid_out, '%.6f' % swept, combinations))
+
+
+if __name__ == '__main__':
+    main()
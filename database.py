@@ -0,0 +1,190 @@
+import logging
+import sqlite3
+from collections.abc import MutableMapping
+
+"""
+SQLite state store for viability scores, aliases
+and trades, in place of the flat history/trade files
+"""
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scores (
+    company TEXT PRIMARY KEY,
+    score REAL NOT NULL,
+    weight REAL NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    company TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS aliases_by_company ON aliases (company);
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    company TEXT NOT NULL,
+    strength TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trades_by_company ON trades (company, timestamp);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY
+);
+'''
+
+UPSERT_SCORE = ('INSERT INTO scores (company, score, weight, timestamp) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (company) DO UPDATE SET '
+                'score = excluded.score, weight = excluded.weight, timestamp = excluded.timestamp')
+
+UPSERT_ALIAS = ('INSERT INTO aliases (alias, company) VALUES (?, ?) '
+                'ON CONFLICT (alias) DO UPDATE SET company = excluded.company')
+
+
+def connect(path):
+    """
+    Opens the state store in WAL mode, creating its tables if needed
+    """
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Scores(MutableMapping):
+    """
+    Viability scores backed by the scores table, company => (score, weight, timestamp).
+
+    Lookups are point queries, and updates are held in memory until
+    the batch is written out, so that nothing needs the full state
+    loaded. Only iterating over every company scans the table.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = {}      # Rows read or written during this batch
+        self.dirty = set()  # Rows written during this batch
+
+    def __getitem__(self, company):
+        if company not in self.rows:
+            row = self.connection.execute('SELECT score, weight, timestamp FROM scores WHERE company = ?',
+                                          (company,)).fetchone()
+            if row is None:
+                raise KeyError(company)
+            self.rows[company] = row
+        return self.rows[company]
+
+    def __contains__(self, company):
+        try:
+            self[company]
+            return True
+        except KeyError:
+            return False
+
+    def __setitem__(self, company, score):
+        self.rows[company] = tuple(score)
+        self.dirty.add(company)
+
+    def __delitem__(self, company):
+        self[company]
+        self.connection.execute('DELETE FROM scores WHERE company = ?', (company,))
+        del self.rows[company]
+        self.dirty.discard(company)
+
+    def __iter__(self):
+        self.flush()
+        for (company,) in self.connection.execute('SELECT company FROM scores'):
+            yield company
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+
+    def items(self):
+        self.flush()
+        for company, score, weight, timestamp in self.connection.execute(
+                'SELECT company, score, weight, timestamp FROM scores'):
+            yield company, (score, weight, timestamp)
+
+    def flush(self):
+        """
+        Sends pending updates to the database, within the current transaction
+        """
+        if self.dirty:
+            self.connection.executemany(UPSERT_SCORE, ((company,) + self.rows[company] for company in self.dirty))
+            self.dirty.clear()
+
+    def rollback(self):
+        """
+        Drops every update made during this batch
+        """
+        self.connection.rollback()
+        self.rows.clear()
+        self.dirty.clear()
+
+    def commit(self):
+        self.flush()
+        self.connection.commit()
+        self.rows.clear()
+
+
+def read_aliases(connection, aliases):
+    """
+    Reads every alias into the given (alias => company) mapping,
+    extraction matches against all of them so they are kept in memory
+    """
+    for alias, company in connection.execute('SELECT alias, company FROM aliases'):
+        aliases[alias] = company
+    return aliases
+
+
+def write_batch(connection, viability_scores, aliases, touched=None):
+    """
+    Writes the companies touched by this batch, or every
+    company and alias without them, as one transaction
+    """
+    if isinstance(viability_scores, Scores):
+        viability_scores.commit()
+        if touched is not None:
+            return
+    else:
+        companies = viability_scores.keys() if touched is None else touched
+        connection.executemany(UPSERT_SCORE, ((company,) + tuple(viability_scores[company])
+                                              for company in companies))
+
+    if touched is None:
+        connection.executemany(UPSERT_ALIAS, aliases.items())
+    connection.commit()
+
+
+def write_trades(connection, trades):
+    """
+    Adds (put/call/no, company, soft/hard/trade, timestamp) trades to the trade
+    ledger, they are committed along with the rest of the batch
+    """
+    connection.executemany('INSERT INTO trades (kind, company, strength, timestamp) VALUES (?, ?, ?, ?)', trades)
+
+
+def read_trade_bands(connection):
+    """
+    Company => (put/call/no, soft/hard/trade) of the latest trade of each company
+    """
+    rows = connection.execute('SELECT company, kind, strength FROM trades '
+                              'WHERE id IN (SELECT MAX(id) FROM trades GROUP BY company)')
+    return {company: (kind, strength) for company, kind, strength in rows}
+
+
+def is_migrated(connection, name):
+    return connection.execute('SELECT 1 FROM migrations WHERE name = ?', (name,)).fetchone() is not None
+
+
+def import_history(connection, viability_scores, aliases):
+    """
+    One-off migration of history read from the flat history files
+    """
+    connection.executemany(UPSERT_SCORE, ((company,) + tuple(score) for company, score in viability_scores.items()))
+    connection.executemany(UPSERT_ALIAS, aliases.items())
+    connection.execute('INSERT INTO migrations (name) VALUES (?)', ('history',))
+    connection.commit()
+    logging.info("Imported " + str(len(viability_scores)) + " scores and " + str(len(aliases))
+                 + " aliases from history")
@@ -0,0 +1,200 @@
+import collections
+import math
+import zlib
+
+import numpy
+
+# Grabs non-application specific helper modules
+import helper
+import scores
+
+"""
+Bounded deduplication of tweets ahead of scoring: exact copies
+are found by their normalised text (so retweets, mentions and
+links aside), near copies by MinHash signatures banded into LSH
+buckets, against the tweets of a sliding window of time. Either
+must mention the same companies as their original
+"""
+
+# Tweets are matched against those of the last WINDOW_SECONDS, at most MAX_TWEETS of them
+WINDOW_SECONDS = 60 * 60
+MAX_TWEETS = 100000
+
+# Words per shingle
+SHINGLE_SIZE = 2
+
+# Signatures are BANDS bands of ROWS MinHashes, tweets with any band in common are candidate near copies
+BANDS = 8
+ROWS = 4
+
+# Least estimated Jaccard similarity between the shingles of near copies
+SIMILARITY = 0.8
+
+# MinHashes are multiply-shift hashes (a * x + b) >> 32 of each shingle's CRC32, wrapping around
+# 64 bits, and the rows of each band are hashed together into a single bucket key
+HASH_A, HASH_B, BAND_HASH = (numpy.random.default_rng(seed).integers(1, 1 << 63, size, dtype=numpy.uint64) | 1
+                             for seed, size in ((0, BANDS * ROWS), (1, BANDS * ROWS), (2, ROWS)))
+SHIFT = numpy.uint64(32)
+
+
+def shingles(tokens):
+    """
+    CRC32s of each run of SHINGLE_SIZE words, a tweet shorter than
+    that is a single shingle
+    """
+    runs = [' '.join(tokens[index:index + SHINGLE_SIZE])
+            for index in range(max(len(tokens) - SHINGLE_SIZE + 1, 1))]
+    return {zlib.crc32(run.encode('utf-8')) for run in runs if run}
+
+
+def signatures(shingle_sets):
+    """
+    MinHash signatures of (non-empty) sets of shingles, one row each, in
+    one pass over every shingle, and the bucket key of each of their bands
+    """
+    counts = [len(shingle_set) for shingle_set in shingle_sets]
+    values = numpy.fromiter((shingle for shingle_set in shingle_sets for shingle in shingle_set),
+                            dtype=numpy.int64, count=sum(counts)).view(numpy.uint64)
+    hashes = values[:, None] * HASH_A
+    hashes += HASH_B
+    hashes >>= SHIFT
+    minimums = numpy.minimum.reduceat(hashes, numpy.cumsum([0] + counts[:-1]), axis=0)
+    bands = (minimums.reshape(len(counts), BANDS, ROWS) * BAND_HASH).sum(axis=2)
+    return minimums, bands.tolist()
+
+
+class Original:
+    """
+    A tweet scored in full, which later copies of it weigh in with
+    """
+    __slots__ = ('key', 'companies', 'signature', 'bands', 'timestamp', 'engagement', 'polarities')
+
+    def __init__(self, key, companies, signature, bands, timestamp, engagement):
+        self.key = key
+        self.companies = companies
+        self.signature = signature
+        self.bands = bands
+        self.timestamp = timestamp
+        self.engagement = engagement
+        self.polarities = {}    # company => polarity, once scored
+
+    def add_engagement(self, engagement):
+        """
+        Adds a copy's retweets+fav to the tweet's own, and returns
+        the rise in its weight, which is ln(retweets+fav)
+        """
+        previous = self.engagement
+        self.engagement += engagement
+        return math.log(max(self.engagement, 1)) - math.log(max(previous, 1))
+
+
+class DedupIndex:
+    """
+    Original tweets of the sliding window, by normalised text, and by
+    each band of their MinHash signature. Tweets are let go of once out
+    of the window (or once there are too many), oldest first.
+    """
+
+    def __init__(self, window=WINDOW_SECONDS, max_tweets=MAX_TWEETS, similarity=SIMILARITY):
+        self.window = int(window * 1000000)
+        self.max_tweets = max_tweets
+        self.similarity = similarity
+        self.exact = {}                                     # normalised text => original
+        self.buckets = [{} for _ in range(BANDS)]           # band's bucket key => originals
+        self.recent = collections.deque()
+        self.latest = 0
+        self.copies = 0
+
+    def __len__(self):
+        return len(self.recent)
+
+    def find(self, key, companies, signature, bands):
+        original = self.exact.get(key)
+        if original is not None or signature is None:
+            return original
+
+        # Candidates share a band, and are near copies if they mention the
+        # same companies and enough of their MinHashes agree
+        for band, bucket in zip(bands, self.buckets):
+            for candidate in bucket.get(band, ()):
+                if (candidate.companies == companies
+                        and numpy.count_nonzero(candidate.signature == signature) >= self.similarity * len(signature)):
+                    return candidate
+        return None
+
+    def add(self, original):
+        self.exact[original.key] = original
+        if original.signature is not None:
+            for band, bucket in zip(original.bands, self.buckets):
+                bucket.setdefault(band, []).append(original)
+        self.recent.append(original)
+
+    def evict(self):
+        while self.recent and (len(self.recent) > self.max_tweets
+                               or self.recent[0].timestamp < self.latest - self.window):
+            original = self.recent.popleft()
+            if self.exact.get(original.key) is original:
+                del self.exact[original.key]
+            if original.signature is not None:
+                for band, bucket in zip(original.bands, self.buckets):
+                    bucket[band].remove(original)
+                    if not bucket[band]:
+                        del bucket[band]
+
+    def add_batch(self, tweets, normalised_tweets, tweet_companies):
+        """
+        Matches each tweet of a batch against the window, and against
+        the tweets before it in the batch. Returns the original of each
+        tweet, and whether the tweet is a copy of it (otherwise it is
+        new, and is its own original, which later tweets match against)
+
+        Tweets come normalised (see helper.normalise_tweets), along with
+        the companies each mentions, as they are for scoring, a near copy
+        naming other companies is a new tweet
+        """
+        # Retweets are keyed by the tweet they retweet
+        tweet_tokens = [helper.retweeted_tokens(tokens) for tokens, _ in normalised_tweets]
+        keys = [' '.join(tokens) for tokens in tweet_tokens]
+        shingle_sets = [shingles(tokens) for tokens in tweet_tokens]
+        hashed = [index for index, shingle_set in enumerate(shingle_sets) if shingle_set]
+        tweet_signatures = [(None, None)] * len(tweets)
+        if hashed:
+            for index, signature, bands in zip(hashed, *signatures([shingle_sets[index] for index in hashed])):
+                tweet_signatures[index] = signature, bands
+
+        originals = []
+        is_copy = []
+        for tweet, key, companies, (signature, bands) in zip(tweets, keys, tweet_companies, tweet_signatures):
+            timestamp = scores.to_epoch(tweet[2])
+            self.latest = max(self.latest, timestamp)
+            original = self.find(key, companies, signature, bands) if key else None
+            is_copy.append(original is not None)
+            if original is None:
+                original = Original(key, companies, signature, bands, timestamp, int(tweet[1]))
+                if key:
+                    self.add(original)
+            else:
+                self.copies += 1
+            originals.append(original)
+        self.evict()
+        return originals, is_copy
+
+    def fold(self, tweets, originals, is_copy, scored_companies):
+        """
+        Given the scores of the new tweets of a batch (see add_batch),
+        in order, records their polarities, and gives back the scores
+        of the whole batch: each copy weighs in with the rise in its
+        original's weight, at the original's polarity
+        """
+        scored_companies = iter(scored_companies)
+        batch_companies = []
+        for tweet, original, copy in zip(tweets, originals, is_copy):
+            if copy:
+                weight = original.add_engagement(int(tweet[1]))
+                new_companies = {company: (polarity, weight, tweet[2])
+                                 for company, polarity in original.polarities.items()}
+            else:
+                new_companies = next(scored_companies)
+                original.polarities = {company: information[0] for company, information in new_companies.items()}
+            batch_companies.append(new_companies)
+        return batch_companies
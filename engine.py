@@ -0,0 +1,202 @@
+import logging
+import multiprocessing
+import queue
+
+# Grabs non-application specific helper modules
+import batchfile
+import database
+import helper
+import process
+import profiling
+import shards
+
+"""
+Resident processing engine that keeps the SA
+state in memory, and processes tweets as they
+stream in, instead of spawning a fresh
+`python process.py` per batch
+"""
+
+# Tweets that may be waiting on the engine before submitting blocks
+MAX_PENDING_TWEETS = 1000
+
+# Most tweets scored together as one micro-batch
+MAX_BATCH_SIZE = 100
+
+# Queue marker asking the engine to acknowledge everything before it
+FLUSH = 'flush'
+
+
+def stream_batches(tweet_queue, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Groups the tweets on the queue into micro-batches as they arrive:
+    waits for the next tweet, then takes whatever else is already
+    waiting, up to max_batch_size. Tweets are queued one by one, or
+    packed into batches (see batchfile.py). Yields (tweets, is flush)
+    pairs, and stops at a None on the queue.
+    """
+    while True:
+        tweets = []
+        item = tweet_queue.get()
+        while True:
+            if item is None:
+                if tweets:
+                    yield tweets, False
+                return
+
+            if item == FLUSH:
+                yield tweets, True
+                break
+
+            if isinstance(item, bytes):
+                tweets.extend(batchfile.unpack(item))
+            else:
+                tweets.append(item)
+            if len(tweets) >= max_batch_size:
+                yield tweets, False
+                break
+
+            try:
+                item = tweet_queue.get_nowait()
+            except queue.Empty:
+                yield tweets, False
+                break
+
+
+def serve(tweet_queue, done_queue, args):
+    """
+    Consumer stage: reads history in once, then extracts,
+    scores and updates the in-memory state for each
+    micro-batch of tweets as they arrive, acknowledging
+    flushes on the done queue. A None stops the worker.
+    """
+    helper.setup_logging(args.verbose, args.quiet, args.log_every)
+    logging.info("Processing engine is now resident")
+    try:
+        if args.profile:
+            profiling.run_profiled(run, tweet_queue, done_queue, args)
+        else:
+            run(tweet_queue, done_queue, args)
+    finally:
+        helper.stop_logging()
+
+
+def run(tweet_queue, done_queue, args):
+    process.setup(args)
+
+    profiling.start_batch()
+    with profiling.stage('history load'):
+        viability_scores, aliases = process.read_history()
+    helper.log_state('history read-in', viability_scores, aliases)
+    profiling.end_batch()
+
+    # Scoring workers are kept warm for the lifetime of the engine
+    pool = process.create_worker_pool(args.workers, aliases) if args.workers > 1 else None
+
+    for tweets, is_flush in stream_batches(tweet_queue):
+        if tweets:
+            logging.info('-------------------- BATCH START --------------------')
+            profiling.start_batch()
+            try:
+                touched = set()
+                viability_scores, aliases = process.parse_tweets(viability_scores, aliases, tweets, pool, touched)
+                with profiling.stage('trade write'):
+                    process.write_trades(viability_scores, touched)
+                with profiling.stage('history write'):
+                    process.write_history(viability_scores, aliases, touched)
+            except Exception:
+                # A bad batch should not take the resident state down with it
+                logging.exception("Processing engine could not process the last batch")
+                if isinstance(viability_scores, database.Scores):
+                    viability_scores.rollback()
+                # Latest trades are read again, in case the batch's were not written
+                process.TRADE_BANDS = None
+                if isinstance(viability_scores, shards.ShardedScores):
+                    viability_scores.reset_trade_bands()
+            profiling.end_batch()
+            logging.info('-------------------- BATCH END --------------------')
+
+        if is_flush:
+            done_queue.put(True)
+
+    logging.info("Processing engine is now shutting down")
+    if pool is not None:
+        pool.shutdown()
+    if process.STATE_SHARDS is not None:
+        process.STATE_SHARDS.close()
+
+
+class ProcessingEngine:
+    """
+    Handle on a long-lived processing worker, tweets are
+    pushed onto a bounded local queue, so that a producer
+    is held back whenever the engine falls behind
+    """
+
+    def __init__(self, args=None, max_pending_tweets=MAX_PENDING_TWEETS):
+        """
+        Takes the same command line arguments as process.py,
+        the defaults if none are given
+        """
+        if args is None:
+            args = helper.parse_args([])
+
+        # Tweets are queued packed into batches of up to MAX_BATCH_SIZE
+        self.tweet_queue = multiprocessing.Queue(max(max_pending_tweets // MAX_BATCH_SIZE, 1))
+        self.done_queue = multiprocessing.Queue()
+        self.pending = 0
+        # Not a daemon, so that it may run its own pool of scoring workers
+        self.worker = multiprocessing.Process(target=serve, args=(self.tweet_queue, self.done_queue, args))
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def submit(self, tweets):
+        """
+        Pushes (tweet text, retweets+fav, timestamp) records onto the
+        queue, packed into batches so that each is handed over as a
+        single block of bytes, blocking while the queue is full
+        """
+        for start in range(0, len(tweets), MAX_BATCH_SIZE):
+            self.tweet_queue.put(batchfile.pack(tweets[start:start + MAX_BATCH_SIZE]))
+
+    def flush(self):
+        """
+        Asks the worker to acknowledge once everything
+        submitted so far has been processed
+        """
+        self.tweet_queue.put(FLUSH)
+        self.pending += 1
+
+    def is_busy(self):
+        """
+        Non-blocking check on whether the worker is still
+        processing anything flushed so far
+        """
+        while self.pending > 0:
+            try:
+                self.done_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+        return self.pending > 0
+
+    def wait(self):
+        """
+        Blocks until everything submitted so far has been processed
+        """
+        self.flush()
+        while self.pending > 0:
+            try:
+                self.done_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError("Processing engine exited with tweets still pending")
+                continue
+            self.pending -= 1
+
+    def stop(self):
+        self.wait()
+        self.tweet_queue.put(None)
+        self.worker.join()
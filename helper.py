@@ -1,37 +1,176 @@
 import logging
+import logging.handlers
+import atexit
 import datetime
+import dedup
+import glob
+import itertools
 import process
+import queue
+import sentiment
+import shards
+import windows
 import argparse
 import os
 import re
-import string
 
 """
 Application helper methods
 """
 
+# Only one in every LOG_SAMPLE_RATE tweets has its details logged
+LOG_SAMPLE_RATE = 100
+LOGGED_TWEETS = itertools.count()
+
+# Background thread writing log records out to the log file, and the process it belongs to
+LOG_WRITER = None
+LOG_WRITER_PID = None
+
 
 def is_empty_file(file_name):
     return os.stat(file_name).st_size == 0
 
 
-def setup_logging(is_verbose):
+def setup_logging(is_verbose, is_quiet=False, sample_rate=LOG_SAMPLE_RATE):
+    """
+    Log records are handed over on a queue, and written to the
+    log file by a background thread, off the scoring thread
+    """
+    global LOG_SAMPLE_RATE
+    LOG_SAMPLE_RATE = max(sample_rate, 1)
+    if resume_logging():
+        return
+
+    global LOG_WRITER, LOG_WRITER_PID
     logging_file = process.LOGGING_DIRECTORY + '/' + datetime.datetime.now().isoformat() + '.log'
     if is_verbose:
-        logging.basicConfig(filename=logging_file, level=logging.DEBUG)
+        level = logging.DEBUG
+    elif is_quiet:
+        level = logging.WARNING
     else:
-        logging.basicConfig(filename=logging_file, level=logging.INFO)
+        level = logging.INFO
+
+    file_handler = logging.FileHandler(logging_file)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.SimpleQueue()
+    LOG_WRITER = logging.handlers.QueueListener(log_queue, file_handler)
+    LOG_WRITER_PID = os.getpid()
+    LOG_WRITER.start()
+    atexit.register(stop_logging)
+
+    # Records are only formatted by the file handler, the queue hands over their message as is
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+
+def resume_logging():
+    """
+    Processes forked after logging was set up only inherit the log
+    queue, not the thread writing it out, so they start their own.
+    Returns whether logging had been set up.
+    """
+    global LOG_WRITER, LOG_WRITER_PID
+    if LOG_WRITER is None:
+        return False
+
+    if LOG_WRITER_PID != os.getpid():
+        LOG_WRITER = logging.handlers.QueueListener(LOG_WRITER.queue, *LOG_WRITER.handlers)
+        LOG_WRITER_PID = os.getpid()
+        LOG_WRITER.start()
+        atexit.register(stop_logging)
+    return True
+
+
+def stop_logging():
+    """
+    Writes out any log records still queued up, worker processes
+    do not run exit handlers so they have to call this themselves
+    """
+    global LOG_WRITER
+    if LOG_WRITER is not None and LOG_WRITER_PID == os.getpid():
+        LOG_WRITER.stop()
+        LOG_WRITER = None
+
+
+def is_sampled():
+    """
+    Whether the next tweet is one of the sample that have their details logged
+    """
+    return next(LOGGED_TWEETS) % LOG_SAMPLE_RATE == 0
 
 
-def parse_args():
+def parse_thresholds(text):
+    """
+    PUT_HARD,PUT_SOFT,CALL_SOFT,CALL_HARD => band edges of trades, in ascending order
+    """
+    try:
+        thresholds = tuple(float(value) for value in text.split(','))
+    except ValueError:
+        thresholds = ()
+    if len(thresholds) != 4 or list(thresholds) != sorted(thresholds):
+        raise argparse.ArgumentTypeError('expected ascending PUT_HARD,PUT_SOFT,CALL_SOFT,CALL_HARD, got ' + text)
+    return thresholds
+
+
+def parse_args(argv=None, is_resident=True):
+    """
+    Command line arguments, of the resident processing engine unless
+    for a single run of process.py over an input file
+    """
     parser = argparse.ArgumentParser(
         description='An application to utilise sentiment analysis to place stock trades'
     )
 
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("-q", "--quiet", help="only log warnings and errors",
+                        action="store_true")
+    parser.add_argument("--log-every", help="log the details of only one in every N tweets",
+                        type=int, default=LOG_SAMPLE_RATE)
+    parser.add_argument("--log-companies", help="log every company weighed for trades, not just a line per batch",
+                        action="store_true")
+    parser.add_argument("-w", "--workers", help="number of processes to score sentiment across",
+                        type=int, default=1)
+    parser.add_argument("--cache-size", help="number of tweet polarities to cache in memory, 0 to disable",
+                        type=int, default=sentiment.CACHE_SIZE)
+    parser.add_argument("--disk-cache", help="also cache tweet polarities on disk, across batches and runs",
+                        action="store_true")
+    parser.add_argument("--half-life", help="half-life of viability scores in seconds, scores never decay by default",
+                        type=float, default=0)
+    parser.add_argument("--momentum", help="trade on the momentum over a rolling window of this horizon instead",
+                        choices=list(windows.HORIZONS))
+    parser.add_argument("--thresholds", help="band edges of trades, as --thresholds=PUT_HARD,PUT_SOFT,CALL_SOFT,"
+                                             "CALL_HARD ({0:g},{1:g},{2:g},{3:g} by default)".format(
+                                                 process.PUT_THRESHOLD_HARD, process.PUT_THRESHOLD_SOFT,
+                                                 process.CALL_THRESHOLD_SOFT, process.CALL_THRESHOLD_HARD),
+                        type=parse_thresholds)
+    parser.add_argument("--database", help="keep scores, aliases and trades in a SQLite database",
+                        action="store_true")
+    parser.add_argument("--dedup", help="weigh copies of recent tweets in with them rather than scoring them again",
+                        action="store_true")
+    parser.add_argument("--dedup-window", help="seconds of tweets to match copies against",
+                        type=float, default=dedup.WINDOW_SECONDS)
+    parser.add_argument("--profile", help="run under cProfile, dumping its stats to the metrics directory",
+                        action="store_true")
+    parser.add_argument("--source", help="where the ingestion engine reads tweets from: "
+                                         "twitter, file:PATH[,PATH...] or replay:HOST:PORT",
+                        default='twitter')
+    parser.add_argument("--rate", help="tweets per second to replay a file source at, 0 for as fast as possible",
+                        type=float, default=0)
+    parser.add_argument("--shards", help="number of sources to split the source into, read side by side and merged",
+                        type=int, default=1)
+    parser.add_argument("--state-shards", help="number of processes to split the viability scores across by ticker, "
+                                               "keep it the same across runs. Only worthwhile for the resident "
+                                               "engine (ingest.py), each shard starts a fresh interpreter",
+                        type=int, default=shards.SHARD_COUNT)
 
-    args, file_name = parser.parse_known_args()
+    args, file_name = parser.parse_known_args(argv)
+    if args.state_shards > 1 and args.database:
+        parser.error("--state-shards keeps each shard's state in history files, it cannot be used with --database")
+    if args.momentum is not None and not is_resident:
+        parser.error("--momentum keeps its rolling windows in memory between batches, "
+                     "it needs the resident engine (ingest.py)")
 
     if len(file_name) > 0:
         return args, file_name[0]
@@ -40,6 +179,10 @@ def parse_args():
 
 
 def log_state(initial_state, viability_scores, aliases):
+    # Walks the whole state, so is skipped outright unless debugging
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+
     logging.debug('Viability scores after ' + initial_state + ':')
     for company, score in viability_scores.items():
         logging.debug('{0:<30} {1}'.format(company, str(score)))
@@ -51,21 +194,52 @@ def log_state(initial_state, viability_scores, aliases):
     logging.debug('\n')
 
 
-def sanitise_tweet(some_string):
+# Links, @mentions, and runs of anything other than letters and digits, newlines
+# are left alone so that a batch of tweets can be normalised in a single pass
+NORMALISE_PATTERN = re.compile(r'(?:https?://|www\.)\S+|@\w*|[^\w\n@]+|_+')
+
+
+def normalise_tweet(some_string):
     """
-    Removes links and special characters
-    from a given string
+    Removes links, @mentions and punctuation from a given string in one pass,
+    returns both its tokens (as matched against aliases) and its cleaned text
+    (as scored for sentiment), which is simply the tokens space separated
     """
-    return ' '.join(re.sub("(@[A-Za-z0-9]+)|([^0-9A-Za-z \t])| (\w +: /  / \S +)", " ", some_string).split())
+    tokens = NORMALISE_PATTERN.sub(' ', some_string).split()
+    return tokens, ' '.join(tokens)
 
 
-def strip_punctuation(some_string):
+def retweeted_tokens(tokens):
     """
-    Removes punctuation from a given string
+    Normalised tokens of a tweet => those of the tweet it retweets ("RT @user: ...",
+    the mention already normalised away), so that every copy of a tweet shares them
     """
-    some_string = some_string.replace("'", " '")
-    translator = str.maketrans('', '', string.punctuation)
-    return some_string.translate(translator)
+    return tokens[1:] if tokens[:1] == ['RT'] else tokens
+
+
+def normalise_tweets(some_strings):
+    """
+    Batch version of normalise_tweet, normalising a whole
+    list of strings with a single pass of the pattern
+    """
+    joined = '\n'.join(some_strings)
+    if joined.count('\n') != max(len(some_strings) - 1, 0):
+        # Strings spanning multiple lines are normalised one at a time
+        return [normalise_tweet(some_string) for some_string in some_strings]
+
+    normalised = []
+    for line in NORMALISE_PATTERN.sub(' ', joined).split('\n') if some_strings else []:
+        tokens = line.split()
+        normalised.append((tokens, ' '.join(tokens)))
+    return normalised
+
+
+def sanitise_tweet(some_string):
+    """
+    Removes links, @mentions and special characters
+    from a given string
+    """
+    return normalise_tweet(some_string)[1]
 
 
 """
@@ -77,14 +251,29 @@ def cleanup():
     if os.path.isfile(process.HISTORY_FILE):
         os.remove(process.HISTORY_FILE)
 
+    if os.path.isfile(process.HISTORY_LOG_FILE):
+        os.remove(process.HISTORY_LOG_FILE)
+
     if os.path.isfile(process.TRADE_FILE):
         os.remove(process.TRADE_FILE)
+    process.TRADE_BANDS = None
+    process.UNWRITTEN_BANDS.clear()
+
+    for history_file in (process.HISTORY_FILE, process.HISTORY_LOG_FILE):
+        for shard_file in glob.glob(shards.shard_file_name(history_file, '*')):
+            os.remove(shard_file)
+
+    for suffix in ('', '-wal', '-shm'):
+        for store_file in (process.SENTIMENT_CACHE_FILE, process.DATABASE_FILE):
+            if os.path.isfile(store_file + suffix):
+                os.remove(store_file + suffix)
 
 
-def run_processing_engine(input_file):
+def run_processing_engine(input_file, *args):
     """
-    Gives back the return code of running the processing engine given a file
+    Gives back the return code of running the processing engine given a file,
+    and any further command line arguments
     """
     from subprocess import Popen, PIPE
-    p = Popen(["python", "process.py", input_file, "-v"], stdout=PIPE)
+    p = Popen(["python", "process.py", input_file, "-v"] + list(args), stdout=PIPE)
     return p.wait()
@@ -1,8 +1,7 @@
+import asyncio
 import logging
-from subprocess import Popen, PIPE
-import signal
-import os
 import sys
+import time
 
 import re
 import tweepy
@@ -16,15 +15,15 @@ from datetime import datetime
 
 # Grabs non-application specific helper modules
 import helper
+import sources
+from engine import ProcessingEngine
 
 """
 Front-end ingestion engine that'll
-batch together input stream while
-the backend processing is working
+stream input to the backend processing
+engine, held back whenever it falls behind
 """
 
-INPUT_FILE = '.input'
-POLLING_TIMEOUT = 10
 USERS = [
     "1364930179",   # Warren Buffett
     "25073877",     # Donald Trump
@@ -46,15 +45,20 @@ KEYWORDS = [
         "NASDAQ",
 ]
 
-NEXT_TWEET_BATCH = []
-
 
 class Tweet:
-    def __init__(self, text, retweets, favorites, time):
+    __slots__ = ('tweet_text', 'retweet_count', 'favorite_count', 'timestamp', 'tweet_id')
+
+    def __init__(self, text, retweets, favorites, time, tweet_id=None):
         self.tweet_text = text
         self.retweet_count = retweets
         self.favorite_count = favorites
         self.timestamp = time
+        self.tweet_id = tweet_id
+
+    def record(self):
+        # (tweet text, retweets+fav, timestamp, tweet id), the id only tells apart tweets delivered twice
+        return self.tweet_text, self.retweet_count + self.favorite_count, str(self.timestamp), self.tweet_id
 
     def __str__(self):
         # tweet text|retweets+fav|timestamp
@@ -64,24 +68,25 @@ class Tweet:
 
 class SListener(StreamListener):
 
-    def on_status(self, status):
-        if (len(NEXT_TWEET_BATCH) < 100):
-            # if status.user.id_str in USERS:
-            # if not status.retweeted and ('RT @' not in status.text):
-            print(status.favorite_count)
-            print(status.retweet_count)
-            print(status.user.screen_name)
-            print(status.text)
-            print(status.created_at)
-            print(len(NEXT_TWEET_BATCH))
-            status.text = status.text.replace('\n', '')
-            status.text = status.text.replace('|', '')
-            new_tweet = Tweet(status.text, status.retweet_count, status.favorite_count, status.created_at)
-            NEXT_TWEET_BATCH.append(new_tweet)
-            return True
-        else:
-            return False
+    def __init__(self, loop, tweet_queue, api=None):
+        super(SListener, self).__init__(api)
+        self.loop = loop
+        self.tweet_queue = tweet_queue
 
+    def on_status(self, status):
+        # if status.user.id_str in USERS:
+        # if not status.retweeted and ('RT @' not in status.text):
+        print(status.favorite_count)
+        print(status.retweet_count)
+        print(status.user.screen_name)
+        print(status.text)
+        print(status.created_at)
+        new_tweet = Tweet(status.text, status.retweet_count, status.favorite_count, status.created_at,
+                          status.id_str)
+
+        # Blocks while the ingestion loop is behind, which in turn holds back the stream
+        asyncio.run_coroutine_threadsafe(self.tweet_queue.put(new_tweet.record()), self.loop).result()
+        return True
 
     def on_error(self, status_code):
         if status_code == 420:
@@ -89,78 +94,133 @@ class SListener(StreamListener):
             return False
 
 
-def generate_input_file():
-    global NEXT_TWEET_BATCH
-    logging.info("Writing tweets to input file")
-    with open(INPUT_FILE, "w") as input_file:
-        for tweet in NEXT_TWEET_BATCH:
-            input_file.write(str(tweet) + "\n")
-    logging.info("Input file successfully generated")
-    NEXT_TWEET_BATCH = []
-
-
-def handler(signum, frame):
-    print("\nChecking if processing engine is done with the last batch")
-    raise ValueError()
+class TwitterSource:
+    """
+    Tweets from twitter's streaming API, of the accounts followed and
+    the keywords tracked, over a single connection that is kept open on
+    a background thread, and only re-opened (backing off) if twitter
+    drops it. Connects with the given account's credentials, by default
+    those in secrets.py
+    """
+
+    def __init__(self, follow=USERS, track=KEYWORDS, account=None, max_pending_tweets=sources.MAX_PENDING_TWEETS):
+        self.follow = follow
+        self.track = track
+        self.account = account if account is not None else vars(secrets)
+        self.max_pending_tweets = max_pending_tweets
+        self.twitter_stream = None
+        self.is_closed = False
+
+    def __aiter__(self):
+        return self.records()
+
+    def connect(self, listener):
+        auth = OAuthHandler(self.account['consumer_key'], self.account['consumer_secret'])
+        auth.set_access_token(self.account['access_token'], self.account['access_token_secret'])
+        self.twitter_stream = tweepy.Stream(auth, listener)
+
+        delay = 1
+        while not self.is_closed:
+            connected = time.monotonic()
+            try:
+                # Blocks for as long as the connection stays open
+                self.twitter_stream.filter(follow=self.follow or None, track=self.track or None)
+            except Exception:
+                logging.exception("Twitter stream was dropped")
+            if self.is_closed:
+                break
+            if time.monotonic() - connected > delay:
+                # The connection held up for longer than it was backed off, so backing off starts over
+                delay = 1
+            logging.warning("Reconnecting to twitter in " + str(delay) + "s")
+            time.sleep(delay)
+            delay = min(2 * delay, 320)
+
+    def disconnect(self):
+        self.is_closed = True
+        if self.twitter_stream is not None:
+            self.twitter_stream.disconnect()
+
+    async def records(self):
+        loop = asyncio.get_running_loop()
+        tweet_queue = asyncio.Queue(self.max_pending_tweets)
+        connection = loop.run_in_executor(None, self.connect, SListener(loop, tweet_queue))
+        connection.add_done_callback(lambda _: asyncio.ensure_future(tweet_queue.put(None)))
+        try:
+            while True:
+                tweet = await tweet_queue.get()
+                if tweet is None:
+                    break
+                yield tweet
+        finally:
+            self.disconnect()
+
+
+def twitter_shards(shards):
+    """
+    One twitter source per shard of the accounts followed and keywords
+    tracked, each connecting with its own account where secrets.py
+    lists several (as accounts), as twitter allows one connection each
+    """
+    accounts = getattr(secrets, 'accounts', None) or [vars(secrets)]
+    shards = max(min(shards, len(USERS) + len(KEYWORDS)), 1)
+    return [TwitterSource(follow, track, accounts[index % len(accounts)])
+            for index, (follow, track) in enumerate(zip(sources.shard(USERS, shards),
+                                                        sources.shard(KEYWORDS, shards)))
+            if follow or track]
+
+
+def open_source(args):
+    """
+    Tweet source given on the command line: twitter, file:PATH[,PATH...]
+    or replay:HOST:PORT[,HOST:PORT...] for local replay servers.
+
+    Twitter is read through a merged source, split into as many shards
+    as asked for, and so are several files or replay servers when
+    sharded, each shard being read side by side
+    """
+    kind, _, location = args.source.partition(':')
+    if kind == 'twitter':
+        return sources.MergedSource(twitter_shards(args.shards))
+    elif kind == 'file':
+        paths = location.split(',')
+        if args.shards > 1 and len(paths) > 1:
+            return sources.MergedSource([sources.FileSource(shard, args.rate)
+                                         for shard in sources.shard(paths, args.shards) if shard])
+        return sources.FileSource(paths, args.rate)
+    elif kind == 'replay':
+        replay_sources = []
+        for address in location.split(','):
+            host, _, port = address.rpartition(':')
+            replay_sources.append(sources.SocketSource(host or sources.DEFAULT_HOST,
+                                                       int(port or sources.DEFAULT_PORT)))
+        if len(replay_sources) > 1:
+            return sources.MergedSource(replay_sources)
+        return replay_sources[0]
+    else:
+        print("Unknown tweet source: " + args.source)
+        sys.exit(1)
 
 
 def main():
     # Initial setup
     args = helper.parse_args()
-    helper.setup_logging(args.verbose)
-    logging.info("Polling is set to: " + str(int(POLLING_TIMEOUT)) + " seconds")
-
-    # Make call to twitter's streaming API to gather tweets
-    while True:
-        print('Gathering tweets from twitter\n')
-        try:
-            try:
-                auth = OAuthHandler(secrets.consumer_key, secrets.consumer_secret)
-                auth.set_access_token(secrets.access_token, secrets.access_token_secret)
-                twitter_stream = tweepy.Stream(auth, SListener())
-                twitter_stream.filter(follow=USERS)
-            except:
-                print("Authentication error")
-                twitter_stream.disconnect()
-
-            # Writes the processing input file
-            generate_input_file()
-
-            # Starts the background process
-            background_process = Popen(["python", "process.py", INPUT_FILE], stdout=PIPE)
-
-            while background_process.poll() is None:
-                print("[SA engine]\t\tStatus: Currently processing a batch.")
-
-                # Signal handling
-                signal.signal(signal.SIGALRM, handler)
-                signal.alarm(POLLING_TIMEOUT)
-
-                try:
-                    auth = OAuthHandler(secrets.consumer_key, secrets.consumer_secret)
-                    auth.set_access_token(secrets.access_token, secrets.access_token_secret)
-                    twitter_stream = tweepy.Stream(auth, SListener())
-                    twitter_stream.filter(follow=USERS)
-                except ValueError:
-                    print("Checking if backend if free for the next batch")
-                except KeyboardInterrupt:
-                    print("\nCleaning up and exiting the ingestion engine")
-                    if os.path.isfile(INPUT_FILE):
-                        os.remove(INPUT_FILE)
-                    sys.exit(0)
-                except:
-                    print("Authentication error")
-                    twitter_stream.disconnect()
-
-
-            # At this point, the last batch is complete
-            print("The last batch is now complete, processing next batch.")
-            print("--------------------")
-        except KeyboardInterrupt:
-            print("\nCleaning up and exiting the ingestion engine")
-            if os.path.isfile(INPUT_FILE):
-                os.remove(INPUT_FILE)
-            sys.exit(0)
+    helper.setup_logging(args.verbose, args.quiet, args.log_every)
+    source = open_source(args)
+
+    # Starts the resident processing engine, which keeps its state between batches
+    engine = ProcessingEngine(args).start()
+    logging.info("Processing engine has been started")
+
+    # Streams tweets from the source (by default twitter's streaming
+    # API) straight to the engine, until the source ends
+    print('Gathering tweets from ' + args.source + '\n')
+    try:
+        asyncio.run(sources.stream_to_engine(source, engine))
+    except KeyboardInterrupt:
+        print("\nCleaning up and exiting the ingestion engine")
+    engine.stop()
+    sys.exit(0)
 
 
 if __name__ == '__main__':
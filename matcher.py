@@ -0,0 +1,167 @@
+from collections import deque
+from collections.abc import MutableMapping
+
+# Grabs non-application specific helper modules
+import helper
+
+"""
+Alias matcher that finds every company mention
+in a tweet in a single pass, using an Aho-Corasick
+automaton over words rather than characters
+"""
+
+
+def tokenise(some_string):
+    """
+    Splits a string into the words the automaton runs over,
+    cashtags such as $TSLA come out as their bare ticker
+    """
+    return helper.normalise_tweet(some_string)[0]
+
+
+class AliasMatcher(MutableMapping):
+    """
+    A mapping of alias => company that doubles as a precompiled
+    Aho-Corasick automaton over those aliases.
+
+    Aliases are matched case-folded on word boundaries, and may
+    span multiple words ("General Motors"). Aliases written
+    entirely in capitals (tickers such as "GM") only ever match
+    that exact capitalisation, so that short tickers do not fire
+    on common words.
+
+    Adding or removing aliases updates the trie in place, failure
+    links are refreshed lazily before the next search.
+    """
+
+    def __init__(self, aliases=None):
+        self._aliases = {}
+        self._patterns = {}     # alias => (tokens, is case sensitive)
+
+        # Automaton, one entry per node, node 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]  # aliases ending at this node
+        self._next_output = [0]  # nearest node down the failure chain with an output
+        self._is_stale = False
+
+        if aliases is not None:
+            self.update(aliases)
+
+    def __getitem__(self, alias):
+        return self._aliases[alias]
+
+    def __setitem__(self, alias, company):
+        if alias not in self._aliases:
+            self._insert(alias)
+        self._aliases[alias] = company
+
+    def __delitem__(self, alias):
+        del self._aliases[alias]
+        tokens, _ = self._patterns.pop(alias)
+        if tokens:
+            self._output[self._walk(tokens)].discard(alias)
+
+    def __iter__(self):
+        return iter(self._aliases)
+
+    def __len__(self):
+        return len(self._aliases)
+
+    def __repr__(self):
+        return 'AliasMatcher(' + repr(self._aliases) + ')'
+
+    def _walk(self, tokens):
+        node = 0
+        for token in tokens:
+            node = self._goto[node][token.casefold()]
+        return node
+
+    def _insert(self, alias):
+        tokens = tuple(tokenise(alias))
+        is_case_sensitive = alias.isupper()
+        self._patterns[alias] = (tokens, is_case_sensitive)
+        if not tokens:
+            return
+
+        node = 0
+        for token in tokens:
+            symbol = token.casefold()
+            child = self._goto[node].get(symbol)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][symbol] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+                self._next_output.append(0)
+                self._is_stale = True
+            node = child
+
+        if not self._output[node]:
+            self._is_stale = True
+        self._output[node].add(alias)
+
+    def _link(self):
+        """
+        Recomputes the failure and output links breadth first
+        """
+        self._fail[0] = 0
+        self._next_output[0] = 0
+        pending = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            self._next_output[child] = 0
+            pending.append(child)
+
+        while pending:
+            node = pending.popleft()
+            for symbol, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and symbol not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(symbol, 0)
+                if self._fail[child] == child:
+                    self._fail[child] = 0
+
+                suffix = self._fail[child]
+                self._next_output[child] = suffix if self._output[suffix] else self._next_output[suffix]
+                pending.append(child)
+
+        self._is_stale = False
+
+    def find(self, tweet_message):
+        """
+        Returns the company for every alias mentioned in the
+        tweet, in order of where each mention ends
+        """
+        return self.find_tokens(tokenise(tweet_message))
+
+    def find_tokens(self, tokens):
+        """
+        Same as find, over a tweet that has already been tokenised
+        """
+        if self._is_stale:
+            self._link()
+
+        goto, fail, output, next_output = self._goto, self._fail, self._output, self._next_output
+        companies = []
+
+        node = 0
+        for position, token in enumerate(tokens):
+            symbol = token.casefold()
+            while node and symbol not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(symbol, 0)
+
+            match = node if output[node] else next_output[node]
+            while match:
+                for alias in output[match]:
+                    alias_tokens, is_case_sensitive = self._patterns[alias]
+                    start = position + 1 - len(alias_tokens)
+                    if is_case_sensitive and tuple(tokens[start:position + 1]) != alias_tokens:
+                        continue
+                    companies.append(self._aliases[alias])
+                match = next_output[match]
+
+        return companies
@@ -1,11 +1,24 @@
 # Application imports
 import logging
 import csv
-from textblob import TextBlob
 import math
+import os
+import time
+from itertools import chain
+
+import numpy
 
 # Grabs non-application specific helper modules
+import batchfile
+import database
+import dedup
 import helper
+import matcher
+import profiling
+import scores
+import sentiment
+import shards
+import windows
 
 """
 Back-end processing engine that'll
@@ -16,26 +29,145 @@ process a given batch of tweets
 LOGGING_DIRECTORY = 'logs'
 TESTING_DIRECTORY = 'tests'
 HISTORY_FILE = '.app.history'
+HISTORY_LOG_FILE = '.app.history.log'
 TRADE_FILE = '.app.trades'
+SENTIMENT_CACHE_FILE = '.app.sentiment'
+DATABASE_FILE = '.app.db'
+
+# Polarity cache of this process, if any
+SENTIMENT_CACHE = None
+
+# State store connection, if state is kept in the database instead of history files
+DATABASE = None
+
+# Aliases of a scoring worker process, set up once per worker
+WORKER_ALIASES = None
+WORKER_CHUNK_SIZE = 250
+
+# The history log is compacted into the history snapshot once it
+# outgrows both the snapshot and this many bytes
+HISTORY_COMPACTION_BYTES = 64 * 1024
+
+# Half-life of viability scores in seconds, scores never decay without one
+HALF_LIFE = None
+
+# Rolling windows of each company's sentiment, if trading on momentum
+WINDOWS = None
+
+# Recent tweets, if copies of a tweet weigh in with it rather than being scored again
+DEDUP = None
+
+# Horizon of the rolling window trades are placed on instead of the cumulative score
+MOMENTUM_HORIZON = None
+
+# Worker processes each holding a shard of the viability scores, if state is sharded
+STATE_SHARDS = None
 
-# Global constants
+# Company => lots of its latest trade (see BAND_TRADES), read in with the history, or
+# from the trades the first time it is needed if the history does not hold them
+TRADE_BANDS = None
+
+# Companies whose band has changed since they were last written to history
+UNWRITTEN_BANDS = set()
+
+# Whether every company weighed for trades is logged, rather than a line per batch
+LOG_COMPANIES = False
+
+# Global constants, band edges of trades (see band_lots), shared with the backtest
 CALL_THRESHOLD_SOFT = 50
 CALL_THRESHOLD_HARD = 150
 
 PUT_THRESHOLD_SOFT = -50
 PUT_THRESHOLD_HARD = -150
 
+# Lots of a band => (put/call, soft/hard) trade, a 'no trade' takes the company's position flat
+BAND_TRADES = {
+    -2: ('put', 'hard'),
+    -1: ('put', 'soft'),
+    0: ('no', 'trade'),
+    1: ('call', 'soft'),
+    2: ('call', 'hard'),
+}
+
+
+def parse_history_line(line):
+    """
+    The first word in the history is an indicator:
+        'score' => The line contains a company name, its current viability score,
+            the current weight, and its timestamp as a tuple
+        'alias' => The line contains a company's name and their stock ticker tuple
+        'band' => The line contains a company name and the lots of its latest trade
+    Raises an IndexError/ValueError on an invalid line
+    """
+    indicator = line[0]
+    if indicator == 'score':
+        return indicator, line[1], (float(line[2]), float(line[3]), line[4])
+    elif indicator == 'alias':
+        return indicator, line[1], line[2]
+    elif indicator == 'band' and int(line[2]) in BAND_TRADES:
+        return indicator, line[1], int(line[2])
+    else:
+        raise ValueError()
+
+
+def apply_history_record(record, viability_scores, aliases, trade_bands):
+    indicator, key, value = record
+    if indicator == 'score':
+        viability_scores[key] = value
+    elif indicator == 'alias':
+        aliases[key] = value
+    else:
+        trade_bands[key] = value
+
+
+def format_score(company, score):
+    return 'score, ' + company + ', ' + str(score[0]) + ', ' + str(score[1]) + ', ' + str(score[2]) + '\n'
+
+
+def format_band(company, lots):
+    return 'band, ' + company + ', ' + str(lots) + '\n'
+
 
 def read_history():
     """
     Reads prior history in if available,
     returns either current state from history
     or clean initial state if there are errors/no history
+
+    With the database, scores are looked up as needed
+    rather than read in, only aliases are read in, likewise
+    with sharded state (see shards.ShardedScores)
+    """
+    if DATABASE is not None:
+        return database.Scores(DATABASE), database.read_aliases(DATABASE, matcher.AliasMatcher())
+
+    if STATE_SHARDS is not None:
+        # Scores are read in by the shards themselves
+        _, aliases = read_history_files()
+        return STATE_SHARDS, aliases
+
+    # Latest trades are read in along with the scores, unless the history predates them
+    global TRADE_BANDS
+    trade_bands = {}
+    viability_scores, aliases = read_history_files(trade_bands)
+    TRADE_BANDS = trade_bands or None
+    return viability_scores, aliases
+
+
+def read_history_files(trade_bands=None):
+    """
+    History is a snapshot, plus a log of the batches
+    written since the snapshot, which is replayed on top
+
+    The lots of each company's latest trade are read into
+    trade_bands, if given
     """
 
     # Empty initial values in case of no history
-    viability_scores = {}
-    aliases = {}
+    viability_scores = scores.ScoreTable()
+    aliases = matcher.AliasMatcher()
+    if trade_bands is None:
+        trade_bands = {}
 
     try:
         # Sanity check: empty file
@@ -43,48 +175,83 @@ def read_history():
             raise ValueError()
 
         with open(HISTORY_FILE, "r") as history:
-            """
-            The first word in the history is an indicator:
-                'score' => The line contains a company name, its current viability score,
-                    the current weight, and its timestamp as a tuple
-                'alias' => The line contains a company's name and their stock ticker tuple
-            """
             history_reader = csv.reader(history, skipinitialspace=True)
             for line in history_reader:
-                indicator = line[0]
-                if indicator == 'score':
-                    viability_scores[line[1]] = (float(line[2]), int(line[3]), line[4])
-                elif indicator == 'alias':
-                    aliases[line[1]] = line[2]
-                else:
-                    raise ValueError()
+                apply_history_record(parse_history_line(line), viability_scores, aliases, trade_bands)
         logging.info("History has now been read successfully")
-    except (IndexError, IOError, ValueError):
-        # In case history file was invalid part way through, we reset it all
+    except IOError:
         logging.info("History file not found, defaulting to clean state")
-        viability_scores = {}
-        aliases = {}
+    except (IndexError, ValueError):
+        # Snapshots are only ever swapped in whole, so this is not a torn
+        # write but an invalid history file, in which case we reset it all
+        logging.warning("History file is invalid, defaulting to clean state")
+        viability_scores = scores.ScoreTable()
+        aliases = matcher.AliasMatcher()
+        trade_bands.clear()
+
+    replay_history_log(viability_scores, aliases, trade_bands)
 
     return viability_scores, aliases
 
 
-def extract_companies(tweet_message, aliases):
-    extracted_companies = []
-    # Tokenises the tweet into words
-    tweet_message = helper.strip_punctuation(tweet_message)
-    tokens = tweet_message.split()
+def replay_history_log(viability_scores, aliases, trade_bands):
+    """
+    Replays each batch committed to the history log on top of
+    the current state. A batch torn part way through by a crash
+    is discarded, and cut off the log so that appends stay clean.
+    """
+    if not os.path.isfile(HISTORY_LOG_FILE):
+        return
+
+    batches = 0
+    committed_bytes = 0
+    offset = 0
+    block = []
+    with open(HISTORY_LOG_FILE, "rb") as history_log:
+        for raw_line in history_log:
+            offset += len(raw_line)
+            try:
+                if not raw_line.endswith(b'\n'):
+                    raise ValueError()
+                line = next(csv.reader([raw_line.decode('utf-8')], skipinitialspace=True))
+                if line[0] == 'commit':
+                    if int(line[1]) != len(block):
+                        raise ValueError()
+                    for record in block:
+                        apply_history_record(record, viability_scores, aliases, trade_bands)
+                    block = []
+                    committed_bytes = offset
+                    batches += 1
+                else:
+                    block.append(parse_history_line(line))
+            except (IndexError, ValueError, UnicodeDecodeError):
+                break
+
+    if committed_bytes < os.path.getsize(HISTORY_LOG_FILE):
+        logging.warning("History log has an uncommitted batch at byte " + str(committed_bytes)
+                        + ", discarding it")
+        with open(HISTORY_LOG_FILE, "r+b") as history_log:
+            history_log.truncate(committed_bytes)
+
+    logging.info("History log replayed " + str(batches) + " batches")
+
 
-    for token in tokens:
-        if token in aliases:
-            extracted_companies.append(aliases[token])
+def extract_companies(tweet_message, aliases):
+    """
+    Returns the company for every alias mentioned in the tweet,
+    aliases may span multiple words and are matched case-folded
+    """
+    # Plain dictionaries are compiled on the fly, history read-in
+    # already hands back a precompiled matcher
+    if not isinstance(aliases, matcher.AliasMatcher):
+        aliases = matcher.AliasMatcher(aliases)
 
-    return extracted_companies
+    return aliases.find(tweet_message)
 
 
 def get_tweet_sentiment(tweet):
     sanitised_tweet = helper.sanitise_tweet(tweet)
-    analysis = TextBlob(sanitised_tweet)
-    return analysis.sentiment.polarity
+    return float(sentiment.score_batch([sanitised_tweet])[0])
 
 
 def get_sentiment_analysis(tweet, aliases):
@@ -101,48 +268,152 @@ def get_sentiment_analysis(tweet, aliases):
     White paper basis for this analysis is located at:
     http://cs229.stanford.edu/proj2011/ChenLazer-SentimentAnalysisOfTwitterFeedsForThePredictionOfStockMarketMovement.pdf
     """
-    new_companies = {}
-    message = tweet[0]
-    weight = math.log(int(tweet[1]))  # The weight of a given tweet is simply ln(# of retweets)
-    timestamp = tweet[2]
-
-    # Extracts any company names
-    extracted_companies = set(extract_companies(message, aliases))
-
-    # Debugging information
-    logging.debug('Extracted companies from tweet message: ' + message)
-    for extracted_company in extracted_companies:
-        logging.debug('\t\t' + extracted_company)
+    return get_batch_sentiment_analysis([tweet], aliases)[0]
 
-    # Sanity check in case no company's name could be found in the tweet
-    if len(extracted_companies) == 0:
-        return new_companies
 
-    # Gets the sentiment of the tweet
-    sentiment_polarity = get_tweet_sentiment(message)
-
-    # Assumes that all companies mentioned reflect the
-    # sentiment of the whole tweet (non-real assumption,
-    # but fine for project)
-    for company in extracted_companies:
-        new_companies[company] = (sentiment_polarity, weight, timestamp)
-
-    return new_companies
+def get_batch_sentiment_analysis(tweets, aliases, normalised_tweets=None, tweet_companies=None):
+    """
+    Batch version of get_sentiment_analysis, returns
+    the sentiment scores for each company mentioned,
+    per tweet in the given list of tweets.
 
+    Only tweets that mention a company are scored,
+    and they are all scored together in one batch.
 
-def add_new_state(viability_scores, new_companies):
+    Tweets already normalised (see helper.normalise_tweets), and
+    the companies each mentions, are taken as given if passed in
+    """
+    batch_companies = [{} for _ in tweets]
+    scored_tweets = []
+    sanitised_tweets = []
+    latencies = []
+    extraction_time = 0.0
+
+    # Plain dictionaries are compiled on the fly, see extract_companies
+    if not isinstance(aliases, matcher.AliasMatcher):
+        aliases = matcher.AliasMatcher(aliases)
+
+    is_debugged = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    # Tokenises and sanitises every tweet in one go
+    start = time.perf_counter()
+    if normalised_tweets is None:
+        normalised_tweets = helper.normalise_tweets([tweet[0] for tweet in tweets])
+    sanitise_time = time.perf_counter() - start
+
+    for index, (tweet, (tokens, sanitised_tweet)) in enumerate(zip(tweets, normalised_tweets)):
+        # Extracts any company names
+        start = time.perf_counter()
+        if tweet_companies is None:
+            extracted_companies = set(aliases.find_tokens(tokens))
+        else:
+            extracted_companies = tweet_companies[index]
+        extracted = time.perf_counter()
+        extraction_time += extracted - start
+
+        # Debugging information, for a sample of tweets
+        if is_debugged and helper.is_sampled():
+            logging.debug('Extracted companies from tweet message: %s\n\t\t%s',
+                          tweet[0], '\n\t\t'.join(extracted_companies))
+
+        # Sanity check in case no company's name could be found in the tweet
+        latencies.append(extracted - start)
+        if len(extracted_companies) == 0:
+            continue
+
+        scored_tweets.append((index, extracted_companies))
+        sanitised_tweets.append(sanitised_tweet)
+
+    # Gets the sentiment of every tweet that mentions a company
+    start = time.perf_counter()
+    sentiment_polarities = sentiment.score_batch(sanitised_tweets, SENTIMENT_CACHE)
+    sentiment_time = time.perf_counter() - start
+
+    metrics = profiling.METRICS
+    if metrics is not None:
+        metrics.stages['extraction'] += extraction_time
+        metrics.stages['sanitise'] += sanitise_time
+        metrics.stages['sentiment'] += sentiment_time
+        # Each tweet's share of normalising the batch, and each scored tweet's share of scoring it
+        normalise_share = sanitise_time / max(len(tweets), 1)
+        latencies = [latency + normalise_share for latency in latencies]
+        sentiment_share = sentiment_time / max(len(sanitised_tweets), 1)
+        for index, _ in scored_tweets:
+            latencies[index] += sentiment_share
+        metrics.add_tweets(latencies, sum(len(companies) for _, companies in scored_tweets))
+
+    for (index, extracted_companies), sentiment_polarity in zip(scored_tweets, sentiment_polarities):
+        weight = math.log(int(tweets[index][1]))  # The weight of a given tweet is simply ln(# of retweets)
+        timestamp = tweets[index][2]
+
+        # Assumes that all companies mentioned reflect the
+        # sentiment of the whole tweet (non-real assumption,
+        # but fine for project)
+        for company in extracted_companies:
+            batch_companies[index][company] = (float(sentiment_polarity), weight, timestamp)
+
+    return batch_companies
+
+
+def add_new_state(viability_scores, new_companies, touched=None):
     """
     Adds a list of new companies to the current list
         new_companies[company name][0] = score
         new_companies[company name][1] = weight
         new_companies[company name][2] = timestamp
+    and records the updated companies in touched, if given
+    """
+    return add_batch_state(viability_scores, [new_companies], touched)
+
+
+def add_batch_state(viability_scores, batch_companies, touched=None):
+    """
+    Adds a batch of new companies, one dictionary per tweet
+    (see add_new_state), to the current list in tweet order
+    """
+    if touched is not None:
+        for new_companies in batch_companies:
+            touched.update(new_companies)
+
+    if isinstance(viability_scores, shards.ShardedScores):
+        # Rolling windows and decay are kept by each shard
+        viability_scores.add_batch(batch_companies)
+        return viability_scores
+
+    if WINDOWS is not None:
+        WINDOWS.add_batch(batch_companies)
+
+    if isinstance(viability_scores, scores.ScoreTable):
+        viability_scores.add_batch(batch_companies, HALF_LIFE)
+        return viability_scores
+
+    for new_companies in batch_companies:
+        viability_scores = add_company_state(viability_scores, new_companies)
+    return viability_scores
+
+
+def add_company_state(viability_scores, new_companies):
+    """
+    Adds a single tweet's companies to a plain mapping of scores
     """
     for new_company, company_information in new_companies.items():
         new_score = company_information[0]
         new_weight = company_information[1]
         new_timestamp = company_information[2]
 
-        if new_company in viability_scores:
+        if new_company in viability_scores and HALF_LIFE:
+            # Decays whichever of the base score and the new information is older
+            base_score, base_weight, base_timestamp = viability_scores[new_company]
+            elapsed = scores.to_epoch(new_timestamp) - scores.to_epoch(base_timestamp)
+            if elapsed >= 0:
+                decay = float(scores.decay_factor(elapsed, HALF_LIFE))
+                viability_scores[new_company] = (base_score * decay + new_score * new_weight,
+                                                 base_weight * decay + new_weight, new_timestamp)
+            else:
+                decay = float(scores.decay_factor(-elapsed, HALF_LIFE))
+                viability_scores[new_company] = (base_score + new_score * new_weight * decay,
+                                                 base_weight + new_weight * decay, base_timestamp)
+        elif new_company in viability_scores:
             # There already exists a base score, updates it with the new information
             total_score = viability_scores[new_company][0] + (new_score * new_weight)
             total_weight = viability_scores[new_company][1] + new_weight
@@ -153,29 +424,212 @@ def add_new_state(viability_scores, new_companies):
     return viability_scores
 
 
-def parse_input(viability_scores, aliases, input_file_name):
+def setup(args):
+    """
+    Sets up the polarity cache, state store, score decay, rolling
+    windows, deduplication and state shards from the command line arguments
+    """
+    global HALF_LIFE, WINDOWS, MOMENTUM_HORIZON, DEDUP, LOG_COMPANIES, STATE_SHARDS
+    HALF_LIFE = args.half_life or None
+    MOMENTUM_HORIZON = args.momentum
+    WINDOWS = windows.RollingWindows() if MOMENTUM_HORIZON is not None else None
+    DEDUP = dedup.DedupIndex(args.dedup_window) if args.dedup else None
+    LOG_COMPANIES = args.log_companies
+    if args.thresholds is not None:
+        set_thresholds(args.thresholds)
+    setup_cache(args.cache_size, args.disk_cache)
+    setup_database(args.database)
+    STATE_SHARDS = shards.ShardedScores(args.state_shards, args) if args.state_shards > 1 else None
+
+
+def set_thresholds(thresholds):
+    """
+    Sets the band edges of trades, given as put hard, put soft, call soft and call hard thresholds
+    """
+    global PUT_THRESHOLD_HARD, PUT_THRESHOLD_SOFT, CALL_THRESHOLD_SOFT, CALL_THRESHOLD_HARD
+    PUT_THRESHOLD_HARD, PUT_THRESHOLD_SOFT, CALL_THRESHOLD_SOFT, CALL_THRESHOLD_HARD = thresholds
+
+
+def setup_database(use_database):
+    """
+    Connects to the state store, importing the
+    history files the first time it is used
+    """
+    global DATABASE, TRADE_BANDS
+    # Trades are read from the store in use the next time they are needed
+    TRADE_BANDS = None
+    if not use_database:
+        DATABASE = None
+        return
+
+    DATABASE = database.connect(DATABASE_FILE)
+    if not database.is_migrated(DATABASE, 'history'):
+        viability_scores, aliases = read_history_files()
+        database.import_history(DATABASE, viability_scores, aliases)
+
+
+def setup_cache(cache_size, use_disk_cache):
+    """
+    Sets up the polarity cache for this process,
+    a cache size of 0 without a disk tier disables it
+    """
+    global SENTIMENT_CACHE
+    if cache_size > 0 or use_disk_cache:
+        SENTIMENT_CACHE = sentiment.SentimentCache(cache_size, SENTIMENT_CACHE_FILE if use_disk_cache else None)
+    else:
+        SENTIMENT_CACHE = None
+
+
+def log_cache_stats():
+    if SENTIMENT_CACHE is not None:
+        SENTIMENT_CACHE.log_stats()
+
+
+def warm_up_worker(aliases, cache):
+    """
+    Scoring worker initialiser: keeps its own copy of the aliases
+    and polarity cache, and loads the sentiment lexicon once, up front
+    """
+    global WORKER_ALIASES, SENTIMENT_CACHE
+    WORKER_ALIASES = aliases
+    SENTIMENT_CACHE = cache
+    helper.resume_logging()
+    sentiment.load_lexicon()
+
+
+def score_tweets(chunk):
+    """
+    Scoring worker task, the per-tweet sentiment for a chunk of
+    (tweets, their normalised tweets, their companies), the latter two
+    None unless already extracted
+    """
+    batch_companies = get_batch_sentiment_analysis(chunk[0], WORKER_ALIASES, *chunk[1:])
+    log_cache_stats()
+    return batch_companies
+
+
+def create_worker_pool(workers, aliases):
+    """
+    Pool of scoring workers, each warmed up with the given aliases
+    """
+    # Only imported when scoring across processes, it is slow to import
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers, initializer=warm_up_worker,
+                               initargs=(aliases, SENTIMENT_CACHE))
+
+
+def parse_line(line):
+    """
+    Splits an input line (tweet text|retweets+fav|timestamp) into a tweet
+    """
+    tweet = line.split('|')
+
+    # Strips out newline if it has one at the end
+    tweet[-1] = tweet[-1].strip()
+    return tweet
+
+
+def parse_lines(viability_scores, aliases, lines, pool=None, touched=None):
+    """
+    Given prior state and an iterable of input lines
+    (tweet text|retweets+fav|timestamp), adds the new
+    expressions to the current state, and returns the new state
+    """
+    tweets = [parse_line(line) for line in lines]
+    return parse_tweets(viability_scores, aliases, tweets, pool, touched)
+
+
+def parse_tweets(viability_scores, aliases, tweets, pool=None, touched=None):
+    """
+    Given prior state and a list of tweets, each a
+    (tweet text, retweets+fav, timestamp) record, adds the new
+    expressions to the current state, and returns the new state
+
+    With a worker pool, the tweets are split across the workers,
+    and their results are merged back in input order, so that the
+    new state is identical to scoring them in a single process
+
+    With deduplication, only new tweets are scored, copies of a
+    recent tweet weigh in with it instead (see dedup.DedupIndex)
+    """
+    all_tweets = tweets
+    normalised_tweets = tweet_companies = None
+    if DEDUP is not None:
+        # Tweets are normalised, and their companies extracted, once for
+        # matching copies, and the new tweets are scored on the same
+        start = time.perf_counter()
+        alias_matcher = aliases if isinstance(aliases, matcher.AliasMatcher) else matcher.AliasMatcher(aliases)
+        normalised_tweets = helper.normalise_tweets([tweet[0] for tweet in all_tweets])
+        tweet_companies = [frozenset(alias_matcher.find_tokens(tokens)) for tokens, _ in normalised_tweets]
+        originals, is_copy = DEDUP.add_batch(all_tweets, normalised_tweets, tweet_companies)
+        new_tweets = [index for index, copy in enumerate(is_copy) if not copy]
+        tweets, normalised_tweets, tweet_companies = ([column[index] for index in new_tweets]
+                                                      for column in (all_tweets, normalised_tweets, tweet_companies))
+        dedup_time = time.perf_counter() - start
+
+    if pool is None or len(tweets) < 2:
+        batch_companies = get_batch_sentiment_analysis(tweets, aliases, normalised_tweets, tweet_companies)
+    else:
+        chunks = [tuple(column and column[i:i + WORKER_CHUNK_SIZE]
+                        for column in (tweets, normalised_tweets, tweet_companies))
+                  for i in range(0, len(tweets), WORKER_CHUNK_SIZE)]
+        start = time.perf_counter()
+        batch_companies = list(chain.from_iterable(pool.map(score_tweets, chunks)))
+        workers_time = time.perf_counter() - start
+
+        # Workers are only timed as a whole, each tweet is given an equal share
+        metrics = profiling.METRICS
+        if metrics is not None:
+            metrics.stages['scoring workers'] += workers_time
+            metrics.add_tweets([workers_time / len(tweets)] * len(tweets),
+                               sum(len(new_companies) for new_companies in batch_companies))
+
+    if DEDUP is not None:
+        batch_companies = DEDUP.fold(all_tweets, originals, is_copy, batch_companies)
+        copies = len(all_tweets) - len(tweets)
+        logging.info('Folded %d copies of recent tweets into them, %d recent tweets', copies, len(DEDUP))
+
+        # Copies are only matched, each tweet is given an equal share of matching the batch
+        metrics = profiling.METRICS
+        if metrics is not None:
+            metrics.stages['dedup'] += dedup_time
+            metrics.add_tweets([dedup_time / len(all_tweets)] * copies,
+                               sum(len(new_companies) for new_companies, copy in zip(batch_companies, is_copy)
+                                   if copy))
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        for new_companies in batch_companies:
+            if helper.is_sampled():
+                logging.info("Adding new information:\n\n%s", new_companies)
+    with profiling.stage('state merge'):
+        viability_scores = add_batch_state(viability_scores, batch_companies, touched)
+
+    log_cache_stats()
+    return viability_scores, aliases
+
+
+def parse_input(viability_scores, aliases, input_file_name, pool=None, touched=None):
     """
     Given prior history/clean state, and an input file
     of new expressions, adds the new expressions to the
     current state, and returns the new state
+
+    The input file is either a batch file (see batchfile.py),
+    read in place, or lines of tweet text|retweets+fav|timestamp
     """
     try:
         # Sanity check: Empty file
         if helper.is_empty_file(input_file_name):
             raise ValueError()
 
-        with open(input_file_name, "r") as input_file:
-            for line in input_file:
-                tweet = line.split('|')
-
-                # Strips out newline if it has one at the end
-                tweet[-1] = tweet[-1].strip()
-
-                new_companies = get_sentiment_analysis(tweet, aliases)
-                logging.info("Adding new information:\n\n")
-                logging.info(new_companies)
-                viability_scores = add_new_state(viability_scores, new_companies)
-            logging.info("Input has now been read successfully")
+        if batchfile.is_batch_file(input_file_name):
+            viability_scores, aliases = parse_tweets(viability_scores, aliases,
+                                                     batchfile.read_batch(input_file_name), pool, touched)
+        else:
+            with open(input_file_name, "r") as input_file:
+                viability_scores, aliases = parse_lines(viability_scores, aliases, input_file, pool, touched)
+        logging.info("Input has now been read successfully")
     except (IOError, ValueError):
         logging.warning("Input file was either not found or was empty, exiting now")
         exit(1)
@@ -183,84 +637,262 @@ def parse_input(viability_scores, aliases, input_file_name):
     return viability_scores, aliases
 
 
-def write_trades(viability_scores):
+def trading_scores(viability_scores):
+    """
+    Company => score that trades are placed on, either the momentum
+    over a rolling window, or the decayed score, None to trade on the
+    cumulative score itself
+    """
+    if MOMENTUM_HORIZON is not None:
+        return WINDOWS.momentum(MOMENTUM_HORIZON)
+    return current_scores(viability_scores)
+
+
+def current_scores(viability_scores, now=None):
+    """
+    With a half-life, gives back company => score decayed up to now,
+    by default the latest timestamp of any company
+    """
+    if not HALF_LIFE:
+        return None
+
+    if not isinstance(viability_scores, scores.ScoreTable):
+        # Laid out column-wise first, e.g. scores from the database
+        viability_scores = scores.ScoreTable(viability_scores)
+
+    decayed = viability_scores.current_scores(HALF_LIFE, None if now is None else scores.to_epoch(now))
+    return dict(zip(viability_scores.companies, decayed.tolist()))
+
+
+def read_trade_bands():
+    """
+    Company => lots of each company's latest trade, from the trade
+    ledger with the database, otherwise from the trade file, for when
+    they were not read in with the history (see read_history)
+    """
+    band_lots = {trade: lots for lots, trade in BAND_TRADES.items()}
+    if DATABASE is not None:
+        return {company: band_lots[band] for company, band in database.read_trade_bands(DATABASE).items()}
+
+    trade_bands = {}
+    if os.path.isfile(TRADE_FILE):
+        with open(TRADE_FILE, "r") as trade_file:
+            for line in trade_file:
+                trade = line.rstrip('\n').split(', ')
+                if len(trade) >= 4 and (trade[0], trade[-2]) in band_lots:
+                    trade_bands[', '.join(trade[1:-2])] = band_lots[(trade[0], trade[-2])]
+    return trade_bands
+
+
+def band_lots(scores, thresholds=None):
+    """
+    Lots each of an array of scores trades (see BAND_TRADES): none from
+    the soft put threshold up to the soft call threshold, 1 above it and
+    2 above the hard call threshold, likewise -1 and -2 below the put
+    thresholds.
+
+    Band edges are given as put hard, put soft, call soft and call hard
+    thresholds, those set (see set_thresholds) by default. Each edge
+    broadcasts against the scores, e.g. a column of edges bands the
+    scores once per row, as the backtest sweeps them
+    """
+    if thresholds is None:
+        thresholds = (PUT_THRESHOLD_HARD, PUT_THRESHOLD_SOFT, CALL_THRESHOLD_SOFT, CALL_THRESHOLD_HARD)
+    put_hard, put_soft, call_soft, call_hard = thresholds
+    return ((scores > call_soft).astype(numpy.int8) + (scores > call_hard)
+            - (scores < put_soft) - (scores < put_hard)).astype(numpy.int8)
+
+
+def weigh_trades(viability_scores, touched=None):
+    """
+    Given a list of viability scores, gives back the
+    (put/call, company, soft/hard, timestamp) trades
+    of those above/below a certain threshold
+
+    Only the companies touched by this batch are looked at, if given,
+    unless trades are placed on decayed scores, which move with time
+    alone (momentum is only weighed for the companies touched, so that
+    a company is not taken flat just for falling out of the window).
+    A trade is only appended when a company moves into another band
+    than that of its latest trade, a company falling back between the
+    thresholds is given a (no, company, trade, timestamp) trade,
+    taking it flat
+    """
+    global TRADE_BANDS
+    if TRADE_BANDS is None:
+        TRADE_BANDS = read_trade_bands()
+
+    scores_traded_on = trading_scores(viability_scores)
+    if touched is None or (scores_traded_on is not None and MOMENTUM_HORIZON is None):
+        companies = list(viability_scores.items())
+    else:
+        companies = [(company, viability_scores[company]) for company in sorted(touched)]
+    company_count = len(companies)
+
+    if scores_traded_on is not None:
+        values = numpy.fromiter((scores_traded_on.get(company, 0.0) for company, _ in companies),
+                                dtype=numpy.float64, count=company_count)
+    else:
+        values = numpy.fromiter((float(company_information[0]) for _, company_information in companies),
+                                dtype=numpy.float64, count=company_count)
+
+    # Companies without a score to band are never traded
+    is_valid = numpy.isfinite(values)
+    lots = numpy.where(is_valid, band_lots(values), 0)
+    previous_lots = numpy.fromiter((TRADE_BANDS.get(company, 0) for company, _ in companies),
+                                   dtype=numpy.int64, count=company_count)
+    changed = numpy.flatnonzero(is_valid & (lots != previous_lots)).tolist()
+    lots = lots.tolist()
+    trades = [(BAND_TRADES[lots[index]][0], companies[index][0], BAND_TRADES[lots[index]][1],
+               companies[index][1][2]) for index in changed]
+
+    for index in numpy.flatnonzero(~is_valid).tolist():
+        logging.warning('Error: trading could not write for: %s with a score of: %s\n',
+                        companies[index][0], values[index])
+    if LOG_COMPANIES and logging.getLogger().isEnabledFor(logging.INFO):
+        for (company, company_information), score, company_lots in zip(companies, values.tolist(), lots):
+            kind, strength = BAND_TRADES[company_lots]
+            logging.info("Company:\t%s\t**%s %s**\n\t\tScore:\t\t%s\n\t\tWeight:\t\t%s\n\t\tTimestamp:\t%s",
+                         company, strength.upper(), kind.upper(), score, company_information[1],
+                         company_information[2])
+    logging.info("Weighed %d companies for trades, %d moved into another band", company_count, len(trades))
+
+    for index in changed:
+        TRADE_BANDS[companies[index][0]] = lots[index]
+        UNWRITTEN_BANDS.add(companies[index][0])
+    return trades
+
+
+def write_trades(viability_scores, touched=None):
     """
     Given a list of viability scores, writes
     a trade down if it is above/below a certain
-    threshold
-    """
-    with open(TRADE_FILE, "w") as trade_file:
-        for company, company_information in viability_scores.items():
-            # Company information values
-            score = float(company_information[0])
-            weight = company_information[1]
-            timestamp = company_information[2]
-
-            # Debugging information
-            logging.info("Writing trade for company:\t" + company)
-            logging.debug("\t\tScore:\t\t" + str(score))
-            logging.debug("\t\tWeight:\t\t" + str(weight))
-            logging.debug("\t\tTimestamp:\t" + timestamp)
-
-            if PUT_THRESHOLD_SOFT <= score <= CALL_THRESHOLD_SOFT:
-                # Not enough sentiment to invoke a trade
-                logging.info("Company:\t" + company + " does not have enough sentiment:\n\t\t**NO TRADE**")
-                logging.info("Not enough of a sentiment score to make a trade")
-            elif PUT_THRESHOLD_HARD <= score <= PUT_THRESHOLD_SOFT:
-                # Enough sentiment to make a soft put trade
-                logging.info("Company:\t" + company + " has enough **NEGATIVE** sentiment:\n\t\t**SOFT PUT**")
-                trade_file.write('put, ' + company + ', soft, ' + timestamp)
-            elif score < PUT_THRESHOLD_HARD:
-                # Enough sentiment to make a hard put trade
-                logging.info("Company:\t" + company + " has enough **NEGATIVE** sentiment to make a\n\t\t**HARD PUT**")
-                trade_file.write('put, ' + company + ', hard, ' + timestamp)
-            elif CALL_THRESHOLD_SOFT <= score <= CALL_THRESHOLD_HARD:
-                # Enough sentiment to make a soft call trade
-                logging.info("Company:\t" + company + " has enough **POSITIVE** sentiment to make a\n\t\t**SOFT CALL**")
-                trade_file.write('call, ' + company + ', soft, ' + timestamp)
-            elif CALL_THRESHOLD_HARD > score:
-                # Enough sentiment to make a hard call trade
-                logging.info("Company:\t" + company + " has enough **POSITIVE** sentiment to make a\n\t\t**HARD CALL**")
-                trade_file.write('call, ' + company + ', hard, ' + timestamp)
-            else:
-                logging.warning('Error: trading could not write for: '
-                                + company + ' with a score of: ' + str(score) + '\n')
+    threshold (see weigh_trades)
+
+    With sharded state, the trades each shard weighed are fanned in
+    """
+    if isinstance(viability_scores, shards.ShardedScores):
+        trades = viability_scores.weigh_trades(touched)
+    else:
+        trades = weigh_trades(viability_scores, touched)
+
+    if DATABASE is not None:
+        database.write_trades(DATABASE, trades)
+    else:
+        with open(TRADE_FILE, "a") as trade_file:
+            trade_file.write(''.join(', '.join(trade) + '\n' for trade in trades))
 
 
-def write_history(viability_scores, aliases):
+def write_history(viability_scores, aliases, touched=None):
+    """
+    Appends the scores of the companies touched by this batch to the
+    history log as one committed batch, along with the bands of the
+    companies traded since, and compacts the log into the history
+    snapshot once it has outgrown it. Without a set of touched
+    companies, the whole state is written out as a new snapshot.
+
+    With the database, the batch (and its trades) is committed instead,
+    and with sharded state each shard writes its own history files
+    """
+    if DATABASE is not None:
+        database.write_batch(DATABASE, viability_scores, aliases, touched)
+        return
+
+    if isinstance(viability_scores, shards.ShardedScores):
+        viability_scores.write_history(touched)
+        return
+
+    if touched is None:
+        write_history_snapshot(viability_scores, aliases)
+        return
+
+    traded = sorted(UNWRITTEN_BANDS) if TRADE_BANDS is not None else []
+    with open(HISTORY_LOG_FILE, "a") as history_log:
+        for company in sorted(touched):
+            history_log.write(format_score(company, viability_scores[company]))
+        for company in traded:
+            history_log.write(format_band(company, TRADE_BANDS.get(company, 0)))
+        history_log.write('commit, ' + str(len(touched) + len(traded)) + '\n')
+        history_log.flush()
+        os.fsync(history_log.fileno())
+    UNWRITTEN_BANDS.difference_update(traded)
+
+    snapshot_size = os.path.getsize(HISTORY_FILE) if os.path.isfile(HISTORY_FILE) else 0
+    if os.path.getsize(HISTORY_LOG_FILE) > max(snapshot_size, HISTORY_COMPACTION_BYTES):
+        logging.info("Compacting the history log into the history snapshot")
+        write_history_snapshot(viability_scores, aliases)
+
+
+def write_history_snapshot(viability_scores, aliases):
     """
     The first word in the history is an indicator:
         'score' => The line contains a company name and current viability score tuple
         'alias' => The line contains a company's name and their stock ticker tuple
+        'band' => The line contains a company name and the lots of its latest trade
+
+    The snapshot is swapped in whole, and only then is the
+    history log it now covers dropped
     """
-    with open(HISTORY_FILE, "w") as history_file:
+    trade_bands = TRADE_BANDS if TRADE_BANDS is not None else read_trade_bands()
+    temporary_file = HISTORY_FILE + '.tmp'
+    with open(temporary_file, "w") as history_file:
         # Prints out the companies and scores
         for company, score in viability_scores.items():
-            history_file.write('score, ' + company + ', ' + str(score[0]) + ', ' + str(score[1]) + '\n')
+            history_file.write(format_score(company, score))
 
         # Prints out any aliases gathered
         for company, ticker in aliases.items():
             history_file.write('alias, ' + company + ', ' + ticker + '\n')
 
+        # Prints out the band of each company's latest trade
+        for company, lots in trade_bands.items():
+            if company in viability_scores:
+                history_file.write(format_band(company, lots))
+
+        history_file.flush()
+        os.fsync(history_file.fileno())
+
+    os.replace(temporary_file, HISTORY_FILE)
+    UNWRITTEN_BANDS.clear()
+    if os.path.isfile(HISTORY_LOG_FILE):
+        os.remove(HISTORY_LOG_FILE)
+
 
 def main():
-    args, file_name = helper.parse_args()
+    args, file_name = helper.parse_args(is_resident=False)
 
     # Initial setup
-    helper.setup_logging(args.verbose)
+    helper.setup_logging(args.verbose, args.quiet, args.log_every)
     logging.info("Logging is now setup")
 
+    if args.profile:
+        profiling.run_profiled(run, args, file_name)
+    else:
+        run(args, file_name)
+
+
+def run(args, file_name):
+    setup(args)
+    profiling.start_batch()
+
     logging.info('-------------------- READING HISTORY START --------------------')
     # Gets prior history if available, clean state if not
-    viability_scores, aliases = read_history()
+    with profiling.stage('history load'):
+        viability_scores, aliases = read_history()
 
     # Debugging
     helper.log_state('history read-in', viability_scores, aliases)
     logging.info('-------------------- READING HISTORY END --------------------')
 
     logging.info('-------------------- INPUT FILE START --------------------')
-    # Gets the current ingestion batch from an input file
-    viability_scores, aliases = parse_input(viability_scores, aliases, file_name)
+    # Gets the current ingestion batch from an input file,
+    # split across scoring workers if asked for
+    touched = set()
+    if args.workers > 1:
+        with create_worker_pool(args.workers, aliases) as pool:
+            viability_scores, aliases = parse_input(viability_scores, aliases, file_name, pool, touched)
+    else:
+        viability_scores, aliases = parse_input(viability_scores, aliases, file_name, touched=touched)
 
     # Debugging
     helper.log_state('input file read-in', viability_scores, aliases)
@@ -268,12 +900,19 @@ def main():
 
     logging.info('-------------------- WRITING FILE OUTPUT START --------------------')
     # Writes any trades to disk
-    write_trades(viability_scores)
+    with profiling.stage('trade write'):
+        write_trades(viability_scores, touched)
 
-    # Writes the SA state to history
-    write_history(viability_scores, aliases)
+    # Writes the companies this batch touched to history
+    with profiling.stage('history write'):
+        write_history(viability_scores, aliases, touched)
     logging.info('-------------------- WRITING FILE OUTPUT END --------------------')
 
+    if STATE_SHARDS is not None:
+        STATE_SHARDS.close()
+
+    profiling.end_batch()
+
 
 if __name__ == '__main__':
     main()
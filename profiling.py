@@ -0,0 +1,136 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import logging
+import os
+import time
+
+import numpy
+
+"""
+Per-batch timing of the processing engine's stages,
+written out as one JSON line per batch to a metrics file
+"""
+
+METRICS_DIRECTORY = 'metrics'
+
+# Stages of a batch, in the order they run
+STAGES = ('history load', 'dedup', 'sanitise', 'extraction', 'sentiment', 'scoring workers',
+          'state merge', 'trade write', 'history write')
+
+# Per-tweet latency histogram bucket upper bounds, in microseconds (1us to ~1s)
+LATENCY_BUCKETS = 2 ** numpy.arange(21)
+
+# Metrics of the batch being processed, if they are being collected
+METRICS = None
+
+# Metrics file of this process
+METRICS_FILE = None
+
+
+class BatchMetrics:
+    """
+    Time spent per stage of one batch, and the latency of each
+    tweet in it: the time spent on that tweet on its own (sanitising
+    and extraction), plus its share of the stages run over the
+    whole batch at once (sentiment and state merge)
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.tweet_latencies = []
+        self.tweets = 0
+        self.companies = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def add_tweets(self, latencies, companies):
+        """
+        Records the per-tweet latencies of a (part of a) batch
+        """
+        self.tweet_latencies.extend(latencies)
+        self.tweets += len(latencies)
+        self.companies += companies
+
+    def histogram(self):
+        """
+        Number of tweets per latency bucket, keyed by the bucket's upper bound in microseconds
+        """
+        latencies = numpy.array(self.tweet_latencies, dtype=numpy.float64) * 1e6
+        counts = numpy.bincount(numpy.searchsorted(LATENCY_BUCKETS, latencies), minlength=len(LATENCY_BUCKETS) + 1)
+        labels = [str(bound) for bound in LATENCY_BUCKETS] + ['inf']
+        return {label: int(count) for label, count in zip(labels, counts) if count}
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'elapsed': elapsed,
+            'stages': self.stages,
+            'tweets': self.tweets,
+            'companies': self.companies,
+            'tweets_per_second': self.tweets / elapsed if elapsed > 0 else 0.0,
+            'companies_per_second': self.companies / elapsed if elapsed > 0 else 0.0,
+            'tweet_latency_histogram_us': self.histogram(),
+        }
+
+
+def stage(name):
+    """
+    Times a stage of the current batch, if metrics are being collected
+    """
+    if METRICS is None:
+        return contextlib.nullcontext()
+    return METRICS.stage(name)
+
+
+def start_batch():
+    global METRICS
+    METRICS = BatchMetrics()
+    return METRICS
+
+
+def end_batch():
+    """
+    Appends the current batch's metrics to this process' metrics file
+    """
+    global METRICS, METRICS_FILE
+    if METRICS is None:
+        return
+
+    summary = METRICS.summary()
+    METRICS = None
+
+    if METRICS_FILE is None:
+        os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+        METRICS_FILE = METRICS_DIRECTORY + '/' + datetime.datetime.now().isoformat() + '.jsonl'
+    with open(METRICS_FILE, "a") as metrics_file:
+        metrics_file.write(json.dumps(summary) + '\n')
+
+    logging.info('Batch of %d tweets took %.6fs (%.1f tweets/s): %s', summary['tweets'], summary['elapsed'],
+                 summary['tweets_per_second'],
+                 ', '.join('%s %.6fs' % (name, seconds) for name, seconds in summary['stages'].items() if seconds))
+    return summary
+
+
+def run_profiled(function, *args):
+    """
+    Runs the function under cProfile, and dumps its
+    stats next to the metrics for pstats/snakeviz
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+        stats_file = METRICS_DIRECTORY + '/' + datetime.datetime.now().isoformat() + '.prof'
+        profiler.dump_stats(stats_file)
+        logging.info('Profile stats written to ' + stats_file)
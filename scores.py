@@ -0,0 +1,207 @@
+import datetime
+import warnings
+from collections.abc import MutableMapping
+
+import numpy
+
+"""
+Column-wise table of viability scores, so that a
+batch of new information is added to every company
+it mentions in one go, rather than one tuple at a time
+"""
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Rows allocated up front, the table doubles whenever it fills up
+INITIAL_CAPACITY = 64
+
+
+def to_epoch(timestamp):
+    """
+    ISO 8601 timestamp => microseconds since the epoch,
+    timestamps without a timezone are taken to be in UTC
+    """
+    moment = datetime.datetime.fromisoformat(str(timestamp))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (moment - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_epoch(microseconds):
+    return (EPOCH + datetime.timedelta(microseconds=int(microseconds))).isoformat()
+
+
+def to_epochs(timestamps):
+    """
+    ISO 8601 timestamps => int64 microseconds since the epoch, in bulk
+    """
+    with warnings.catch_warnings():
+        # Timestamps with a timezone are converted to UTC, which is what we want
+        warnings.simplefilter('ignore')
+        return numpy.array(timestamps, dtype='datetime64[us]').astype(numpy.int64)
+
+
+def from_epochs(microseconds):
+    """
+    int64 microseconds since the epoch => ISO 8601 timestamps, in bulk,
+    formatted as from_epoch formats them: whole seconds without a fraction
+    """
+    microseconds = numpy.asarray(microseconds, dtype=numpy.int64)
+    timestamps = numpy.datetime_as_string(microseconds.astype('datetime64[us]'))
+    is_whole = microseconds % 1000000 == 0
+    timestamps[is_whole] = numpy.datetime_as_string(microseconds[is_whole].astype('datetime64[us]'), unit='s')
+    return timestamps.tolist()
+
+
+def decay_factor(elapsed, half_life):
+    """
+    How much a score has decayed after elapsed microseconds, given a half-life in seconds
+    """
+    return numpy.exp2(-elapsed / (half_life * 1e6))
+
+
+class ScoreTable(MutableMapping):
+    """
+    Viability scores, company => (score, weight, timestamp), where
+    each company is given a row id indexing into arrays of scores,
+    weights and timestamps (as int64 microseconds since the epoch).
+
+    Reading a company back gives the same (score, weight, ISO 8601
+    timestamp) tuple as the plain dictionary of scores would.
+    """
+
+    def __init__(self, scores=None, capacity=INITIAL_CAPACITY):
+        self.ids = {}           # company => row id
+        self.companies = []     # row id => company
+        self.score = numpy.zeros(capacity, dtype=numpy.float64)
+        self.weight = numpy.zeros(capacity, dtype=numpy.float64)
+        self.timestamp = numpy.zeros(capacity, dtype=numpy.int64)
+
+        if scores is not None:
+            self.update(scores)
+
+    def __getitem__(self, company):
+        row = self.ids[company]
+        return float(self.score[row]), float(self.weight[row]), from_epoch(self.timestamp[row])
+
+    def __setitem__(self, company, score):
+        row = self.row(company)
+        self.score[row] = score[0]
+        self.weight[row] = score[1]
+        self.timestamp[row] = to_epoch(score[2])
+
+    def __delitem__(self, company):
+        # Moves the last row into the one freed up
+        row = self.ids.pop(company)
+        last = len(self.companies) - 1
+        if row != last:
+            moved = self.companies[last]
+            self.companies[row] = moved
+            self.ids[moved] = row
+            self.score[row] = self.score[last]
+            self.weight[row] = self.weight[last]
+            self.timestamp[row] = self.timestamp[last]
+        self.companies.pop()
+
+    def __iter__(self):
+        return iter(self.companies)
+
+    def __len__(self):
+        return len(self.companies)
+
+    def __contains__(self, company):
+        return company in self.ids
+
+    def __repr__(self):
+        return 'ScoreTable(' + repr(dict(self.items())) + ')'
+
+    def row(self, company):
+        """
+        Row id of a company, adding an empty row for a new one
+        """
+        row = self.ids.get(company)
+        if row is None:
+            row = len(self.companies)
+            if row == len(self.score):
+                self.grow(2 * row)
+            self.ids[company] = row
+            self.companies.append(company)
+            self.score[row] = 0.0
+            self.weight[row] = 0.0
+            self.timestamp[row] = 0
+        return row
+
+    def grow(self, capacity):
+        for column in ('score', 'weight', 'timestamp'):
+            old = getattr(self, column)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+
+    def add_batch(self, batch_companies, half_life=None):
+        """
+        Adds a batch of new information, one dictionary per tweet of
+        company => (score, weight, timestamp), as a scatter-add over
+        every row the batch touches. Sums are accumulated in batch
+        order, exactly as adding the tweets one by one would.
+
+        With a half-life (in seconds), scores decay exponentially, see add_decayed
+        """
+        rows, scores, weights, timestamps = [], [], [], []
+        for new_companies in batch_companies:
+            for company, (score, weight, timestamp) in new_companies.items():
+                rows.append(self.row(company))
+                scores.append(score)
+                weights.append(weight)
+                timestamps.append(timestamp)
+        if not rows:
+            return
+
+        rows = numpy.array(rows, dtype=numpy.int64)
+        weights = numpy.array(weights, dtype=numpy.float64)
+        scores = numpy.array(scores, dtype=numpy.float64) * weights
+        if half_life:
+            self.add_decayed(rows, scores, weights, numpy.array([to_epoch(timestamp) for timestamp in timestamps],
+                                                                dtype=numpy.int64), half_life)
+            return
+
+        numpy.add.at(self.score, rows, scores)
+        numpy.add.at(self.weight, rows, weights)
+
+        # Each row keeps the timestamp of the last tweet that touched it
+        reversed_rows = rows[::-1]
+        _, last = numpy.unique(reversed_rows, return_index=True)
+        last = len(rows) - 1 - last
+        self.timestamp[rows[last]] = [to_epoch(timestamps[index]) for index in last]
+
+    def add_decayed(self, rows, scores, weights, timestamps, half_life):
+        """
+        Adds a batch to exponentially decaying scores, so that each row
+        ends up as of the latest tweet that touched it (or its own
+        timestamp, if later): the existing score is decayed up to then,
+        and so is each tweet, from its own timestamp. This gives the
+        same as decaying tweet by tweet, with out of order tweets being
+        decayed on the way in rather than the score being rewound.
+        """
+        touched = numpy.unique(rows)
+        previous = self.timestamp[touched].copy()
+        numpy.maximum.at(self.timestamp, rows, timestamps)
+
+        decay = decay_factor(self.timestamp[touched] - previous, half_life)
+        self.score[touched] *= decay
+        self.weight[touched] *= decay
+
+        decay = decay_factor(self.timestamp[rows] - timestamps, half_life)
+        numpy.add.at(self.score, rows, scores * decay)
+        numpy.add.at(self.weight, rows, weights * decay)
+
+    def current_scores(self, half_life, now=None):
+        """
+        Every company's score decayed up to now, by default the
+        latest timestamp in the table, in row order
+        """
+        count = len(self.companies)
+        timestamps = self.timestamp[:count]
+        if now is None:
+            now = timestamps.max() if count else 0
+        return self.score[:count] * decay_factor(numpy.maximum(now - timestamps, 0), half_life)
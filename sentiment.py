@@ -0,0 +1,383 @@
+import argparse
+import hashlib
+import importlib.util
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy
+
+"""
+Batch sentiment scoring against the pattern lexicon
+that TextBlob uses, scoring a whole list of sanitised
+tweets at once instead of one TextBlob per tweet
+"""
+
+# Same negations as pattern's Sentiment
+NEGATIONS = ('no', 'not', "n't", 'never')
+
+# Token flags
+KNOWN = 1       # Has a sentiment score in the lexicon
+MODIFIER = 2    # Adverb that modifies the next known word ("very good")
+NEGATION = 4    # Flips the next known word ("not good")
+
+LEXICON = None
+
+# Compiled lexicon, built once by `python sentiment.py --build`, kept next to the code
+LEXICON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.app.lexicon.npy')
+
+# Pattern's lexicon as shipped with TextBlob, compiled lexicons record a hash of it
+PATTERN_LEXICON = os.path.join('en', 'en-sentiment.xml')
+
+# Number of polarities kept in memory by default
+CACHE_SIZE = 10000
+
+
+class Lexicon:
+    """
+    The pattern sentiment lexicon laid out as arrays,
+    indexed by the id a word maps to
+    """
+
+    def __init__(self, words, polarity, intensity, flags):
+        self.words = words          # word => id
+        self.polarity = polarity
+        self.intensity = intensity
+        self.flags = flags
+
+    @classmethod
+    def from_pattern(cls):
+        from textblob.en import sentiment as pattern_sentiment
+
+        words = {}
+        polarity, intensity, flags = [], [], []
+        for word, scores in pattern_sentiment.items():
+            # Sanitised tweets carry no part-of-speech tags, only the
+            # tag-averaged (None) scores can ever be looked up
+            words[word] = len(polarity)
+            polarity.append(scores[None][0])
+            intensity.append(scores[None][2])
+            flags.append(KNOWN | (MODIFIER if 'RB' in scores else 0) | (NEGATION if word in NEGATIONS else 0))
+
+        for word in NEGATIONS:
+            if word not in words:
+                words[word] = len(polarity)
+                polarity.append(0.0)
+                intensity.append(1.0)
+                flags.append(NEGATION)
+
+        return cls(words, numpy.array(polarity, dtype=numpy.float64),
+                   numpy.array(intensity, dtype=numpy.float64), numpy.array(flags, dtype=numpy.int8))
+
+    @classmethod
+    def from_index(cls, path=LEXICON_FILE):
+        """
+        Reads a compiled lexicon in place, through a memory map
+        """
+        index = numpy.load(path, mmap_mode='r')
+        return cls(dict(zip(index['word'].tolist(), range(len(index)))), index['polarity'],
+                   index['intensity'], index['flags'])
+
+    def save(self, path=LEXICON_FILE, source=None):
+        """
+        Compiles the lexicon into a single array of records sorted by word,
+        alongside the hash of the source lexicon it was compiled from
+        """
+        words = sorted(self.words)
+        ids = [self.words[word] for word in words]
+        index = numpy.zeros(len(words), dtype=[('word', 'U' + str(max(len(word) for word in words))),
+                                               ('polarity', numpy.float64), ('intensity', numpy.float64),
+                                               ('flags', numpy.int8)])
+        index['word'] = words
+        index['polarity'] = self.polarity[ids]
+        index['intensity'] = self.intensity[ids]
+        index['flags'] = self.flags[ids]
+        numpy.save(path, index)
+        with open(source_file_name(path), "w") as source_file:
+            source_file.write(source or '')
+
+
+def source_file_name(path):
+    return os.path.splitext(path)[0] + '.source'
+
+
+def pattern_lexicon_hash():
+    """
+    Hash of the lexicon TextBlob is installed with, found without importing
+    TextBlob, None if it cannot be found
+    """
+    spec = importlib.util.find_spec('textblob')
+    if spec is None or spec.origin is None:
+        return None
+    try:
+        with open(os.path.join(os.path.dirname(spec.origin), PATTERN_LEXICON), "rb") as pattern_file:
+            return hashlib.sha1(pattern_file.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def is_index_current(path=LEXICON_FILE):
+    """
+    Whether a compiled lexicon was compiled from the lexicon TextBlob is
+    installed with, it is taken to be if TextBlob's cannot be found
+    """
+    source = pattern_lexicon_hash()
+    if source is None:
+        return True
+    try:
+        with open(source_file_name(path), "r") as source_file:
+            return source_file.read() == source
+    except IOError:
+        return False
+
+
+def load_lexicon(path=LEXICON_FILE):
+    """
+    Loads the lexicon once per process, from its compiled index if
+    it has been built from the installed TextBlob's lexicon, otherwise
+    from pattern (importing TextBlob)
+    """
+    global LEXICON
+    if LEXICON is None:
+        if not os.path.exists(path):
+            logging.info('No compiled lexicon, loading it from TextBlob (see sentiment.py --build)')
+            LEXICON = Lexicon.from_pattern()
+        elif not is_index_current(path):
+            logging.warning('Compiled lexicon does not match the installed TextBlob, loading it from TextBlob '
+                            'instead (rebuild it with sentiment.py --build)')
+            LEXICON = Lexicon.from_pattern()
+        else:
+            LEXICON = Lexicon.from_index(path)
+    return LEXICON
+
+
+def build_lexicon(path=LEXICON_FILE):
+    """
+    Compiles pattern's lexicon, so that later runs load it without TextBlob
+    """
+    lexicon = Lexicon.from_pattern()
+    lexicon.save(path, pattern_lexicon_hash())
+    return lexicon
+
+
+def assess(tokens, ids, lexicon):
+    """
+    Pattern's assessment of a single tweet, for tweets with
+    modifiers or negations where each known word depends on
+    the words before it. Returns the tweet's polarity.
+    """
+    assessments = []    # [polarity, intensity, is negated]
+    modifier = None
+    negation = None
+    for token, word in zip(tokens, ids):
+        flags = lexicon.flags[word] if word >= 0 else 0
+        if flags & KNOWN:
+            if modifier is None:
+                assessments.append([lexicon.polarity[word], lexicon.intensity[word], False])
+            else:
+                # Known word preceded by a modifier ("really good")
+                last = assessments[-1]
+                last[0] = max(-1.0, min(lexicon.polarity[word] * last[1], 1.0))
+                last[1] = lexicon.intensity[word]
+            if negation is not None:
+                # Known word preceded by a negation ("not really good")
+                last = assessments[-1]
+                last[1] = 1.0 / last[1]
+                last[2] = True
+            modifier = token if flags & MODIFIER else None
+            negation = token if flags & NEGATION else None
+        else:
+            if flags & NEGATION:
+                negation = token
+            elif negation and len(token.strip("'")) > 1:
+                # Retains negation across small words ("not a good")
+                negation = None
+
+            if negation is not None and modifier is not None and modifier.endswith('ly'):
+                # Negation preceded by a modifier ("really not good")
+                assessments[-1][2] = True
+                negation = None
+            elif modifier and len(token) > 2:
+                # Retains modifier across small words ("really is a good")
+                modifier = None
+
+    if len(assessments) == 0:
+        return 0.0
+
+    # "not good" = slightly bad, "not bad" = slightly good
+    total = 0.0
+    for polarity, _, is_negated in assessments:
+        total += polarity * -0.5 if is_negated else polarity
+    return total / len(assessments)
+
+
+class SentimentCache:
+    """
+    Polarity cache keyed on a hash of the sanitised tweet,
+    so that retweets and near-identical posts are only scored once.
+
+    Recent polarities are kept in an in-memory LRU of a given size,
+    and optionally in an on-disk (SQLite) tier that survives across
+    batches and runs.
+    """
+
+    def __init__(self, size=CACHE_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._connection = None
+
+    def __getstate__(self):
+        # Database connections stay with the process that opened them
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @staticmethod
+    def key(sanitised_tweet):
+        return hashlib.blake2b(sanitised_tweet.encode('utf-8'), digest_size=16).digest()
+
+    @property
+    def connection(self):
+        if self._connection is None and self.path is not None:
+            self._connection = sqlite3.connect(self.path, timeout=30)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS sentiment (key BLOB PRIMARY KEY, polarity REAL)')
+            self._connection.commit()
+        return self._connection
+
+    def remember(self, key, polarity):
+        self.entries[key] = polarity
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Returns key => polarity for every key found in either tier
+        """
+        found = {}
+        for key in keys:
+            polarity = self.entries.get(key)
+            if polarity is not None:
+                self.entries.move_to_end(key)
+                found[key] = polarity
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.connection is not None:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                rows = self.connection.execute(
+                    'SELECT key, polarity FROM sentiment WHERE key IN (' + ','.join('?' * len(chunk)) + ')', chunk)
+                for key, polarity in rows:
+                    found[key] = polarity
+                    self.remember(key, polarity)
+                    self.disk_hits += 1
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, polarities):
+        """
+        Stores key => polarity in both tiers
+        """
+        for key, polarity in polarities.items():
+            self.remember(key, polarity)
+
+        if polarities and self.connection is not None:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO sentiment (key, polarity) VALUES (?, ?)',
+                                            polarities.items())
+
+    def log_stats(self):
+        logging.info('Sentiment cache: %d hits (%d from disk), %d misses, %d entries in memory',
+                     self.hits, self.disk_hits, self.misses, len(self.entries))
+
+
+def score_batch(sanitised_tweets, cache=None):
+    """
+    Given a list of sanitised tweets, returns a numpy array
+    of their polarities, matching TextBlob(tweet).sentiment.polarity
+
+    With a cache, only tweets not seen before are scored
+    """
+    if cache is None:
+        return score_tweets(sanitised_tweets)
+
+    keys = [cache.key(tweet) for tweet in sanitised_tweets]
+    unique_keys = list(dict.fromkeys(keys))
+    polarities = cache.get_many(unique_keys)
+
+    # Scores each missing tweet once, even if it is repeated in the batch
+    missing = {}
+    for key, tweet in zip(keys, sanitised_tweets):
+        if key not in polarities and key not in missing:
+            missing[key] = tweet
+    scores = score_tweets(list(missing.values()))
+    new_polarities = dict(zip(missing.keys(), scores.tolist()))
+    cache.put_many(new_polarities)
+    polarities.update(new_polarities)
+
+    return numpy.fromiter((polarities[key] for key in keys), dtype=numpy.float64, count=len(keys))
+
+
+def score_tweets(sanitised_tweets):
+    """
+    Scores a list of sanitised tweets without any caching
+
+    Tweets made up only of plain known words are scored with
+    array operations in one go, tweets with modifiers or
+    negations fall back to pattern's word-by-word assessment
+    """
+    lexicon = load_lexicon()
+    tweet_count = len(sanitised_tweets)
+    polarities = numpy.zeros(tweet_count, dtype=numpy.float64)
+    if tweet_count == 0:
+        return polarities
+
+    # Tokenises the whole batch in bulk
+    tokens = [tweet.lower().split() for tweet in sanitised_tweets]
+    lengths = numpy.fromiter((len(tweet_tokens) for tweet_tokens in tokens), dtype=numpy.int64, count=tweet_count)
+    words = lexicon.words
+    ids = numpy.fromiter((words.get(token, -1) for tweet_tokens in tokens for token in tweet_tokens),
+                         dtype=numpy.int64, count=int(lengths.sum()))
+    tweet_ids = numpy.repeat(numpy.arange(tweet_count), lengths)
+
+    flags = numpy.where(ids >= 0, lexicon.flags[ids], 0)
+    is_known = (flags & KNOWN) != 0
+    is_sequential = numpy.bincount(tweet_ids[(flags & (MODIFIER | NEGATION)) != 0], minlength=tweet_count) > 0
+
+    # Plain tweets: polarity is the mean over its known words
+    plain = is_known & ~is_sequential[tweet_ids]
+    totals = numpy.bincount(tweet_ids[plain], weights=lexicon.polarity[ids[plain]], minlength=tweet_count)
+    counts = numpy.bincount(tweet_ids[plain], minlength=tweet_count)
+    polarities = totals / numpy.maximum(counts, 1)
+
+    # Tweets with modifiers or negations
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    for tweet in numpy.flatnonzero(is_sequential):
+        polarities[tweet] = assess(tokens[tweet], ids[offsets[tweet]:offsets[tweet + 1]], lexicon)
+
+    return polarities
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch sentiment scoring against the pattern lexicon')
+    parser.add_argument("--build", action="store_true",
+                        help="compile the lexicon, e.g. after installing or upgrading TextBlob")
+    args = parser.parse_args()
+
+    if args.build:
+        lexicon = build_lexicon()
+        print('Compiled ' + str(len(lexicon.words)) + ' words to ' + LEXICON_FILE)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
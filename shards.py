@@ -0,0 +1,253 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import zlib
+from collections.abc import Mapping
+from itertools import chain
+
+# Grabs non-application specific helper modules
+import helper
+import process
+
+"""
+Viability scores partitioned by a hash of each company's ticker
+into shards, each owned by a worker process along with its own
+history files, so that merging batches into the state, weighing
+trades and writing history runs on every shard at once
+"""
+
+# Default number of shards, a single shard keeps all state in the processing engine itself
+SHARD_COUNT = 1
+
+
+def shard_of(company, shard_count):
+    """
+    Shard a company's scores are kept in, the same across processes and runs
+    """
+    return zlib.crc32(company.encode('utf-8')) % shard_count
+
+
+def shard_file_name(file_name, shard):
+    return file_name + '.shard' + str(shard)
+
+
+def seed_shard(shard, shard_count):
+    """
+    Scores of the companies in a shard, out of the (unsharded) history
+    files, the first time state is sharded
+    """
+    viability_scores, _ = process.read_history_files()
+    return {company: score for company, score in viability_scores.items()
+            if shard_of(company, shard_count) == shard}
+
+
+def serve(shard, shard_count, args, connection):
+    """
+    Shard worker: reads its shard's history in, then carries out each
+    command sent over its end of the connection, replying to each
+    """
+    helper.setup_logging(args.verbose, args.quiet, args.log_every)
+    try:
+        run(shard, shard_count, args, connection)
+    finally:
+        helper.stop_logging()
+
+
+def run(shard, shard_count, args, connection):
+    process.setup(args)
+    shard_files = [shard_file_name(file_name, shard) for file_name in (process.HISTORY_FILE, process.HISTORY_LOG_FILE)]
+    seed = None
+    if not any(os.path.isfile(file_name) for file_name in shard_files):
+        seed = seed_shard(shard, shard_count)
+
+    process.HISTORY_FILE, process.HISTORY_LOG_FILE = shard_files
+    if seed:
+        process.write_history_snapshot(seed, {})
+    viability_scores, _ = process.read_history()
+    logging.info("Shard %d of %d holds %d companies", shard, shard_count, len(viability_scores))
+
+    while True:
+        command, value = connection.recv()
+        if command == 'stop':
+            break
+
+        try:
+            if command == 'batch':
+                # Batches are merged, weighed for trades and written to history in one go
+                touched = set()
+                viability_scores = process.add_batch_state(viability_scores, value, touched)
+                reply = process.weigh_trades(viability_scores, touched)
+                process.write_history(viability_scores, {}, touched)
+            elif command == 'trades':
+                reply = process.weigh_trades(viability_scores)
+            elif command == 'snapshot':
+                reply = process.write_history(viability_scores, {})
+            elif command == 'reset':
+                process.TRADE_BANDS = None
+                reply = None
+            elif command == 'get':
+                reply = viability_scores.get(value)
+            else:
+                reply = dict(viability_scores.items())
+        except Exception as error:
+            logging.exception("Shard %d could not carry out: %s", shard, command)
+            reply = error
+        connection.send(reply)
+
+
+class ShardedScores(Mapping):
+    """
+    Viability scores, company => (score, weight, timestamp), held by
+    one worker process per shard. Each batch is split up by shard and
+    sent to the shards it touches, which merge it side by side, and
+    the trades they weigh are fanned back in.
+
+    Lookups go to the company's shard, only iterating over every
+    company gathers the whole state from every shard.
+    """
+
+    def __init__(self, shard_count, args):
+        # Copies of tweets are folded in, and polarities cached, before the state is sharded
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.dedup = False
+        shard_args.cache_size = 0
+        shard_args.disk_cache = False
+        shard_args.state_shards = SHARD_COUNT
+        if shard_args.thresholds is None:
+            # Band edges set other than on the command line, e.g. by a test, are handed down too
+            shard_args.thresholds = (process.PUT_THRESHOLD_HARD, process.PUT_THRESHOLD_SOFT,
+                                     process.CALL_THRESHOLD_SOFT, process.CALL_THRESHOLD_HARD)
+
+        # Shard workers are spawned afresh rather than forked, as the processing
+        # engine may already be running threads (e.g. writing out its log)
+        context = multiprocessing.get_context('spawn')
+
+        self.shard_count = shard_count
+        self.shards = {}            # company => shard
+        self.connections = []
+        self.workers = []
+        self.pending = []           # shards yet to reply to the latest batch
+        self.trades = []            # trades of batches not yet written
+        for shard in range(shard_count):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=serve, args=(shard, shard_count, shard_args, worker_connection),
+                                     daemon=True)
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def shard(self, company):
+        shard = self.shards.get(company)
+        if shard is None:
+            shard = self.shards[company] = shard_of(company, self.shard_count)
+        return shard
+
+    def receive(self, shards):
+        """
+        Replies of the given shards, every one of them is read before
+        raising on a failed shard, so that later replies stay in step
+        """
+        replies = [self.connections[shard].recv() for shard in shards]
+        for shard, reply in zip(shards, replies):
+            if isinstance(reply, Exception):
+                raise RuntimeError("Shard " + str(shard) + " failed") from reply
+        return replies
+
+    def request(self, command, value=None):
+        """
+        Sends a command to every shard, then waits for all of their replies
+        """
+        self.collect()
+        for connection in self.connections:
+            connection.send((command, value))
+        return self.receive(range(self.shard_count))
+
+    def collect(self):
+        """
+        Waits for the shards still merging the latest batch, keeping their trades
+        """
+        pending, self.pending = self.pending, []
+        self.trades.extend(chain.from_iterable(self.receive(pending)))
+
+    def add_batch(self, batch_companies):
+        """
+        Splits a batch up by shard, one dictionary per tweet as in
+        process.add_batch_state, and hands each shard its share
+        """
+        self.collect()
+        shard_batches = [[] for _ in range(self.shard_count)]
+        for new_companies in batch_companies:
+            shard_companies = {}
+            for company, company_information in new_companies.items():
+                shard_companies.setdefault(self.shard(company), {})[company] = company_information
+            for shard, companies in shard_companies.items():
+                shard_batches[shard].append(companies)
+
+        for shard, shard_batch in enumerate(shard_batches):
+            if shard_batch:
+                self.connections[shard].send(('batch', shard_batch))
+                self.pending.append(shard)
+
+    def weigh_trades(self, touched=None):
+        """
+        Trades of the batches merged since the last call, or of every
+        company without the companies touched, fanned in from every shard
+        """
+        self.collect()
+        if touched is None:
+            self.trades.extend(chain.from_iterable(self.request('trades')))
+        trades, self.trades = self.trades, []
+        return trades
+
+    def reset_trade_bands(self):
+        """
+        Drops the trades not yet written, and has every shard read its
+        latest trades again, e.g. once a batch could not be processed
+        """
+        try:
+            self.collect()
+        except RuntimeError:
+            logging.exception("Trades of the last batch are dropped")
+        self.trades = []
+        self.request('reset')
+
+    def write_history(self, touched=None):
+        """
+        Shards write their history as they merge each batch, without
+        the companies touched, each writes its whole shard out instead
+        """
+        self.collect()
+        if touched is None:
+            self.request('snapshot')
+
+    def __getitem__(self, company):
+        self.collect()
+        shard = self.shard(company)
+        self.connections[shard].send(('get', company))
+        score = self.receive([shard])[0]
+        if score is None:
+            raise KeyError(company)
+        return score
+
+    def scores(self):
+        return dict(chain.from_iterable(shard_scores.items() for shard_scores in self.request('scores')))
+
+    def __iter__(self):
+        return iter(self.scores())
+
+    def __len__(self):
+        return len(self.scores())
+
+    def items(self):
+        return self.scores().items()
+
+    def close(self):
+        try:
+            self.collect()
+        finally:
+            # Shards that have already died are only waited on
+            for connection, worker in zip(self.connections, self.workers):
+                if worker.is_alive():
+                    connection.send(('stop', None))
+                worker.join()
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import collections
+import heapq
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Grabs non-application specific helper modules
+import batchfile
+import engine
+import process
+import scores
+
+"""
+Pluggable tweet sources for the ingestion engine, and the
+asyncio loop that streams them to the processing engine.
+
+Besides twitter itself (see ingest.py), tweets may be replayed
+from input files, or from a local replay server over TCP, so that
+the whole ingestion loop can be load-tested without network access
+"""
+
+# Tweets read ahead of the processing engine before the source is held back
+MAX_PENDING_TWEETS = 1000
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8765
+
+# Seconds a merged source waits on its quiet sources before letting buffered tweets through out of turn
+MERGE_DELAY = 1.0
+
+# Tweets remembered by a merged source to drop a tweet delivered by more than one of its sources
+SEEN_TWEETS = 100000
+
+
+class FileSource:
+    """
+    Replays tweets from input files (tweet text|retweets+fav|timestamp)
+    or batch files, as fast as possible, or throttled to a rate of
+    tweets per second
+    """
+
+    def __init__(self, paths, rate=0, repeat=1):
+        self.paths = paths
+        self.rate = rate
+        self.repeat = repeat
+
+    def __aiter__(self):
+        return self.records()
+
+    async def records(self):
+        start = time.monotonic()
+        count = 0
+        for _ in range(self.repeat):
+            for path in self.paths:
+                for tweet in self.read(path):
+                    yield tweet
+
+                    count += 1
+                    if self.rate > 0:
+                        await asyncio.sleep(max(0.0, start + count / self.rate - time.monotonic()))
+                    else:
+                        # Lets the rest of the loop run between tweets
+                        await asyncio.sleep(0)
+
+    @staticmethod
+    def read(path):
+        if batchfile.is_batch_file(path):
+            yield from batchfile.read_batch(path)
+            return
+
+        with open(path, "r") as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield tuple(process.parse_line(line))
+
+
+class SocketSource:
+    """
+    Reads tweets, one input line each, from a replay server
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+
+    def __aiter__(self):
+        return self.records()
+
+    async def records(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield tuple(process.parse_line(line.decode('utf-8')))
+        finally:
+            writer.close()
+
+
+def shard(items, shards):
+    """
+    Splits items round-robin into the given number of shards
+    """
+    return [items[index::shards] for index in range(shards)]
+
+
+def tweet_key(tweet):
+    """
+    A tweet is keyed by its id, where its source gives one after the
+    (tweet text, retweets+fav, timestamp) record, otherwise by the whole
+    record. Retweets and other copies of a tweet are tweets of their own,
+    left to deduplication (see dedup.py)
+    """
+    return tweet[3] if len(tweet) > 3 else tuple(tweet)
+
+
+class SeenTweets:
+    """
+    Keys of the latest tweets seen, forgetting the oldest past a size
+    """
+
+    def __init__(self, size=SEEN_TWEETS):
+        self.keys = set()
+        self.order = collections.deque()
+        self.size = size
+
+    def add(self, key):
+        """
+        Returns whether the key is new
+        """
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.order.append(key)
+        if len(self.order) > self.size:
+            self.keys.discard(self.order.popleft())
+        return True
+
+
+class MergedSource:
+    """
+    Several sources (e.g. shards of the accounts followed) read side
+    by side, each into its own buffer, and merged back into a single
+    stream ordered by timestamp, without a tweet already let through
+    from another source (see tweet_key).
+
+    Tweets are let through once every source still open has one
+    buffered, so that the oldest is known to come first. A source
+    that stays quiet for longer than the merge delay is not waited
+    on any further, what is buffered is let through as it stands.
+    """
+
+    def __init__(self, sources, max_pending_tweets=MAX_PENDING_TWEETS, merge_delay=MERGE_DELAY,
+                 seen_tweets=SEEN_TWEETS):
+        self.sources = sources
+        self.max_pending_tweets = max_pending_tweets
+        self.merge_delay = merge_delay
+        self.seen_tweets = seen_tweets
+
+    def __aiter__(self):
+        return self.records()
+
+    async def records(self):
+        # Each buffer is only ever touched from the event loop, so needs no lock
+        buffers = [collections.deque() for _ in self.sources]
+        is_open = [True] * len(self.sources)
+        arrived = asyncio.Event()
+        drained = asyncio.Event()
+
+        async def read(index, source):
+            records = source.__aiter__()
+            try:
+                async for tweet in records:
+                    try:
+                        timestamp = scores.to_epoch(tweet[2])
+                    except (IndexError, ValueError):
+                        logging.warning('Dropped a tweet without a valid timestamp: %s', tweet)
+                        continue
+
+                    while len(buffers[index]) >= self.max_pending_tweets:
+                        drained.clear()
+                        await drained.wait()
+                    buffers[index].append((timestamp, tweet))
+                    arrived.set()
+            finally:
+                is_open[index] = False
+                arrived.set()
+                if hasattr(records, 'aclose'):
+                    await records.aclose()
+
+        readers = [asyncio.ensure_future(read(index, source)) for index, source in enumerate(self.sources)]
+        seen = SeenTweets(self.seen_tweets)
+        heads = []              # (timestamp, buffer index) of the first tweet of each buffer on it
+        is_queued = [False] * len(self.sources)
+        let_through = 0         # tweets to let through without waiting on quiet sources
+        duplicates = 0
+        try:
+            while True:
+                for index, buffer in enumerate(buffers):
+                    if buffer and not is_queued[index]:
+                        heapq.heappush(heads, (buffer[0][0], index))
+                        is_queued[index] = True
+
+                if heads and (let_through > 0 or all(buffer or not is_open[index]
+                                                     for index, buffer in enumerate(buffers))):
+                    _, index = heapq.heappop(heads)
+                    is_queued[index] = False
+                    _, tweet = buffers[index].popleft()
+                    drained.set()
+                    let_through = max(let_through - 1, 0)
+                    if seen.add(tweet_key(tweet)):
+                        yield tweet
+                    else:
+                        duplicates += 1
+                    continue
+
+                if not heads and not any(is_open):
+                    break
+
+                arrived.clear()
+                try:
+                    await asyncio.wait_for(arrived.wait(), self.merge_delay)
+                except asyncio.TimeoutError:
+                    let_through = sum(len(buffer) for buffer in buffers)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            logging.info('Merged sources dropped %d tweets delivered more than once', duplicates)
+
+
+async def serve_replay(source, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Starts a local replay server, streaming the tweets of
+    the given source to each client that connects
+    """
+    async def replay(reader, writer):
+        try:
+            async for tweet in source:
+                writer.write(('|'.join(str(field) for field in tweet) + '\n').encode('utf-8'))
+                # Held back by the client, as a stream connection would be
+                await writer.drain()
+        except ConnectionError:
+            logging.info("Replay client disconnected")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(replay, host, port)
+
+
+async def stream_to_engine(source, processing_engine, max_batch_size=engine.MAX_BATCH_SIZE,
+                           max_pending_tweets=MAX_PENDING_TWEETS):
+    """
+    Reads tweets off the source into a bounded queue, and hands
+    them to the processing engine in batches of whatever has
+    arrived since the last one. Handing over (which blocks while
+    the engine is behind) runs on a separate thread, so that the
+    source keeps being read in the meantime.
+
+    Returns the number of tweets processed once the source ends.
+    """
+    loop = asyncio.get_running_loop()
+    tweets = asyncio.Queue(max_pending_tweets)
+    executor = ThreadPoolExecutor(1)
+
+    async def produce():
+        try:
+            async for tweet in source:
+                await tweets.put(tweet)
+        finally:
+            await tweets.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    count = 0
+    try:
+        tweet = None
+        while True:
+            batch = []
+            tweet = await tweets.get()
+            while tweet is not None:
+                batch.append(tweet)
+                if len(batch) >= max_batch_size or tweets.empty():
+                    break
+                tweet = tweets.get_nowait()
+
+            if batch:
+                await loop.run_in_executor(executor, processing_engine.submit, batch)
+                count += len(batch)
+                logging.debug('Handed %d tweets to the processing engine', len(batch))
+
+            if tweet is None:
+                break
+
+        # Waits on the engine's acknowledgement rather than polling it
+        await loop.run_in_executor(executor, processing_engine.wait)
+        await producer
+    finally:
+        producer.cancel()
+        executor.shutdown(wait=False)
+
+    logging.info('Source ended after %d tweets', count)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local replay server for the ingestion engine')
+    parser.add_argument("files", nargs='+', help="input files to replay (tweet text|retweets+fav|timestamp)")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--rate", type=float, default=0, help="tweets per second, 0 for as fast as possible")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to replay the files")
+    args = parser.parse_args()
+
+    async def serve():
+        server = await serve_replay(FileSource(args.files, args.rate, args.repeat), args.host, args.port)
+        print('Replaying tweets on ' + args.host + ':' + str(args.port))
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
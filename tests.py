@@ -1,9 +1,32 @@
 # Testing suite for the application
+import glob
 import shutil
 import os
+import math
+import queue
+import asyncio
+import itertools
+import random
+
+import numpy
+import pytest
+from textblob import TextBlob
 
 import process
+import backtest
+import batchfile
+import dedup
 import helper
+import engine
+import matcher
+import profiling
+import scores
+import sentiment
+import shards
+import sources
+import trade
+import windows
+from engine import ProcessingEngine
 
 
 def test_history_read_0():
@@ -99,6 +122,1082 @@ def test_history_read_3():
     os.remove(process.HISTORY_FILE)
 
 
+def test_history_read_4():
+    """
+    Test to handle a history log on top of a snapshot:
+        - Committed batches are replayed over the snapshot
+        - A batch torn part way through is discarded, not the whole state
+        - History file: 3
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/test_history_3', process.HISTORY_FILE)
+    viability_scores, aliases = process.read_history()
+
+    touched = set()
+    new_companies = {'NYSE: GM': (0.5, 10.0, '2017-04-12T08:42:37.315456')}
+    viability_scores = process.add_new_state(viability_scores, new_companies, touched)
+    process.write_history(viability_scores, aliases, touched)
+
+    with open(process.HISTORY_LOG_FILE, "a") as history_log:
+        history_log.write('score, NASDAQ: AMD, 500.0, 1')
+
+    # Actual application test
+    viability_scores, aliases = process.read_history()
+
+    assert(viability_scores['NYSE: GM'] == (205.0, 30.0, '2017-04-12T08:42:37.315456'))
+    assert(viability_scores['NASDAQ: AMD'] == (float(-200), 100, '2017-04-11T08:42:37.315756'))
+    assert(len(aliases.keys()) == 10)
+
+    # Torn batch has been cut off the log
+    with open(process.HISTORY_LOG_FILE, "r") as history_log:
+        assert(history_log.read().endswith('commit, 1\n'))
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_history_write_0():
+    """
+    Test compacting the history log into the history snapshot
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/test_history_3', process.HISTORY_FILE)
+    viability_scores, aliases = process.read_history()
+
+    # Actual application test
+    process.write_history(viability_scores, aliases, set(viability_scores.keys()))
+    assert(os.path.isfile(process.HISTORY_LOG_FILE))
+
+    process.write_history(viability_scores, aliases)
+    assert(not os.path.isfile(process.HISTORY_LOG_FILE))
+    assert(process.read_history() == (viability_scores, aliases))
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_write_trades_0():
+    """
+    Test writing trades incrementally:
+        - Only companies touched by the batch are traded
+        - Trades are only appended when a company moves into another band
+        - Falling back into no trade takes the company flat, re-entering a band trades again
+        - Latest trades are read back from the trade file by a new process
+    """
+
+    # Setup
+    helper.cleanup()
+    viability_scores = {'NYSE: GM': (-100.0, 10.0, '2017-04-11T08:42:37.315456'),
+                        'NASDAQ: AMD': (-200.0, 10.0, '2017-04-11T08:42:37.315456')}
+
+    # Actual application test
+    process.write_trades(viability_scores, {'NYSE: GM'})
+    process.write_trades(viability_scores, {'NYSE: GM'})
+    viability_scores['NYSE: GM'] = (0.0, 20.0, '2017-04-11T08:43:37.315456')
+    process.write_trades(viability_scores, {'NYSE: GM'})
+
+    process.TRADE_BANDS = None
+    viability_scores['NYSE: GM'] = (-100.0, 30.0, '2017-04-11T08:44:37.315456')
+    process.write_trades(viability_scores, {'NYSE: GM'})
+    process.write_trades(viability_scores, {'NASDAQ: AMD'})
+    viability_scores['NYSE: GM'] = (-300.0, 40.0, '2017-04-11T08:45:37.315456')
+    process.write_trades(viability_scores, {'NYSE: GM'})
+
+    with open(process.TRADE_FILE, "r") as trade_file:
+        assert(trade_file.read().splitlines() == ['put, NYSE: GM, soft, 2017-04-11T08:42:37.315456',
+                                                  'no, NYSE: GM, trade, 2017-04-11T08:43:37.315456',
+                                                  'put, NYSE: GM, soft, 2017-04-11T08:44:37.315456',
+                                                  'put, NASDAQ: AMD, hard, 2017-04-11T08:42:37.315456',
+                                                  'put, NYSE: GM, hard, 2017-04-11T08:45:37.315456'])
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_write_trades_1():
+    """
+    Test banding scores for trades:
+        - Banded on and between every band edge, by default those set
+        - A column of band edges bands the scores once per row, as the backtest sweeps them
+        - Hard calls are traded
+        - Band edges can be set
+    """
+
+    # Setup
+    helper.cleanup()
+    thresholds = (process.PUT_THRESHOLD_HARD, process.PUT_THRESHOLD_SOFT,
+                  process.CALL_THRESHOLD_SOFT, process.CALL_THRESHOLD_HARD)
+    values = numpy.array([-1000.0, -150.0, -149.0, -50.0, 0.0, 50.0, 51.0, 150.0, 151.0, 1000.0])
+    viability_scores = {'NYSE: GM': (200.0, 10.0, '2017-04-11T08:42:37.315456'),
+                        'NASDAQ: AMD': (100.0, 10.0, '2017-04-11T08:42:37.315456')}
+
+    # Actual application test
+    assert(process.band_lots(values).tolist() == [-2, -1, -1, 0, 0, 0, 1, 1, 2, 2])
+    assert(numpy.array_equal(process.band_lots(values, thresholds), process.band_lots(values)))
+    swept = process.band_lots(values, [numpy.array([[-150.0], [-1000.0]]), numpy.array([[-50.0], [-100.0]]),
+                                       numpy.array([[50.0], [100.0]]), numpy.array([[150.0], [1000.0]])])
+    assert(swept.tolist() == [[-2, -1, -1, 0, 0, 0, 1, 1, 2, 2], [-1, -1, -1, 0, 0, 0, 0, 1, 1, 1]])
+
+    process.write_trades(viability_scores)
+    process.set_thresholds(helper.parse_thresholds('-300,-100,100,300'))
+    viability_scores['NASDAQ: AMD'] = (150.0, 10.0, '2017-04-11T08:43:37.315456')
+    process.write_trades(viability_scores, {'NYSE: GM', 'NASDAQ: AMD'})
+
+    with open(process.TRADE_FILE, "r") as trade_file:
+        assert(trade_file.read().splitlines() == ['call, NYSE: GM, hard, 2017-04-11T08:42:37.315456',
+                                                  'call, NASDAQ: AMD, soft, 2017-04-11T08:42:37.315456',
+                                                  'call, NYSE: GM, soft, 2017-04-11T08:42:37.315456'])
+
+    # Teardown
+    process.set_thresholds(thresholds)
+    helper.cleanup()
+
+
+def test_write_trades_2():
+    """
+    Test keeping the latest trades with the history:
+        - Trades, and the history log, are written in order of company
+        - Latest trades are read back with the history, both from the log and from the snapshot
+        - A new process only trades companies that moved into another band, the trade file aside
+    """
+
+    # Setup
+    helper.cleanup()
+    viability_scores = {'NYSE: GM': (-100.0, 10.0, '2017-04-11T08:42:37.315456'),
+                        'NASDAQ: AMD': (-200.0, 10.0, '2017-04-11T08:42:37.315456'),
+                        'NASDAQ: TSLA': (0.0, 10.0, '2017-04-11T08:42:37.315456')}
+    touched = {'NYSE: GM', 'NASDAQ: AMD', 'NASDAQ: TSLA'}
+
+    # Actual application test
+    process.write_trades(viability_scores, touched)
+    process.write_history(viability_scores, {}, touched)
+    with open(process.TRADE_FILE, "r") as trade_file:
+        assert(trade_file.read().splitlines() == ['put, NASDAQ: AMD, hard, 2017-04-11T08:42:37.315456',
+                                                  'put, NYSE: GM, soft, 2017-04-11T08:42:37.315456'])
+    with open(process.HISTORY_LOG_FILE, "r") as history_log:
+        assert([line.split(', ')[:2] for line in history_log.read().splitlines()]
+               == [['score', 'NASDAQ: AMD'], ['score', 'NASDAQ: TSLA'], ['score', 'NYSE: GM'],
+                   ['band', 'NASDAQ: AMD'], ['band', 'NYSE: GM'], ['commit', '5']])
+
+    os.remove(process.TRADE_FILE)
+    process.TRADE_BANDS = None
+    history_scores, _ = process.read_history()
+    assert(process.TRADE_BANDS == {'NASDAQ: AMD': -2, 'NYSE: GM': -1})
+
+    process.write_history(history_scores, {})
+    process.TRADE_BANDS = None
+    history_scores, _ = process.read_history()
+    assert(process.TRADE_BANDS == {'NASDAQ: AMD': -2, 'NYSE: GM': -1})
+
+    history_scores['NYSE: GM'] = (-300.0, 20.0, '2017-04-11T08:43:37.315456')
+    process.write_trades(history_scores, touched)
+    with open(process.TRADE_FILE, "r") as trade_file:
+        assert(trade_file.read().splitlines() == ['put, NYSE: GM, hard, 2017-04-11T08:43:37.315456'])
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_database_0():
+    """
+    Test the SQLite state store:
+        - History file is imported the first time it is used
+        - Single tweet, single company (Tesla), written as one batch
+        - Scores are looked up without reading the whole state in
+        - History file: base
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+
+    # Actual application test
+    process.setup_database(True)
+    viability_scores, aliases = process.read_history()
+    assert(len(aliases) == 511)
+
+    touched = set()
+    viability_scores, aliases = process.parse_input(viability_scores, aliases,
+                                                    process.TESTING_DIRECTORY + '/test_input_1', touched=touched)
+    process.write_trades(viability_scores)
+    process.write_history(viability_scores, aliases, touched)
+    process.DATABASE.close()
+
+    process.setup_database(True)
+    viability_scores, aliases = process.read_history()
+    assert(viability_scores.rows == {})
+    assert('TSLA' in viability_scores)
+    assert('GM' not in viability_scores)
+    assert(abs(viability_scores['TSLA'][1] - math.log(1000000)) < 1e-9)
+    assert(process.DATABASE.execute('SELECT COUNT(*) FROM trades').fetchone()[0] == 0)
+
+    # Teardown
+    process.DATABASE.close()
+    process.setup_database(False)
+    helper.cleanup()
+
+
+def test_engine_1():
+    """
+    Test grouping streamed tweets into micro-batches:
+        - Batches are capped, and cut short by a flush
+        - Remaining tweets are processed before stopping
+    """
+
+    # Setup
+    tweet_queue = queue.Queue()
+    for item in [('a', 1, 't')] * 5 + [engine.FLUSH] + [('b', 1, 't')] * 2 + [None]:
+        tweet_queue.put(item)
+
+    # Actual application test
+    batches = [(len(tweets), is_flush) for tweets, is_flush in engine.stream_batches(tweet_queue, 3)]
+    assert(batches == [(3, False), (2, True), (2, False)])
+
+
+def test_batchfile_0():
+    """
+    Test the columnar batch format:
+        - Records come back as they went in, including non-ASCII texts, pipes and newlines
+        - Records are looked up off the batch's columns, without unpacking the whole batch
+        - A batch file is scored the same as the input file it was converted from
+    """
+
+    # Setup
+    tweets = [('Tesla is doing an amazing job this quarter!', 1000000, '2017-04-11T08:42:37.315456'),
+              ('Tesla|GM über alles\nüber alles', 3, '2017-04-11T08:42:38')]
+    input_file = process.TESTING_DIRECTORY + '/test_input_3'
+    batchfile.write_batch('.app.batch', batchfile.read_tweets(input_file))
+    aliases = matcher.AliasMatcher({'Tesla': 'TSLA', 'GM': 'GM'})
+
+    # Actual application test
+    assert(list(batchfile.unpack(batchfile.pack(tweets))) == tweets)
+    assert(list(batchfile.unpack(batchfile.pack(tweets[:1]))) == tweets[:1])
+    batch = batchfile.unpack(batchfile.pack(tweets))
+    assert(len(batch) == 2 and batch[1] == tweets[1] and batch[-1:] == tweets[-1:])
+    assert(batch.texts == [tweet[0] for tweet in tweets])
+    assert(batchfile.is_batch_file('.app.batch') and not batchfile.is_batch_file(input_file))
+
+    batch_scores, _ = process.parse_input(scores.ScoreTable(), aliases, '.app.batch')
+    text_scores, _ = process.parse_input(scores.ScoreTable(), aliases, input_file)
+    assert(dict(batch_scores) == dict(text_scores))
+
+    # Teardown
+    os.remove('.app.batch')
+
+
+def test_batchfile_1():
+    """
+    Test timestamps handed over in the batch format:
+        - Whole seconds come back without a fraction, as they went in
+        - Formatted in bulk as each one is formatted on its own
+    """
+
+    # Setup
+    tweets = [('Tesla is amazing', 10, '2017-04-11T08:00:00'),
+              ('GM is terrible', 20, '2017-04-11T08:00:00.000001'),
+              ('AMD is fine', 30, '1969-12-31T23:59:59')]
+    epochs = [scores.to_epoch(tweet[2]) for tweet in tweets] + [0, -1, 1500000000123000]
+
+    # Actual application test
+    assert(list(batchfile.unpack(batchfile.pack(tweets))) == tweets)
+    assert(scores.from_epochs(epochs) == [scores.from_epoch(epoch) for epoch in epochs])
+
+
+def test_ingest_0():
+    """
+    Test the ingestion loop end to end, without network access:
+        - Tesla input replayed twice from a file source
+        - Tweets streamed through the resident engine
+        - History file: base
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+    source = sources.FileSource([process.TESTING_DIRECTORY + '/test_input_1'], repeat=2)
+
+    # Actual application test
+    engine = ProcessingEngine().start()
+    count = asyncio.run(sources.stream_to_engine(source, engine))
+    engine.stop()
+
+    viability_scores, aliases = process.read_history()
+
+    assert(count == 2)
+    assert(list(viability_scores.keys()) == ['TSLA'])
+    assert(abs(viability_scores['TSLA'][1] - 2 * math.log(1000000)) < 1e-9)
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_ingest_1():
+    """
+    Test replaying tweets over a local replay server:
+        - Same tweets come out as from the file itself
+    """
+
+    # Setup
+    source = sources.FileSource([process.TESTING_DIRECTORY + '/test_input_5'])
+
+    async def replay():
+        server = await sources.serve_replay(source, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        replayed = [tweet async for tweet in sources.SocketSource('127.0.0.1', port)]
+        server.close()
+        await server.wait_closed()
+        return replayed
+
+    async def read():
+        return [tweet async for tweet in source]
+
+    # Actual application test
+    expected = asyncio.run(read())
+    assert(len(expected) > 0)
+    assert(asyncio.run(replay()) == expected)
+
+
+def test_ingest_2():
+    """
+    Test merging sharded sources, one of them a local replay server:
+        - Tweets come out in timestamp order across the shards
+        - A tweet delivered by more than one shard is only let through once
+        - Retweets, and tweets that only share their text, are let through
+    """
+
+    # Setup
+    with open('.app.shard_0', "w") as shard_file:
+        shard_file.write('Tesla is amazing|10|2017-04-11T08:00:00\nGM is terrible|5|2017-04-11T08:02:00\n'
+                         'RT @elonmusk: Tesla is amazing|12|2017-04-11T08:03:00\n')
+    with open('.app.shard_1', "w") as shard_file:
+        shard_file.write('AMD is on fire|7|2017-04-11T08:01:00\nGM is terrible|5|2017-04-11T08:02:00\n'
+                         'Tesla quarter looks great|3|2017-04-11T08:04:00\nTesla is amazing|2|2017-04-11T08:05:00\n')
+
+    async def merge():
+        server = await sources.serve_replay(sources.FileSource(['.app.shard_1']), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        merged = sources.MergedSource([sources.FileSource(['.app.shard_0']), sources.SocketSource('127.0.0.1', port)])
+        tweets = [tweet async for tweet in merged]
+        server.close()
+        await server.wait_closed()
+        return tweets
+
+    # Actual application test
+    tweets = asyncio.run(merge())
+
+    assert([tweet[0] for tweet in tweets] == ['Tesla is amazing', 'AMD is on fire', 'GM is terrible',
+                                              'RT @elonmusk: Tesla is amazing', 'Tesla quarter looks great',
+                                              'Tesla is amazing'])
+    assert(sources.tweet_key(('GM is terrible', 5, '2017-04-11T08:02:00', '42')) == '42')
+    assert(sources.shard(['a', 'b', 'c'], 2) == [['a', 'c'], ['b']])
+
+    # Teardown
+    os.remove('.app.shard_0')
+    os.remove('.app.shard_1')
+
+
+def test_scores_0():
+    """
+    Test the column-wise score table against a plain dictionary:
+        - Same scores, weights and timestamps after a batch
+        - Companies repeated within the batch, and deleted after it
+    """
+
+    # Setup
+    batch_companies = [
+        {'NYSE: GM': (0.5, math.log(10), '2017-04-11T08:42:37.315456')},
+        {'NYSE: GM': (-0.25, math.log(200), '2017-04-11T08:42:38'),
+         'NASDAQ: TSLA': (0.8, math.log(3), '2017-04-11T08:42:38')},
+        {},
+        {'NYSE: GM': (0.1, math.log(7), '2017-04-11T08:42:39.000001')},
+    ]
+    expected = process.add_batch_state({'NYSE: UAL': (300.0, 60.0, '2017-04-11T08:42:37.315656')}, batch_companies)
+
+    # Actual application test
+    table = scores.ScoreTable({'NYSE: UAL': (300.0, 60.0, '2017-04-11T08:42:37.315656')})
+    touched = set()
+    table = process.add_batch_state(table, batch_companies, touched)
+
+    assert(table == expected)
+    assert(touched == {'NYSE: GM', 'NASDAQ: TSLA'})
+
+    del table['NYSE: UAL']
+    del expected['NYSE: UAL']
+    assert(table == expected)
+    assert(list(table.keys()) == ['NASDAQ: TSLA', 'NYSE: GM'])
+
+
+def test_profiling_0():
+    """
+    Test per-stage timing of a batch:
+        - Every tweet has a latency, only scored tweets count companies
+        - Stages run over the batch are timed
+    """
+
+    # Setup
+    aliases = matcher.AliasMatcher({'Tesla': 'TSLA', 'GM': 'GM'})
+    tweets = [('Tesla and GM are doing well', 10, '2017-04-11T08:42:37'),
+              ('Nothing to see here', 10, '2017-04-11T08:42:38'),
+              ('Tesla is bad', 10, '2017-04-11T08:42:39')]
+
+    # Actual application test
+    metrics = profiling.start_batch()
+    process.parse_tweets(scores.ScoreTable(), aliases, tweets)
+    summary = metrics.summary()
+    profiling.METRICS = None
+
+    assert(summary['tweets'] == 3)
+    assert(summary['companies'] == 3)
+    assert(sum(summary['tweet_latency_histogram_us'].values()) == 3)
+    assert(summary['stages']['extraction'] > 0)
+    assert(summary['stages']['state merge'] > 0)
+    assert(summary['stages']['history write'] == 0)
+
+
+def test_normalise_0():
+    """
+    Test normalising tweets for alias matching and sentiment:
+        - Links, @mentions and punctuation are removed
+        - A batch gives the same as normalising one tweet at a time
+    """
+
+    # Setup
+    tweets = ["RT @elon_musk: $TSLA's Model 3 is great!! https://t.co/abc123?x=1 via www.cnbc.com/tesla",
+              "AT&T and Coca-Cola, not bad... #NYSE",
+              "Two\nlines @GM",
+              ""]
+
+    # Actual application test
+    assert(helper.normalise_tweet(tweets[0]) == (
+        ['RT', 'TSLA', 's', 'Model', '3', 'is', 'great', 'via'], 'RT TSLA s Model 3 is great via'))
+    assert(helper.retweeted_tokens(helper.normalise_tweet(tweets[0])[0]) ==
+           ['TSLA', 's', 'Model', '3', 'is', 'great', 'via'])
+    assert(helper.sanitise_tweet(tweets[1]) == 'AT T and Coca Cola not bad NYSE')
+    assert(helper.normalise_tweets(tweets) == [helper.normalise_tweet(tweet) for tweet in tweets])
+    assert(helper.normalise_tweets(tweets[:2]) == [helper.normalise_tweet(tweet) for tweet in tweets[:2]])
+    assert(helper.normalise_tweets([]) == [])
+
+
+def test_logging_0():
+    """
+    Test sampling which tweets have their details logged:
+        - One in every LOG_SAMPLE_RATE tweets, starting with the first
+    """
+
+    # Setup
+    sample_rate = helper.LOG_SAMPLE_RATE
+    helper.LOG_SAMPLE_RATE = 3
+    helper.LOGGED_TWEETS = iter(range(7))
+
+    # Actual application test
+    assert([helper.is_sampled() for _ in range(7)] == [True, False, False, True, False, False, True])
+
+    # Teardown
+    helper.LOG_SAMPLE_RATE = sample_rate
+    helper.LOGGED_TWEETS = itertools.count()
+
+
+def test_logging_1():
+    """
+    Test what the processing engine writes to its log file:
+        - Each record formatted once, level and logger ahead of the message
+    """
+
+    # Setup
+    helper.cleanup()
+
+    # Actual application test
+    assert(helper.run_processing_engine(process.TESTING_DIRECTORY + '/test_input_1') == 0)
+    with open(max(glob.glob(process.LOGGING_DIRECTORY + '/*.log')), "r") as log_file:
+        lines = log_file.read().splitlines()
+
+    assert(lines[0] == 'INFO:root:Logging is now setup')
+    assert(not any(line.count(':root:') > 1 for line in lines))
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_decay_0():
+    """
+    Test exponentially decaying viability scores, with a half-life of a minute:
+        - A score is halved a minute on, and a late tweet is decayed on its way in
+        - Same scores whether added in one batch or tweet by tweet
+    """
+
+    # Setup
+    process.HALF_LIFE = 60
+    batch_companies = [
+        {'TSLA': (1.0, 1.0, '2017-04-11T08:00:00')},
+        {'TSLA': (1.0, 1.0, '2017-04-11T08:01:00'), 'GM': (-1.0, 4.0, '2017-04-11T08:01:00')},
+        {'TSLA': (1.0, 2.0, '2017-04-11T08:00:30')},
+    ]
+    expected_score = 1.0 * 0.5 + 1.0 + 2.0 * 2 ** -0.5
+
+    # Actual application test
+    table = process.add_batch_state(scores.ScoreTable(), batch_companies)
+    plain = {}
+    for new_companies in batch_companies:
+        plain = process.add_new_state(plain, new_companies)
+
+    for viability_scores in (table, plain):
+        assert(abs(viability_scores['TSLA'][0] - expected_score) < 1e-12)
+        assert(viability_scores['TSLA'][2] == '2017-04-11T08:01:00')
+        decayed_scores = process.current_scores(viability_scores, '2017-04-11T08:02:00')
+        assert(abs(decayed_scores['TSLA'] - expected_score / 2) < 1e-12)
+        assert(abs(decayed_scores['GM'] + 2.0) < 1e-12)
+
+    # Teardown
+    process.HALF_LIFE = None
+
+
+def test_dedup_0():
+    """
+    Test folding copies of recent tweets into them rather than scoring them again:
+        - A retweet is an exact copy, a tweet with a word added a near copy, across batches
+        - Copies raise their original's weight to ln of the retweets+fav of every copy
+    """
+
+    # Setup
+    process.DEDUP = dedup.DedupIndex()
+    aliases = matcher.AliasMatcher({'Tesla': 'TSLA'})
+    original = 'Tesla is doing an amazing job this quarter!'
+    different = 'Tesla is doing a terrible job this quarter'
+
+    # Actual application test
+    viability_scores, _ = process.parse_tweets(scores.ScoreTable(), aliases, [
+        (original, 100, '2017-04-11T08:00:00'),
+        ('RT @elonmusk: ' + original + ' https://t.co/abc', 50, '2017-04-11T08:01:00')])
+    viability_scores, _ = process.parse_tweets(viability_scores, aliases, [
+        (original + ' Wow', 50, '2017-04-11T08:02:00'),
+        (different, 10, '2017-04-11T08:03:00')])
+
+    score, weight, timestamp = viability_scores['TSLA']
+    expected_score = (process.get_tweet_sentiment(original) * math.log(200)
+                      + process.get_tweet_sentiment(different) * math.log(10))
+    assert(process.DEDUP.copies == 2)
+    assert(len(process.DEDUP) == 2)
+    assert(abs(weight - (math.log(200) + math.log(10))) < 1e-9)
+    assert(abs(score - expected_score) < 1e-9)
+    assert(timestamp == '2017-04-11T08:03:00')
+
+    # Teardown
+    process.DEDUP = None
+
+
+def test_dedup_1():
+    """
+    Test a near copy naming another company is not folded into its original:
+        - The same sentence about Tesla, then about Ford, scores both companies
+    """
+
+    # Setup
+    process.DEDUP = dedup.DedupIndex()
+    aliases = matcher.AliasMatcher({'Tesla': 'TSLA', 'Ford': 'F'})
+    sentence = ' is doing an amazing job with its new cars this quarter, shares are flying right now'
+
+    # Actual application test
+    viability_scores, _ = process.parse_tweets(scores.ScoreTable(), aliases, [
+        ('Tesla' + sentence, 100, '2017-04-11T08:00:00'),
+        ('Ford' + sentence, 100, '2017-04-11T08:01:00')])
+
+    assert(process.DEDUP.copies == 0)
+    assert(sorted(viability_scores) == ['F', 'TSLA'])
+    assert(viability_scores['F'][0] == viability_scores['TSLA'][0])
+
+    # Teardown
+    process.DEDUP = None
+
+
+def test_dedup_2():
+    """
+    Test copies are matched on the same normalised tweets that are scored:
+        - Each batch is normalised once, not again for scoring
+        - Scores identical across a worker pool
+    """
+
+    # Setup
+    aliases = matcher.AliasMatcher({'Tesla': 'TSLA', 'Ford': 'F'})
+    tweets = [('Tesla is doing an amazing job this quarter!', 100, '2017-04-11T08:00:00'),
+              ('RT @elonmusk: Tesla is doing an amazing job this quarter!', 50, '2017-04-11T08:01:00'),
+              ('Ford is doing a terrible job this quarter', 10, '2017-04-11T08:02:00'),
+              ('Ford cars are fine', 20, '2017-04-11T08:03:00')]
+    normalise_tweets = helper.normalise_tweets
+    batches = []
+
+    def counted_normalise_tweets(some_strings):
+        batches.append(len(some_strings))
+        return normalise_tweets(some_strings)
+
+    # Actual application test
+    process.DEDUP = dedup.DedupIndex()
+    helper.normalise_tweets = counted_normalise_tweets
+    try:
+        serial_scores, _ = process.parse_tweets(scores.ScoreTable(), aliases, tweets)
+    finally:
+        helper.normalise_tweets = normalise_tweets
+
+    assert(batches == [len(tweets)])
+    assert(process.DEDUP.copies == 1)
+
+    process.DEDUP = dedup.DedupIndex()
+    with process.create_worker_pool(2, aliases) as pool:
+        parallel_scores, _ = process.parse_tweets(scores.ScoreTable(), aliases, tweets, pool)
+
+    assert(sorted(serial_scores) == ['F', 'TSLA'])
+    assert(dict(parallel_scores.items()) == dict(serial_scores.items()))
+
+    # Teardown
+    process.DEDUP = None
+
+
+def test_windows_0():
+    """
+    Test rolling windows against summing every tweet within them:
+        - Tweets over two hours, some out of order, over several batches
+        - Tweets past the window are dropped, whichever order they came in
+    """
+
+    # Setup
+    generator = random.Random(0)
+    start = scores.to_epoch('2017-04-11T08:00:00')
+    tweets = []
+    for _ in range(2000):
+        timestamp = scores.from_epoch(start + generator.randint(0, 2 * 3600 * 1000000))
+        tweets.append({generator.choice(['TSLA', 'GM', 'AMD']): (generator.uniform(-1, 1), generator.uniform(0, 5),
+                                                               timestamp)})
+
+    # Actual application test
+    rolling_windows = windows.RollingWindows()
+    for batch in range(0, len(tweets), 300):
+        rolling_windows.add_batch(tweets[batch:batch + 300])
+
+    for horizon, seconds in windows.HORIZONS.items():
+        width = seconds * 1000000 // windows.BUCKETS
+        current = rolling_windows.latest // width
+        momentum = rolling_windows.momentum(horizon)
+        for company in ['TSLA', 'GM', 'AMD']:
+            expected_score = expected_weight = 0.0
+            for new_companies in tweets:
+                if company in new_companies:
+                    score, weight, timestamp = new_companies[company]
+                    if current - windows.BUCKETS < scores.to_epoch(timestamp) // width <= current:
+                        expected_score += score * weight
+                        expected_weight += weight
+
+            window_score, window_weight = rolling_windows.window(company, horizon)
+            assert(abs(window_score - expected_score) < 1e-9)
+            assert(abs(window_weight - expected_weight) < 1e-9)
+            assert(abs(momentum[company] - expected_score) < 1e-9)
+
+
+def test_windows_1():
+    """
+    Test trading on momentum:
+        - Only the companies a batch touched are weighed
+        - A company falling out of the window keeps its latest trade
+        - Turned down for a single run of process.py
+    """
+
+    # Setup
+    helper.cleanup()
+    process.setup(helper.parse_args(['--momentum', '1m']))
+    viability_scores = scores.ScoreTable()
+
+    # Actual application test
+    for new_companies in [{'NASDAQ: TSLA': (1.0, 100.0, '2017-04-11T08:00:00')},
+                          {'NYSE: GM': (-1.0, 100.0, '2017-04-11T08:05:00')}]:
+        touched = set()
+        viability_scores = process.add_new_state(viability_scores, new_companies, touched)
+        process.write_trades(viability_scores, touched)
+
+    with open(process.TRADE_FILE, "r") as trade_file:
+        assert(trade_file.read().splitlines() == ['call, NASDAQ: TSLA, soft, 2017-04-11T08:00:00',
+                                                  'put, NYSE: GM, soft, 2017-04-11T08:05:00'])
+    with pytest.raises(SystemExit):
+        helper.parse_args(['--momentum', '1m'], is_resident=False)
+
+    # Teardown
+    process.setup(helper.parse_args([]))
+    helper.cleanup()
+
+
+def test_trade_0():
+    """
+    Test paper trading on signals against a price file:
+        - Each signal trades into its position, at the price as of the signal
+        - Gains/losses marked to market at the end of each hour
+    """
+
+    # Setup
+    with open('.app.prices', "w") as price_file:
+        price_file.write('timestamp,company,price\n'
+                         '2017-04-11T08:00:00,TSLA,100\n2017-04-11T08:30:00,TSLA,110\n'
+                         '2017-04-11T09:00:00,TSLA,120\n2017-04-11T09:10:00,TSLA,115\n'
+                         '2017-04-11T08:00:00,GM,50\n2017-04-11T09:00:00,GM,45\n'
+                         '2017-04-11T08:00:00,UAL,70\n')
+    signals = trade.Signals.from_trades([
+        ('call', 'TSLA', 'soft', '2017-04-11T08:00:00'),
+        ('put', 'TSLA', 'soft', '2017-04-11T09:10:00'),
+        ('put', 'GM', 'hard', '2017-04-11T08:10:00'),
+        ('call', 'TSLA', 'hard', '2017-04-11T08:30:00'),
+        ('call', 'TSLA', 'hard', '2017-04-11T08:40:00'),
+        ('call', 'AMD', 'soft', '2017-04-11T08:40:00'),
+    ])
+
+    # Actual application test
+    price_book = trade.read_prices('.app.prices', signals.companies)
+    portfolio = trade.Portfolio(signals.companies, 100000.0, 100)
+    fills = portfolio.execute(signals, price_book)
+    starts, fill_counts, gains, values = trade.segment_gains(fills, price_book, 100000.0, 3600)
+
+    assert(len(fills) == 4)
+    assert(dict(zip(signals.companies, portfolio.positions)) == {'AMD': 0, 'GM': -200, 'TSLA': -100})
+    assert(portfolio.cash == 123500.0)
+    assert([trade.format_timestamp(start) for start in starts] == ['2017-04-11T08:00:00.000000',
+                                                                   '2017-04-11T09:00:00.000000'])
+    assert(list(fill_counts) == [3, 1])
+    assert(list(gains) == [1000.0, 2000.0])
+    assert(list(values) == [101000.0, 103000.0])
+
+    # Teardown
+    os.remove('.app.prices')
+
+
+def test_backtest_0():
+    """
+    Test sweeping thresholds over scored events against OHLC prices:
+        - Trades on each company's cumulative score, going flat in the no trade band
+        - Events without a price are skipped, positions are marked at the latest close
+        - The current thresholds give the same gains as paper trading their signals
+    """
+
+    # Setup
+    with open('.app.prices', "w") as price_file:
+        price_file.write('timestamp,company,open,high,low,close\n'
+                         '2017-04-11T08:00:00,TSLA,99,101,98,100\n2017-04-11T09:00:00,TSLA,100,111,99,110\n'
+                         '2017-04-11T10:00:00,TSLA,110,121,109,120\n'
+                         '2017-04-11T08:00:00,GM,49,51,48,50\n2017-04-11T10:00:00,GM,50,51,39,40\n')
+    events = backtest.Events.from_batches([
+        [{'TSLA': (0.5, 120.0, '2017-04-11T08:10:00')}, {'GM': (-0.5, 120.0, '2017-04-11T08:20:00')}],
+        [{'TSLA': (-0.1, 100.0, '2017-04-11T09:10:00'), 'AMD': (0.5, 100.0, '2017-04-11T09:10:00')}, {}],
+        [{'TSLA': (0.5, 220.0, '2017-04-11T09:20:00')}],
+    ])
+    events.save('.app.events.npz')
+
+    # Actual application test
+    events = backtest.Events.load('.app.events.npz')
+    price_book = trade.read_prices('.app.prices', events.companies, 'close')
+    results = backtest.Backtest(events, price_book)
+    gains, fills = results.sweep([50, 0], [150, 1000], [-50, 0], [-150, -1000])
+
+    signals = trade.Signals.from_trades([('call', 'TSLA', 'soft', '2017-04-11T08:10:00'),
+                                         ('put', 'GM', 'soft', '2017-04-11T08:20:00'),
+                                         ('no', 'TSLA', 'trade', '2017-04-11T09:10:00'),
+                                         ('call', 'TSLA', 'hard', '2017-04-11T09:20:00')])
+    signal_prices = trade.read_prices('.app.prices', signals.companies, 'close')
+    portfolio = trade.Portfolio(signals.companies, 100000.0, 100)
+    portfolio.execute(signals, signal_prices)
+    final_prices, _ = signal_prices.as_of(numpy.arange(len(signals.companies)),
+                                       numpy.full(len(signals.companies), price_book.timestamps.max()))
+
+    assert(len(events) == 5 and len(results) == 4)
+    assert(list(gains) == [4000.0, 3000.0])
+    assert(list(fills) == [4, 2])
+    assert(portfolio.cash + numpy.dot(portfolio.positions, final_prices) - 100000.0 == gains[0])
+
+    # Teardown
+    os.remove('.app.prices')
+    os.remove('.app.events.npz')
+
+
+def test_extract_0():
+    """
+    Test company extraction with multi-word aliases:
+        - "General Motors", "Activision Blizzard" & "3M Company" span words
+        - Case-folded match for company names
+        - History file: base
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+    viability_scores, aliases = process.read_history()
+
+    # Actual application test
+    tweet = "General Motors, ACTIVISION blizzard and 3M Company all beat estimates"
+    assert(process.extract_companies(tweet, aliases) == ['GM', 'ATVI', 'MMM'])
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_extract_1():
+    """
+    Test company extraction as aliases change:
+        - All-caps tickers only match exactly
+        - Aliases added/removed after the matcher was built
+    """
+
+    # Setup
+    aliases = matcher.AliasMatcher({'GM': 'NYSE: GM', 'Tesla': 'NASDAQ: TSLA'})
+
+    # Actual application test
+    assert(process.extract_companies("gm is up, so is $GM", aliases) == ['NYSE: GM'])
+
+    aliases['Tesla Motors'] = 'NASDAQ: TSLA'
+    del aliases['Tesla']
+    assert(process.extract_companies("tesla motors is up", aliases) == ['NASDAQ: TSLA'])
+    assert(process.extract_companies("tesla is up", aliases) == [])
+
+
+def test_sentiment_0():
+    """
+    Test batch sentiment scoring against TextBlob:
+        - Every test input tweet, scored as one batch
+        - Modifiers ("really") and negations ("not")
+    """
+
+    # Setup
+    tweets = []
+    for test_number in range(1, 6):
+        with open(process.TESTING_DIRECTORY + '/test_input_' + str(test_number), "r") as input_file:
+            tweets.extend(line.split('|')[0] for line in input_file)
+    tweets.append("Tesla is not really a good buy, it is seriously not bad though")
+    tweets.append("")
+    sanitised_tweets = [helper.sanitise_tweet(tweet) for tweet in tweets]
+
+    # Actual application test
+    polarities = sentiment.score_batch(sanitised_tweets)
+
+    assert(len(polarities) == len(tweets))
+    for sanitised_tweet, polarity in zip(sanitised_tweets, polarities):
+        assert(abs(polarity - TextBlob(sanitised_tweet).sentiment.polarity) < 1e-9)
+
+
+def test_sentiment_2():
+    """
+    Test the compiled lexicon:
+        - Every word, with the same polarity, intensity and flags as pattern's
+        - Tweets scored against it the same as against pattern's
+        - Only loaded while it matches the lexicon TextBlob is installed with
+    """
+
+    # Setup
+    lexicon_file = '.test.lexicon.npy'
+    pattern_lexicon = sentiment.Lexicon.from_pattern()
+    tweets = [helper.sanitise_tweet(tweet) for tweet in
+              ["Tesla is not really a good buy", "Apple is great", "Very very bad news for Google", ""]]
+
+    # Actual application test
+    pattern_lexicon.save(lexicon_file)
+    compiled_lexicon = sentiment.Lexicon.from_index(lexicon_file)
+
+    assert(set(compiled_lexicon.words) == set(pattern_lexicon.words))
+    for word, word_id in pattern_lexicon.words.items():
+        compiled_id = compiled_lexicon.words[word]
+        assert(compiled_lexicon.polarity[compiled_id] == pattern_lexicon.polarity[word_id])
+        assert(compiled_lexicon.intensity[compiled_id] == pattern_lexicon.intensity[word_id])
+        assert(compiled_lexicon.flags[compiled_id] == pattern_lexicon.flags[word_id])
+
+    previous_lexicon = sentiment.LEXICON
+    sentiment.LEXICON = compiled_lexicon
+    compiled_polarities = sentiment.score_tweets(tweets)
+    sentiment.LEXICON = pattern_lexicon
+    assert(numpy.array_equal(compiled_polarities, sentiment.score_tweets(tweets)))
+
+    sentiment.LEXICON = None
+    assert(not sentiment.is_index_current(lexicon_file))
+    assert(not isinstance(sentiment.load_lexicon(lexicon_file).flags, numpy.memmap))
+    sentiment.build_lexicon(lexicon_file)
+    sentiment.LEXICON = None
+    assert(sentiment.is_index_current(lexicon_file))
+    assert(isinstance(sentiment.load_lexicon(lexicon_file).flags, numpy.memmap))
+
+    # Teardown
+    sentiment.LEXICON = previous_lexicon
+    del compiled_lexicon
+    os.remove(lexicon_file)
+    os.remove(sentiment.source_file_name(lexicon_file))
+
+
+def test_workers_0():
+    """
+    Test scoring across a worker pool:
+        - Multiple chunks of tweets, from every test input
+        - Viability scores identical to the serial path
+        - History file: base
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+
+    lines = []
+    for test_number in range(1, 6):
+        with open(process.TESTING_DIRECTORY + '/test_input_' + str(test_number), "r") as input_file:
+            lines.extend(input_file.read().splitlines())
+    lines = lines * 100
+
+    # Actual application test
+    viability_scores, aliases = process.read_history()
+    serial_scores, _ = process.parse_lines({}, aliases, lines)
+    with process.create_worker_pool(2, aliases) as pool:
+        parallel_scores, _ = process.parse_lines({}, aliases, lines, pool)
+
+    assert(len(serial_scores) > 0)
+    assert(parallel_scores == serial_scores)
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_shards_0():
+    """
+    Test sharding the viability scores across worker processes:
+        - Shards are seeded with the scores in history
+        - Scores and trades identical to the unsharded path
+        - Each shard reads its own history back in
+        - History file: 3
+    """
+
+    # Setup
+    tweets = [("Tesla is amazing", 1000, '2017-04-12T08:42:37.315456'),
+              ("AMD is terrible and GM is awful", 5000, '2017-04-12T08:43:37.315456'),
+              ("United Airlines is great", 10, '2017-04-12T08:44:37.315456'),
+              ("AyyMD is the worst, Tesla is the best", 100000, '2017-04-12T08:45:37.315456')]
+
+    def run_batch(argv):
+        helper.cleanup()
+        shutil.copyfile(process.TESTING_DIRECTORY + '/test_history_3', process.HISTORY_FILE)
+        process.setup(helper.parse_args(argv))
+        viability_scores, aliases = process.read_history()
+        seeded_scores = dict(viability_scores.items())
+        touched = set()
+        viability_scores, aliases = process.parse_tweets(viability_scores, aliases, tweets, touched=touched)
+        process.write_trades(viability_scores, touched)
+        process.write_history(viability_scores, aliases, touched)
+        with open(process.TRADE_FILE, "r") as trade_file:
+            trades = sorted(trade_file.read().splitlines())
+        return seeded_scores, dict(viability_scores.items()), trades
+
+    # Actual application test
+    _, serial_scores, serial_trades = run_batch([])
+    seeded_scores, sharded_scores, sharded_trades = run_batch(['--state-shards', '3'])
+
+    assert(seeded_scores['NYSE: UAL'] == (300.0, 60.0, '2017-04-11T08:42:37.315656'))
+    assert(len(seeded_scores) == 4)
+    assert(sharded_scores == serial_scores)
+    assert(sharded_trades == serial_trades)
+    assert(len(serial_trades) > 0)
+    assert(process.STATE_SHARDS['NASDAQ: TSLA'] == serial_scores['NASDAQ: TSLA'])
+
+    process.STATE_SHARDS.close()
+    process.setup(helper.parse_args(['--state-shards', '3']))
+    viability_scores, aliases = process.read_history()
+    assert(set(viability_scores) == set(serial_scores))
+    for company, score in viability_scores.items():
+        assert(abs(score[0] - serial_scores[company][0]) < 1e-6)
+    assert(len(aliases) == 10)
+
+    # Teardown
+    process.STATE_SHARDS.close()
+    process.setup(helper.parse_args([]))
+    helper.cleanup()
+
+
+def test_shards_1():
+    """
+    Test a shard failing on a batch:
+        - The failure is raised, and the other shard's reply is still read
+        - Later lookups and trades get their own replies
+    """
+
+    # Setup
+    helper.cleanup()
+    process.setup(helper.parse_args(['--state-shards', '2']))
+    viability_scores, _ = process.read_history()
+    assert(shards.shard_of('NASDAQ: TSLA', 2) != shards.shard_of('NASDAQ: AMD', 2))
+
+    # Actual application test
+    process.add_batch_state(viability_scores, [{'NASDAQ: TSLA': (1.0, 1.0, 'not a timestamp'),
+                                                'NASDAQ: AMD': (200.0, 1.0, '2017-04-12T08:42:37')}])
+    with pytest.raises(RuntimeError):
+        viability_scores.weigh_trades()
+    assert(viability_scores['NASDAQ: AMD'] == (200.0, 1.0, '2017-04-12T08:42:37'))
+
+    viability_scores.reset_trade_bands()
+    process.add_batch_state(viability_scores, [{'NASDAQ: TSLA': (200.0, 1.0, '2017-04-12T08:43:37')}])
+    trades = viability_scores.weigh_trades()
+    assert(sorted(trade[1] for trade in trades) == ['NASDAQ: AMD', 'NASDAQ: TSLA'])
+
+    # Teardown
+    process.STATE_SHARDS.close()
+    process.setup(helper.parse_args([]))
+    helper.cleanup()
+
+
+def test_shards_2():
+    """
+    Test band edges set on the command line with sharded state:
+        - process.py trades the same with its scores split across 2 shards as without
+        - Input file: 1
+        - History file: base
+    """
+
+    # Setup
+    input_file = process.TESTING_DIRECTORY + '/test_input_1'
+    trades = []
+
+    # Actual application test
+    for args in ([], ['--state-shards', '2']):
+        helper.cleanup()
+        shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+        assert(helper.run_processing_engine(input_file, '--thresholds=-3,-1,1,3', *args) == 0)
+        with open(process.TRADE_FILE, "r") as trade_file:
+            trades.append(trade_file.read().splitlines())
+
+    assert(trades[0] == ['call, TSLA, hard, 2017-04-11T08:42:37.315456'])
+    assert(trades[1] == trades[0])
+
+    # Teardown
+    helper.cleanup()
+
+
+def test_sentiment_1():
+    """
+    Test the polarity cache:
+        - Repeated tweets are only scored once
+        - LRU tier is bounded by its size
+        - Disk tier survives a new cache instance
+    """
+
+    # Setup
+    helper.cleanup()
+    tweets = ["Tesla is amazing", "GM is terrible", "Tesla is amazing", "AMD is fine"]
+
+    # Actual application test
+    cache = sentiment.SentimentCache(2, process.SENTIMENT_CACHE_FILE)
+    polarities = sentiment.score_batch(tweets, cache)
+    assert(list(polarities) == list(sentiment.score_batch(tweets)))
+    assert((cache.hits, cache.misses) == (0, 3))
+    assert(len(cache.entries) == 2)
+
+    sentiment.score_batch(tweets[:1], cache)
+    assert((cache.hits, cache.disk_hits) == (1, 1))
+
+    cache = sentiment.SentimentCache(2, process.SENTIMENT_CACHE_FILE)
+    assert(list(sentiment.score_batch(tweets, cache)) == list(polarities))
+    assert((cache.hits, cache.disk_hits, cache.misses) == (3, 3, 0))
+
+    # Teardown
+    helper.cleanup()
+
+
 def test_input_0():
     """
     Test with an empty input file, should simply log and exit with error code 1
@@ -213,3 +1312,37 @@ def test_input_5():
 
     # Teardown
     helper.cleanup()
+
+
+def test_engine_0():
+    """
+    Test the resident processing engine:
+        - Two batches streamed to the same worker
+        - Single company (Tesla) in each batch
+        - State is kept in memory between batches
+        - History file: base
+    """
+
+    # Setup
+    helper.cleanup()
+    shutil.copyfile(process.TESTING_DIRECTORY + '/base_aliases', process.HISTORY_FILE)
+
+    with open(process.TESTING_DIRECTORY + '/test_input_1', "r") as input_file:
+        tweets = [process.parse_line(line) for line in input_file]
+
+    # Actual application test
+    engine = ProcessingEngine().start()
+    engine.submit(tweets)
+    engine.wait()
+    engine.submit(tweets)
+    engine.wait()
+    assert(not engine.is_busy())
+    engine.stop()
+
+    viability_scores, aliases = process.read_history()
+
+    assert(list(viability_scores.keys()) == ['TSLA'])
+    assert(abs(viability_scores['TSLA'][1] - 2 * math.log(1000000)) < 1e-9)
+
+    # Teardown
+    helper.cleanup()
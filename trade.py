@@ -0,0 +1,356 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+import numpy
+
+# Grabs non-application specific helper modules
+import database
+import process
+import scores
+
+"""
+Paper-trading engine that trades on the signals written out by
+the SA engine (put/call/no, company, soft/hard/trade, timestamp), keeping
+positions and cash as arrays, and marking them to market against
+a local price file (timestamp,company,price)
+"""
+
+TRADING_DIRECTORY = 'output/trading'
+
+# Shares per lot, a soft signal asks for one lot, a hard signal for two
+LOT_SIZE = 100
+STARTING_CASH = 100000.0
+
+# Lots of a soft signal of each kind, a 'no trade' takes the position flat
+SIGNAL_LOTS = {'put': -1, 'no': 0, 'call': 1}
+
+# Gains/losses are reported per segment of this many seconds
+SEGMENT_SECONDS = 60 * 60
+
+
+def parse_timestamps(timestamps):
+    return scores.to_epochs(timestamps)
+
+
+def format_timestamp(microseconds):
+    return str(numpy.datetime64(int(microseconds), 'us'))
+
+
+class Signals:
+    """
+    Trade signals laid out column-wise in time order, each asking
+    for a position of a number of lots in a company: calls go
+    long, puts go short, hard signals twice as far as soft ones,
+    and a 'no trade' goes flat
+    """
+
+    def __init__(self, companies, company_ids, timestamps, lots):
+        self.companies = companies      # company id => company
+        self.company_ids = company_ids
+        self.timestamps = timestamps
+        self.lots = lots
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @classmethod
+    def from_trades(cls, trades):
+        """
+        From (put/call/no, company, soft/hard/trade, timestamp) trades,
+        invalid trades are dropped
+        """
+        trades = [trade for trade in trades if len(trade) == 4 and trade[0] in SIGNAL_LOTS]
+        if not trades:
+            return cls.from_columns([], [], [], [])
+        return cls.from_columns(*zip(*trades))
+
+    @classmethod
+    def from_columns(cls, kinds, companies, strengths, timestamps):
+        if len(kinds) == 0:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return cls(numpy.array([], dtype=str), empty, empty, empty)
+
+        companies, company_ids = numpy.unique(numpy.array(companies), return_inverse=True)
+        kinds = numpy.array(kinds)
+        lots = (numpy.select([kinds == kind for kind in SIGNAL_LOTS], list(SIGNAL_LOTS.values()))
+                * numpy.where(numpy.array(strengths) == 'hard', 2, 1))
+        timestamps = parse_timestamps(timestamps)
+
+        order = numpy.argsort(timestamps, kind='stable')
+        return cls(companies, company_ids[order], timestamps[order], lots[order])
+
+
+def split_columns(text, separator, column_count):
+    """
+    Splits lines of separated fields into columns, in one pass over
+    the whole text, None if any line has the wrong number of fields
+    """
+    fields = text.replace('\n', separator).split(separator)
+    if fields[-1] == '':
+        fields.pop()
+    if len(fields) % column_count != 0:
+        return None
+    return [fields[column::column_count] for column in range(column_count)]
+
+
+def read_signals(file_name):
+    with open(file_name, "r") as trade_file:
+        text = trade_file.read()
+
+    columns = split_columns(text, ', ', 4)
+    if columns is None or not set(columns[0]) <= set(SIGNAL_LOTS):
+        # Falls back to splitting line by line, dropping the invalid ones
+        return Signals.from_trades([line.split(', ') for line in text.splitlines() if line.strip()])
+    return Signals.from_columns(*columns)
+
+
+class AsOfBook:
+    """
+    Values by (company id, timestamp), looked up as of a given
+    time: the latest value at or before it, for every lookup at once
+    """
+
+    def __init__(self, company_ids, timestamps, values):
+        order = numpy.lexsort((timestamps, company_ids))
+        self.company_ids = company_ids[order]
+        self.timestamps = timestamps[order]
+        self.values = values[order]
+
+    def as_of(self, company_ids, timestamps):
+        """
+        Returns the values as of each (company id, timestamp),
+        and whether there was one (NaN where there was not)
+        """
+        if len(self.values) == 0:
+            return numpy.full(len(timestamps), numpy.nan), numpy.zeros(len(timestamps), dtype=bool)
+
+        # Ranks every timestamp together, so that (company id, timestamp) pairs sort as single integers
+        ranks = numpy.unique(numpy.concatenate((self.timestamps, timestamps)))
+        keys = self.company_ids.astype(numpy.int64) * len(ranks) + numpy.searchsorted(ranks, self.timestamps)
+        queries = company_ids.astype(numpy.int64) * len(ranks) + numpy.searchsorted(ranks, timestamps)
+
+        index = numpy.searchsorted(keys, queries, side='right') - 1
+        clipped = numpy.maximum(index, 0)
+        found = (index >= 0) & (self.company_ids[clipped] == company_ids)
+        return numpy.where(found, self.values[clipped], numpy.nan), found
+
+
+def read_prices(file_name, companies, price_column='price'):
+    """
+    Reads a price file (timestamp,company,price, with a header line),
+    keeping only the prices of the given (sorted) companies. Columns
+    are found by their name in the header, so that e.g. the close of
+    an OHLC file (timestamp,company,open,high,low,close) may be read.
+    """
+    with open(file_name, "r") as price_file:
+        header = [name.strip().lower() for name in price_file.readline().split(',')]
+        text = price_file.read()
+
+    column_count = max(len(header), 3)
+    indices = [header.index(name) if name in header else default
+               for name, default in (('timestamp', 0), ('company', 1), (price_column, column_count - 1))]
+    columns = split_columns(text, ',', column_count)
+    if columns is None:
+        rows = [line.split(',') for line in text.splitlines()]
+        columns = list(zip(*[row for row in rows if len(row) == column_count])) or [[]] * column_count
+    if len(columns[0]) == 0 or len(companies) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return AsOfBook(empty, empty, numpy.zeros(0))
+
+    timestamps, price_companies, prices = (numpy.array(columns[index]) for index in indices)
+    company_ids = numpy.minimum(numpy.searchsorted(companies, price_companies), len(companies) - 1)
+    is_traded = companies[company_ids] == price_companies
+    return AsOfBook(company_ids[is_traded], parse_timestamps(timestamps[is_traded]),
+                    prices[is_traded].astype(numpy.float64))
+
+
+def group_by(ids):
+    """
+    Order that groups equal ids together, keeping each group in
+    its original order, and whether each grouped entry starts a group
+    """
+    order = numpy.argsort(ids, kind='stable')
+    grouped_ids = ids[order]
+    is_first = numpy.concatenate(([True], grouped_ids[1:] != grouped_ids[:-1])) if len(ids) else numpy.zeros(0, bool)
+    return order, is_first
+
+
+def grouped_cumsum(values, is_first):
+    """
+    Running totals of grouped values, starting over at each group
+    """
+    totals = numpy.cumsum(values)
+    group_starts = numpy.flatnonzero(is_first)
+    return totals - numpy.repeat((totals - values)[group_starts], numpy.diff(numpy.append(group_starts, len(totals))))
+
+
+class Fills:
+    """
+    Executed trades laid out column-wise in time order, quantities
+    are in shares, positive for buying and negative for selling
+    """
+
+    def __init__(self, company_ids, timestamps, quantities, prices):
+        self.company_ids = company_ids
+        self.timestamps = timestamps
+        self.quantities = quantities
+        self.prices = prices
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class Portfolio:
+    """
+    Paper portfolio: cash, and a position in shares per company id
+    """
+
+    def __init__(self, companies, cash=STARTING_CASH, lot_size=LOT_SIZE):
+        self.companies = companies
+        self.positions = numpy.zeros(len(companies), dtype=numpy.float64)
+        self.starting_cash = cash
+        self.cash = cash
+        self.lot_size = lot_size
+
+    def execute(self, signals, price_book):
+        """
+        Trades each company into the position each signal asks for, at
+        the price as of the signal. Signals without a price yet are skipped.
+        """
+        prices, has_price = price_book.as_of(signals.company_ids, signals.timestamps)
+        skipped = len(signals) - int(has_price.sum())
+        if skipped:
+            logging.warning('Skipped %d signals without a price', skipped)
+
+        company_ids = signals.company_ids[has_price]
+        timestamps = signals.timestamps[has_price]
+        targets = signals.lots[has_price] * float(self.lot_size)
+        prices = prices[has_price]
+        if len(targets) == 0:
+            return Fills(company_ids, timestamps, targets, prices)
+
+        # Groups signals by company, keeping them in time order, so that
+        # each trade is the difference from the company's previous position
+        order, is_first = group_by(company_ids)
+        grouped_ids = company_ids[order]
+        grouped_targets = targets[order]
+        is_last = numpy.concatenate((is_first[1:], [True]))
+        previous = numpy.roll(grouped_targets, 1)
+        previous[is_first] = self.positions[grouped_ids[is_first]]
+
+        quantities = numpy.empty_like(targets)
+        quantities[order] = grouped_targets - previous
+        self.positions[grouped_ids[is_last]] = grouped_targets[is_last]
+        self.cash -= float(numpy.dot(quantities, prices))
+
+        is_trade = quantities != 0
+        return Fills(company_ids[is_trade], timestamps[is_trade], quantities[is_trade], prices[is_trade])
+
+
+def segment_gains(fills, price_book, starting_cash, segment_seconds=SEGMENT_SECONDS, end=None):
+    """
+    Marks the portfolio to market at the end of each segment of time,
+    from the first fill up to the end (by default, the last fill).
+    Returns the segment start times, the number of fills, the
+    gains/losses and the portfolio's value at the end of each segment.
+    """
+    segment = int(segment_seconds * 1000000)
+    if len(fills) == 0:
+        empty = numpy.zeros(0)
+        return empty.astype(numpy.int64), empty.astype(numpy.int64), empty, empty
+
+    first = fills.timestamps[0] // segment * segment
+    last = fills.timestamps[-1] if end is None else max(end, fills.timestamps[-1])
+    starts = numpy.arange(first, last + 1, segment, dtype=numpy.int64)
+    ends = starts + segment - 1
+
+    # Cash as of the end of each segment
+    filled = numpy.searchsorted(fills.timestamps, ends, side='right')
+    cash = starting_cash - numpy.concatenate(([0.0], numpy.cumsum(fills.quantities * fills.prices)))[filled]
+
+    # Positions after each fill, looked up as of the end of each segment
+    order, is_first = group_by(fills.company_ids)
+    positions = AsOfBook(fills.company_ids[order], fills.timestamps[order],
+                         grouped_cumsum(fills.quantities[order], is_first))
+
+    companies = numpy.unique(fills.company_ids)
+    query_ids = numpy.tile(companies, len(ends))
+    query_times = numpy.repeat(ends, len(companies))
+    held, _ = positions.as_of(query_ids, query_times)
+    prices, _ = price_book.as_of(query_ids, query_times)
+    held = numpy.nan_to_num(held)
+    marked = numpy.where(held != 0, held * numpy.nan_to_num(prices), 0.0).reshape(len(ends), len(companies))
+
+    values = cash + marked.sum(axis=1)
+    gains = numpy.diff(numpy.concatenate(([starting_cash], values)))
+    fill_counts = numpy.diff(numpy.concatenate(([0], filled)))
+    return starts, fill_counts, gains, values
+
+
+def write_report(portfolio, fills, segments, price_book, report_file):
+    starts, fill_counts, gains, values = segments
+    lines = ['{0:<28} {1:>8} {2:>16} {3:>16}'.format('segment start', 'fills', 'gain/loss', 'value')]
+    for start, fill_count, gain, value in zip(starts, fill_counts, gains, values):
+        lines.append('{0:<28} {1:>8} {2:>16.2f} {3:>16.2f}'.format(format_timestamp(start), fill_count, gain, value))
+
+    lines.append('')
+    lines.append('{0:<28} {1:>8} {2:>16}'.format('position', 'shares', 'last price'))
+    held = numpy.flatnonzero(portfolio.positions)
+    last = fills.timestamps[-1] if len(fills) else 0
+    prices, _ = price_book.as_of(held, numpy.full(len(held), last, dtype=numpy.int64))
+    for company_id, price in zip(held, prices):
+        lines.append('{0:<28} {1:>8.0f} {2:>16.2f}'.format(portfolio.companies[company_id],
+                                                          portfolio.positions[company_id], price))
+
+    lines.append('')
+    lines.append('Cash: {0:.2f}'.format(portfolio.cash))
+    lines.append('Total gain/loss: {0:.2f}'.format(gains.sum() if len(gains) else 0.0))
+
+    report = '\n'.join(lines) + '\n'
+    with open(report_file, "w") as output_file:
+        output_file.write(report)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Paper trades the signals written out by the SA engine')
+    parser.add_argument("signals", nargs='?', default=process.TRADE_FILE,
+                        help="trade signals (put/call/no, company, soft/hard/trade, timestamp)")
+    parser.add_argument("--prices", required=True, help="price file (timestamp,company,price, with a header line)")
+    parser.add_argument("--database", action="store_true", help="trade the ledger of trades in the database instead")
+    parser.add_argument("--cash", type=float, default=STARTING_CASH, help="starting cash")
+    parser.add_argument("--lot-size", type=int, default=LOT_SIZE, help="shares per lot")
+    parser.add_argument("--segment", type=float, default=SEGMENT_SECONDS,
+                        help="seconds per segment to report gains/losses over")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    if args.database:
+        connection = database.connect(process.DATABASE_FILE)
+        signals = Signals.from_trades(connection.execute(
+            'SELECT kind, company, strength, timestamp FROM trades ORDER BY id').fetchall())
+    else:
+        try:
+            signals = read_signals(args.signals)
+        except IOError:
+            print("Trade file was not found: " + args.signals)
+            sys.exit(1)
+
+    price_book = read_prices(args.prices, signals.companies)
+    portfolio = Portfolio(signals.companies, args.cash, args.lot_size)
+    fills = portfolio.execute(signals, price_book)
+    segments = segment_gains(fills, price_book, args.cash, args.segment)
+
+    os.makedirs(TRADING_DIRECTORY, exist_ok=True)
+    report_file = TRADING_DIRECTORY + '/' + datetime.datetime.now().isoformat() + '.trade'
+    print(write_report(portfolio, fills, segments, price_book, report_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import numpy
+
+# Grabs non-application specific helper modules
+import scores
+
+"""
+Rolling per-company sentiment over short horizons (the last
+minute, 5 minutes, hour), kept in fixed-size bucketed ring
+buffers so that memory stays bounded however long it runs
+"""
+
+# Horizon name => length in seconds
+HORIZONS = {
+    '1m': 60,
+    '5m': 5 * 60,
+    '1h': 60 * 60,
+}
+
+# Buckets per horizon, each horizon is split into this many equal slices of time
+BUCKETS = 60
+
+
+class RollingWindows:
+    """
+    For each company and horizon, a ring buffer of buckets, each holding
+    the sum of score * weight and of weight of the tweets that fell into
+    that slice of time, and which slice of time it currently holds.
+
+    A tweet is added to its bucket in O(1), a bucket left over from an
+    earlier lap around the ring is emptied first. Querying a window
+    sums the buckets still within it, a fixed amount of work per
+    company, however many tweets went into them. A window covers the
+    current (partly filled) bucket and the buckets before it, so
+    between (BUCKETS - 1) / BUCKETS of the horizon and all of it.
+
+    Windows end at the latest tweet seen rather than the wall clock,
+    so that replaying old tweets gives the same windows.
+    """
+
+    def __init__(self, horizons=HORIZONS, buckets=BUCKETS, capacity=scores.INITIAL_CAPACITY):
+        self.horizons = list(horizons)
+        self.buckets = buckets
+        self.widths = numpy.array([max(horizons[horizon] * 1000000 // buckets, 1) for horizon in self.horizons],
+                                  dtype=numpy.int64)
+        self.ids = {}           # company => row id
+        self.companies = []     # row id => company
+        self.latest = 0         # latest timestamp seen, in microseconds since the epoch
+
+        shape = (capacity, len(self.horizons), buckets)
+        self.score = numpy.zeros(shape, dtype=numpy.float64)
+        self.weight = numpy.zeros(shape, dtype=numpy.float64)
+        self.bucket = numpy.full(shape, -1, dtype=numpy.int64)
+
+    def row(self, company):
+        """
+        Row id of a company, adding empty windows for a new one
+        """
+        row = self.ids.get(company)
+        if row is None:
+            row = len(self.companies)
+            if row == len(self.score):
+                self.grow(2 * row)
+            self.ids[company] = row
+            self.companies.append(company)
+        return row
+
+    def grow(self, capacity):
+        for column, empty in (('score', 0.0), ('weight', 0.0), ('bucket', -1)):
+            old = getattr(self, column)
+            new = numpy.full((capacity,) + old.shape[1:], empty, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+
+    def add_batch(self, batch_companies):
+        """
+        Adds a batch of new information, one dictionary per tweet of
+        company => (score, weight, timestamp), to every horizon at once
+        """
+        rows, weighted_scores, weights, timestamps = [], [], [], []
+        for new_companies in batch_companies:
+            for company, (score, weight, timestamp) in new_companies.items():
+                rows.append(self.row(company))
+                weighted_scores.append(score * weight)
+                weights.append(weight)
+                timestamps.append(scores.to_epoch(timestamp))
+        if not rows:
+            return
+
+        rows = numpy.array(rows, dtype=numpy.int64)
+        timestamps = numpy.array(timestamps, dtype=numpy.int64)
+        horizon_count = len(self.horizons)
+
+        # Flat index of the (company, horizon, bucket) cell each tweet falls into, per horizon
+        buckets = timestamps[:, None] // self.widths[None, :]
+        cells = ((rows[:, None] * horizon_count + numpy.arange(horizon_count)[None, :]) * self.buckets
+                 + buckets % self.buckets)
+        buckets, cells = buckets.ravel(), cells.ravel()
+        flat_score, flat_weight, flat_bucket = self.score.reshape(-1), self.weight.reshape(-1), self.bucket.reshape(-1)
+
+        # Cells moving on to a newer slice of time are emptied first
+        touched = numpy.unique(cells)
+        previous = flat_bucket[touched].copy()
+        numpy.maximum.at(flat_bucket, cells, buckets)
+        emptied = touched[flat_bucket[touched] != previous]
+        flat_score[emptied] = 0.0
+        flat_weight[emptied] = 0.0
+
+        # Tweets older than what their cell now holds have already left every window
+        is_current = flat_bucket[cells] == buckets
+        numpy.add.at(flat_score, cells[is_current], numpy.repeat(weighted_scores, horizon_count)[is_current])
+        numpy.add.at(flat_weight, cells[is_current], numpy.repeat(weights, horizon_count)[is_current])
+
+        self.latest = max(self.latest, int(timestamps.max()))
+
+    def totals(self, horizon, now=None):
+        """
+        Sums of score * weight and of weight within the
+        horizon's window for every company, in row order
+        """
+        index = self.horizons.index(horizon)
+        count = len(self.companies)
+        current = (self.latest if now is None else now) // self.widths[index]
+        buckets = self.bucket[:count, index]
+        is_live = (buckets > current - self.buckets) & (buckets <= current)
+        return (self.score[:count, index] * is_live).sum(axis=1), (self.weight[:count, index] * is_live).sum(axis=1)
+
+    def window(self, company, horizon, now=None):
+        """
+        A single company's (score * weight sum, weight sum) within the horizon's window
+        """
+        index = self.horizons.index(horizon)
+        row = self.ids.get(company)
+        if row is None:
+            return 0.0, 0.0
+
+        current = (self.latest if now is None else now) // self.widths[index]
+        buckets = self.bucket[row, index]
+        is_live = (buckets > current - self.buckets) & (buckets <= current)
+        return float(self.score[row, index][is_live].sum()), float(self.weight[row, index][is_live].sum())
+
+    def momentum(self, horizon, now=None):
+        """
+        Company => sum of score * weight within the horizon's window, the
+        short-window counterpart of a company's cumulative viability score
+        """
+        totals, _ = self.totals(horizon, now)
+        return dict(zip(self.companies, totals.tolist()))